@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Время импорта alba_client в свежем интерпретаторе.
+
+    python benchmarks/import_time.py [--runs 20] [--max-ms 30]
+
+С --max-ms скрипт завершается с ошибкой, если медиана импорта
+для проверки нотификаций превышает порог.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+CASES = [
+    ('callback', 'from alba_client import AlbaCallback, check_callback_sign'),
+    ('sign', 'from alba_client import sign'),
+    ('service', 'from alba_client import AlbaService'),
+]
+
+
+def measure(statement, runs):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.join(os.path.dirname(__file__), '..', 'src')] +
+        [os.environ.get('PYTHONPATH', '')]))
+    baseline, timings = [], []
+    for _ in range(runs):
+        for code, target in (('pass', baseline), (statement, timings)):
+            started = time.time()
+            subprocess.check_call([sys.executable, '-c', code], env=env)
+            target.append(time.time() - started)
+    median = sorted(timings)[len(timings) // 2]
+    interpreter = sorted(baseline)[len(baseline) // 2]
+    return max(median - interpreter, 0) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    results = {}
+    for name, statement in CASES:
+        results[name] = measure(statement, args.runs)
+        print('{:<10} {:>8.1f} ms  {}'.format(name, results[name], statement))
+    if args.max_ms is not None and results['callback'] > args.max_ms:
+        print('callback import is slower than {} ms'.format(args.max_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
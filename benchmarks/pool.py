@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Сравнение запросов через requests.post и через ConnectionPool
+на локальном заглушечном сервере. Сервер считает принятые
+TCP-соединения, так видно, сколько рукопожатий удалось переиспользовать.
+
+    python benchmarks/pool.py [число запросов]
+"""
+from __future__ import print_function, unicode_literals
+
+import json
+import sys
+import threading
+import time
+
+import requests
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from alba_client import AlbaService, ConnectionPool
+
+BODY = json.dumps({'status': 'success', 'tid': 1}).encode('utf-8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+
+
+def run(label, server, call, count):
+    server.connections = 0
+    started = time.time()
+    for _ in range(count):
+        call()
+    elapsed = time.time() - started
+    print('{:<14} {:>6} req  {:>8.1f} req/s  {:>6} connections'.format(
+        label, count, count / elapsed, server.connections))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    profile = dict(AlbaService.FIRST_CONNECTION_PROFILE, base_url=base_url)
+    url = base_url + 'alba/input/'
+
+    run('requests.post', server,
+        lambda: requests.post(url, {'tid': '1'}), count)
+
+    service = AlbaService('1', 'secret', connection_profile=profile,
+                          pool=ConnectionPool())
+    run('ConnectionPool', server,
+        lambda: service.init_payment('mc', 10, 'Test', 'a@b.c', '7911'),
+        count)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Сравнение sign() и заранее подготовленного Signer.
+
+    python benchmarks/sign.py [число вызовов]
+"""
+from __future__ import print_function, unicode_literals
+
+import sys
+import timeit
+
+from alba_client.sign import Signer, sign
+
+URL = 'https://partner.rficb.ru/alba/input/'
+SECRET = 'secret'
+PARAMS = {
+    'cost': 200,
+    'name': 'Тестовый заказ',
+    'email': 'test@example.com',
+    'phone_number': '79091234567',
+    'background': '1',
+    'type': 'spg',
+    'service_id': '10000',
+    'order_id': '123456',
+    'version': '2.0',
+}
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    signer = Signer('POST', URL, SECRET)
+    assert signer(PARAMS) == sign('POST', URL, PARAMS, SECRET)
+
+    for label, func in (
+            ('sign()', lambda: sign('POST', URL, PARAMS, SECRET)),
+            ('Signer', lambda: signer(PARAMS))):
+        elapsed = min(timeit.repeat(func, number=number, repeat=5))
+        print('{:<8} {:>10.0f} ops/s  {:>6.2f} us/op'.format(
+            label, number / elapsed, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
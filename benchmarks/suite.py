@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Набор бенчмарков клиента: подпись запросов, проверка подписи
+нотификаций, сборка полей init_payment, разбор JSON-ответа и полный
+путь запроса к локальному заглушечному серверу - последовательно,
+в нескольких потоках и в asyncio (если установлен aiohttp).
+
+    python benchmarks/suite.py [--number 5000] [--threads 8] [--save base.json]
+    python benchmarks/suite.py --baseline base.json [--threshold 0.1]
+    python benchmarks/suite.py --diff base.json new.json
+
+Для каждого случая выводятся ops/s и перцентили задержки в микросекундах.
+С --baseline или --diff скрипт завершается с ошибкой, если ops/s
+какого-либо случая упали больше чем на threshold.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+from alba_client import AlbaService
+from alba_client.sign import callback_sign, check_callback_sign, sign
+from alba_client.transport import MemoryTransport
+
+from pool import BODY, StubServer
+from sign import PARAMS, SECRET, URL
+
+PERCENTILES = (50, 90, 99)
+
+
+def summarize(timings, elapsed):
+    timings = sorted(timings)
+    result = {'ops': len(timings) / elapsed}
+    for percentile in PERCENTILES:
+        index = min(len(timings) - 1, len(timings) * percentile // 100)
+        result['p{}'.format(percentile)] = timings[index] * 1e6
+    return result
+
+
+def measure(func, number):
+    timings = []
+    started = time.perf_counter()
+    for _ in range(number):
+        call_started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - call_started)
+    return summarize(timings, time.perf_counter() - started)
+
+
+def measure_threads(func, number, threads):
+    timings = [[] for _ in range(threads)]
+
+    def worker(target):
+        for _ in range(number // threads):
+            call_started = time.perf_counter()
+            func()
+            target.append(time.perf_counter() - call_started)
+
+    workers = [threading.Thread(target=worker, args=(target,))
+               for target in timings]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return summarize([t for target in timings for t in target], elapsed)
+
+
+def measure_async(make_service, call, number, concurrency):
+    import asyncio
+
+    async def scenario():
+        timings = []
+        async with make_service() as service:
+            async def worker():
+                for _ in range(number // concurrency):
+                    call_started = time.perf_counter()
+                    await call(service)
+                    timings.append(time.perf_counter() - call_started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+            return summarize(timings, time.perf_counter() - started)
+
+    return asyncio.run(scenario())
+
+
+def micro_cases():
+    service = AlbaService('10000', SECRET, transport=MemoryTransport(
+        handler=lambda method, url, data: (200, BODY), history=1))
+    post = {key: str(value) for key, value in PARAMS.items()}
+    post.update(tid='1', command='success', partner_id='1')
+    post['check'] = callback_sign(post, SECRET)
+    assert check_callback_sign(post, SECRET)
+    return [
+        ('sign', lambda: sign('POST', URL, PARAMS, SECRET)),
+        ('check_callback_sign', lambda: check_callback_sign(post, SECRET)),
+        ('init_payment (memory)', lambda: service.init_payment(
+            'spg', 200, 'Test', 'test@example.com', '79091234567',
+            order_id='123456')),
+        ('parse_response', lambda: service._parse_response(200, BODY)),
+    ]
+
+
+def request_cases(args, base_url):
+    profile = dict(AlbaService.FIRST_CONNECTION_PROFILE, base_url=base_url)
+    service = AlbaService('10000', SECRET, connection_profile=profile)
+
+    def call():
+        service.init_payment('spg', 200, 'Test', 'test@example.com',
+                             '79091234567')
+
+    number = args.number // 5
+    yield 'init_payment (http)', measure(call, number)
+    name = 'init_payment (http, {} threads)'.format(args.threads)
+    yield name, measure_threads(call, number, args.threads)
+    try:
+        from alba_client.aio import AsyncAlbaService
+    except ImportError:
+        return
+
+    name = 'init_payment (asyncio, {} tasks)'.format(args.threads)
+    yield name, measure_async(
+        lambda: AsyncAlbaService('10000', SECRET,
+                                 connection_profile=profile),
+        lambda service: service.init_payment(
+            'spg', 200, 'Test', 'test@example.com', '79091234567'),
+        number, args.threads)
+
+
+def run(args):
+    results = {}
+    for name, func in micro_cases():
+        results[name] = measure(func, args.number)
+        report(name, results[name])
+
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    try:
+        for name, result in request_cases(args, base_url):
+            results[name] = result
+            report(name, result)
+    finally:
+        server.shutdown()
+    return results
+
+
+def report(name, result):
+    print('{:<34} {:>10.0f} ops/s  '.format(name, result['ops']) +
+          '  '.join('p{0} {1:>8.1f} us'.format(
+              p, result['p{}'.format(p)]) for p in PERCENTILES))
+
+
+def compare(baseline, current, threshold):
+    """
+    Сравнение двух прогонов, возвращает число регрессий
+    """
+    regressions = 0
+    for name in sorted(set(baseline) & set(current)):
+        ratio = current[name]['ops'] / baseline[name]['ops']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{:<34} {:>10.0f} -> {:>10.0f} ops/s  {:>+7.1%}{}'.format(
+            name, baseline[name]['ops'], current[name]['ops'],
+            ratio - 1, flag))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--save', help='сохранить результаты в JSON')
+    parser.add_argument('--baseline', help='сравнить с сохранённым прогоном')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'),
+                        help='сравнить два сохранённых прогона')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.diff:
+        old, new = map(load, args.diff)
+        return 1 if compare(old, new, args.threshold) else 0
+
+    results = run(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        print()
+        return 1 if compare(load(args.baseline), results,
+                            args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
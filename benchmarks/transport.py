@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Сравнение транспортов AlbaService на локальном заглушечном сервере.
+MemoryTransport показывает накладные расходы самого клиента без сети.
+HTTPXTransport с HTTP/2 требует TLS на стороне сервера, поэтому здесь
+он запускается в режиме HTTP/1.1.
+
+    python benchmarks/transport.py [число запросов]
+"""
+from __future__ import print_function, unicode_literals
+
+import sys
+import threading
+
+from alba_client import AlbaService
+from alba_client.transport import (
+    HTTPXTransport, MemoryTransport, RequestsTransport, Urllib3Transport)
+
+from pool import BODY, StubServer, run
+
+
+def transports(base_url):
+    yield 'memory', MemoryTransport(
+        {base_url + 'alba/input/': (200, BODY)}, history=1)
+    yield 'requests', RequestsTransport()
+    yield 'urllib3', Urllib3Transport()
+    try:
+        yield 'httpx', HTTPXTransport(http2=False)
+    except ImportError:
+        print('httpx не установлен, пропускаем')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    base_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    profile = dict(AlbaService.FIRST_CONNECTION_PROFILE, base_url=base_url)
+    for label, transport in transports(base_url):
+        service = AlbaService('1', 'secret', connection_profile=profile,
+                              transport=transport)
+        run(label, server,
+            lambda: service.init_payment('mc', 10, 'Test', 'a@b.c', '7911'),
+            count)
+        service.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
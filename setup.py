@@ -17,7 +17,19 @@ setup(
     packages=find_packages('src'),
     package_dir={'': 'src'},
 
-    install_requires=['setuptools', 'requests', 'six'],
+    install_requires=['setuptools', 'requests', 'six',
+                      'futures; python_version < "3"'],
+    extras_require={
+        'async': ['aiohttp'],
+        'http2': ['httpx[http2]'],
+    },
+    entry_points={
+        'console_scripts': [
+            'alba-refunds = alba_client.refunds:main',
+            'alba-reconcile = alba_client.reconcile:main',
+            'alba-fake-gateway = alba_client.testing:main',
+        ],
+    },
 
     classifiers=[
         'Intended Audience :: Developers',
@@ -1,2 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Модули с HTTP-клиентом (requests) загружаются при первом обращении,
+поэтому проверка подписей и нотификаций импортируется без сторонних
+зависимостей
+"""
+import sys
 
-from .client import AlbaException, AlbaService, AlbaCallback
+from .exceptions import (
+    AlbaException, AlbaConnectionError, AlbaRateLimitError, AlbaTimeoutError,
+    AuthError, MissArgumentError, UniqueError, CODE2EXCEPTION)
+from .sign import Signer, check_callback_sign, sign
+
+_LAZY = {
+    'AlbaService': 'service',
+    'AlbaCallback': 'callback',
+    'ConnectionPool': 'connection',
+    'MetadataCache': 'cache',
+}
+
+
+if sys.version_info < (3, 7):
+    from .client import (
+        AlbaService, AlbaCallback, ConnectionPool, MetadataCache)
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name))
+    import importlib
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Совместимость Python 2 и 3 без сторонних зависимостей для модулей,
+которые должны импортироваться без requests и six
+"""
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import parse_qs, quote, urlencode, urlparse
+except ImportError:
+    from urllib import quote, urlencode
+    from urlparse import parse_qs, urlparse
+
+__all__ = ['text_type', 'queue', 'parse_qs', 'quote', 'urlencode',
+           'urlparse']
@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронный клиент Alba на asyncio и aiohttp.
+
+    from alba_client.aio import AsyncAlbaService
+
+    service = AsyncAlbaService(<service-id>, '<service-secret>')
+    response = await service.init_payment(
+        'mc', 10, 'Test', 'test@example.com', '71111111111')
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import os
+import time
+
+import aiohttp
+
+from .batch import BatchResult
+from .cache import FRESH, STALE
+from .deadline import Deadline
+from .exceptions import AlbaConnectionError, AlbaException, AlbaTimeoutError
+from .models import GateDetails, Transaction, pay_types
+from .service import AlbaService
+from .transport import _encode_params
+
+
+async def _call_async(func, item):
+    try:
+        return BatchResult(item, await func(item), None)
+    except Exception as e:
+        return BatchResult(item, None, e)
+
+
+async def run_concurrently_async(func, items, max_workers=100):
+    """
+    Асинхронный аналог run_concurrently: вызывает корутину func для
+    каждого элемента items и отдаёт BatchResult по мере готовности,
+    одновременно выполняется не более max_workers вызовов
+    """
+    pending = set()
+    for item in items:
+        pending.add(asyncio.ensure_future(_call_async(func, item)))
+        if len(pending) < max_workers:
+            continue
+        done, pending = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+    while pending:
+        done, pending = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+
+async def acquire_async(rate_limiter, service_id, endpoint, max_wait=None):
+    """
+    То же, что RateLimiter.acquire, но ожидание не блокирует event loop
+    """
+    wait = rate_limiter._reserve(service_id, endpoint, max_wait)
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+
+async def _close_with_loop(session):
+    """
+    Асинхронный генератор, который asyncio.run закрывает через
+    loop.shutdown_asyncgens() перед закрытием event loop, а вместе с ним
+    закрывается и сессия
+    """
+    try:
+        yield
+    finally:
+        await session.close()
+
+
+class AsyncConnectionPool(object):
+    """
+    Пул HTTP-соединений поверх aiohttp.ClientSession.
+
+    Как и ConnectionPool, может быть общим для нескольких сервисов.
+    Сессия создаётся при первом запросе и пересоздаётся после fork
+    или при смене event loop; сессия прежнего loop закрывается в нём,
+    в том числе при завершении asyncio.run.
+
+    pool_size максимальное число одновременных соединений
+    pool_size_per_host ограничение на один хост, 0 - без ограничения
+    keep_alive переиспользовать ли соединения между запросами
+    """
+
+    def __init__(self, pool_size=100, pool_size_per_host=0,
+                 keep_alive=True):
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.keep_alive = keep_alive
+        self._session = None
+        self._guard = None
+        self._loop = None
+        self._pid = None
+
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_size_per_host,
+            force_close=not self.keep_alive)
+        return aiohttp.ClientSession(connector=connector)
+
+    @property
+    def session(self):
+        loop = asyncio.get_running_loop()
+        pid = os.getpid()
+        if (self._session is None or self._session.closed
+                or self._loop is not loop or self._pid != pid):
+            if self._pid == pid:
+                self._release()
+            self._session = self._create_session()
+            self._guard = _close_with_loop(self._session)
+            # первый шаг генератора не ждёт, его можно выполнить
+            # синхронно; так генератор регистрируется в текущем loop
+            try:
+                self._guard.asend(None).send(None)
+            except StopIteration:
+                pass
+            self._loop = loop
+            self._pid = pid
+        return self._session
+
+    def _release(self):
+        """
+        Закрытие сессии другого event loop, если он ещё не закрыт
+        """
+        session, loop = self._session, self._loop
+        self._session = self._guard = None
+        if (session is not None and not session.closed
+                and not loop.is_closed()):
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    @staticmethod
+    def _client_timeout(timeout):
+        if timeout is None:
+            return aiohttp.ClientTimeout(total=None)
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return aiohttp.ClientTimeout(sock_connect=connect,
+                                         sock_read=read)
+        return aiohttp.ClientTimeout(total=timeout)
+
+    async def request(self, method, url, data=None, timeout=None):
+        """
+        timeout число секунд на весь запрос или пара (connect, read)
+        """
+        params = _encode_params(data)
+        timeout = self._client_timeout(timeout)
+        if method == 'get':
+            context = self.session.get(url, params=params, timeout=timeout)
+        else:
+            context = self.session.post(url, data=params, timeout=timeout)
+        async with context as response:
+            return response.status, await response.read()
+
+    async def close(self):
+        if self._session is not None and self._pid == os.getpid():
+            if self._loop is asyncio.get_running_loop():
+                await self._guard.aclose()
+            else:
+                self._release()
+        self._session = self._guard = None
+
+
+class AsyncAlbaService(AlbaService):
+    """
+    Асинхронный вариант AlbaService с теми же методами.
+    Все публичные методы возвращают корутины.
+    """
+
+    def __init__(self, service_id, secret, connection_profile=None,
+                 logger=None, pool=None, cache=None, failover=None,
+                 timeout=AlbaService.DEFAULT_TIMEOUT, endpoint_timeouts=None,
+                 rate_limiter=None, typed=False, transport=None,
+                 singleflight=None, hooks=(), request_logger=None,
+                 transaction_cache=None):
+        """
+        transport асинхронный транспорт с корутиной request, по умолчанию
+          pool или собственный AsyncConnectionPool
+        """
+        transport = transport or pool or AsyncConnectionPool()
+        super(AsyncAlbaService, self).__init__(
+            service_id, secret, connection_profile=connection_profile,
+            logger=logger, pool=transport, transport=transport, cache=cache,
+            failover=failover, timeout=timeout,
+            endpoint_timeouts=endpoint_timeouts, rate_limiter=rate_limiter,
+            typed=typed, singleflight=singleflight, hooks=hooks,
+            request_logger=request_logger,
+            transaction_cache=transaction_cache)
+
+    async def _coalesce(self, key, func, deadline=None):
+        if self.singleflight is None:
+            return await func()
+        try:
+            return await self.singleflight.do_async(
+                (self.service_id,) + key, func, timeout=deadline)
+        except asyncio.TimeoutError:
+            raise AlbaTimeoutError(
+                'Превышено время выполнения запроса: {} с'.format(deadline))
+
+    async def _transport_request(self, url, method, data, timeout):
+        try:
+            return await self.transport.request(
+                method, url, data, timeout=timeout)
+        except asyncio.TimeoutError as e:
+            raise AlbaTimeoutError(e)
+        except aiohttp.ClientError as e:
+            raise AlbaConnectionError(e)
+
+    async def _request(self, url, method, data, timeout=None,
+                       sign_time=None):
+        log = self.request_logger.sent(method, url, data)
+        if self.hooks is None:
+            status_code, content = await self._transport_request(
+                url, method, data, timeout)
+            self.request_logger.received(log, status_code, content)
+            return self._parse_response(status_code, content)
+
+        event, tokens = self.hooks.request(
+            self.service_id, method, url, data, sign_time)
+        try:
+            status_code, content = await self._transport_request(
+                url, method, data, timeout)
+            self.request_logger.received(log, status_code, content)
+            event.received(status_code, content)
+            return self._parse_response(status_code, content)
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            self.hooks.request_finished(event, tokens)
+
+    async def _call(self, method, path, fields=None, url_key='base_url',
+                    signed=True, idempotent=False, hedge=False,
+                    deadline=None):
+        endpoint = self._endpoint(path)
+        timeout = self.endpoint_timeouts.get(endpoint, self.timeout)
+        deadline = Deadline.start(deadline)
+        if self.rate_limiter is not None:
+            await acquire_async(self.rate_limiter, self.service_id,
+                                endpoint, self._max_wait(deadline))
+        if self.failover is None:
+            return await self._send(method, self._url(path, url_key),
+                                    fields, signed, timeout, deadline)
+
+        def send(base):
+            return self._send(method, base + path, fields, signed,
+                              timeout, deadline)
+
+        failover = self.failover
+        endpoint = None
+        for attempt in range(failover.attempts(idempotent)):
+            if attempt:
+                await asyncio.sleep(failover.delay(attempt, error, deadline))
+            if deadline is not None:
+                deadline.check()
+            endpoint = failover.choose(url_key, avoid=endpoint)
+            try:
+                if hedge and failover.hedge_after is not None:
+                    return await self._hedged(send, url_key, endpoint,
+                                              deadline)
+                return await self._run(endpoint, send)
+            except AlbaConnectionError as e:
+                error = e
+        raise error
+
+    async def _run(self, endpoint, send):
+        started = time.time()
+        try:
+            result = await send(endpoint.base)
+        except AlbaConnectionError:
+            endpoint.record_failure()
+            raise
+        except asyncio.CancelledError:
+            # отменённый пробный запрос не должен занимать адрес навсегда
+            endpoint.breaker.release()
+            raise
+        except Exception:
+            endpoint.record_success(time.time() - started)
+            raise
+        endpoint.record_success(time.time() - started)
+        return result
+
+    async def _hedged(self, send, url_key, primary, deadline=None):
+        pending = {asyncio.ensure_future(self._run(primary, send))}
+        done, _ = await asyncio.wait(
+            pending, timeout=self.failover.hedge_after)
+        if not done and (deadline is None or deadline.remaining() > 0):
+            secondary = self.failover._secondary(url_key, primary)
+            if secondary is not None:
+                pending.add(asyncio.ensure_future(
+                    self._run(secondary, send)))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    result = task.result()
+                except AlbaConnectionError as e:
+                    error = e
+                    continue
+                for other in pending:
+                    other.cancel()
+                return result
+        raise error
+
+    async def _refresh(self, cache, key, loader):
+        try:
+            cache.set(key, await loader())
+        except Exception:
+            self.logger.exception('Cache refresh failed for %r', key)
+        finally:
+            cache.end_refresh(key)
+
+    async def _cached(self, cache, key, loader):
+        value, state = cache.lookup(key)
+        if state == FRESH:
+            return value
+        if state == STALE:
+            if cache.begin_refresh(key):
+                asyncio.ensure_future(self._refresh(cache, key, loader))
+            return value
+        value = await loader()
+        cache.set(key, value)
+        return value
+
+    async def _load_pay_types(self, deadline=None):
+        return (await self._call('get', self._pay_types_path(),
+                                 signed=False, idempotent=True,
+                                 deadline=deadline))['types']
+
+    async def pay_types(self, deadline=None):
+        """
+        Получение списка доступных способов оплаты для сервиса
+        """
+        def load():
+            return self._coalesce(('alba/pay_types/',),
+                                  lambda: self._load_pay_types(deadline),
+                                  deadline)
+
+        if self.cache is None:
+            types = await load()
+        else:
+            types = await self._cached(
+                self.cache.pay_types, self._pay_types_key(), load)
+        return self._result(pay_types, types)
+
+    async def gate_details(self, gate, deadline=None):
+        """
+        получение информации о шлюзе
+        gate короткое имя шлюза
+        """
+        def load():
+            return self._coalesce(('alba/gate_details/', gate),
+                                  lambda: self._load_gate_details(
+                                      gate, deadline), deadline)
+
+        if self.cache is None:
+            details = await load()
+        else:
+            details = await self._cached(
+                self.cache.gate_details, self._gate_details_key(gate), load)
+        return self._result(GateDetails, details)
+
+    async def warm_up(self, gates=()):
+        """
+        Заполнение кеша pay_types и gate_details при старте процесса
+        """
+        if self.cache is None:
+            raise AlbaException('Кеш для сервиса не настроен')
+        self.cache.pay_types.set(self._pay_types_key(),
+                                 await self._load_pay_types())
+        for gate in gates:
+            self.cache.gate_details.set(self._gate_details_key(gate),
+                                        await self._load_gate_details(gate))
+
+    async def create_card_token(
+            self, card, exp_month, exp_year, cvc, test,
+            card_holder=None, deadline=None):
+        params = self._card_token_params(
+            card, exp_month, exp_year, cvc, card_holder)
+        result = await self._create_card_token(params, test, deadline)
+        return self._card_token(result)
+
+    async def transaction_details(self, tid=None, order_id=None,
+                                  deadline=None):
+        params = self._details_params(tid, order_id)
+        details = self._cached_details(params)
+        if details is None:
+            details = await self._coalesce(
+                self._details_key(params),
+                lambda: self._call('post', 'alba/details/', params,
+                                   idempotent=True, deadline=deadline),
+                deadline)
+            self._store_details(params, details)
+        return self._result(Transaction, details)
+
+    async def transaction_details_batch(self, tids=None, order_ids=None,
+                                        max_workers=100, deadline=None):
+        """
+        Пакетное получение информации о транзакциях, асинхронный генератор
+        BatchResult в порядке готовности; одновременно выполняется
+        не более max_workers запросов
+        """
+        async for result in run_concurrently_async(
+                lambda item: self.transaction_details(
+                    deadline=deadline, **item),
+                self._details_items(tids, order_ids), max_workers):
+            yield result
+
+    async def create_card_tokens(self, cards, test, max_workers=100,
+                                 deadline=None):
+        """
+        Пакетная токенизация карт, асинхронный генератор BatchResult
+        """
+        async for result in run_concurrently_async(
+                lambda card: self.create_card_token(
+                    test=test, deadline=deadline, **card),
+                cards, max_workers):
+            yield result
+
+    async def close(self):
+        await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
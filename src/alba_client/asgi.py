@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI приложение для приёма нотификаций Alba на asyncio.
+
+Поведение как у alba_client.webhook.WSGICallbackApp, но нотификации
+разбирают задачи asyncio.
+
+    from alba_client.asgi import ASGICallbackApp
+
+    application = ASGICallbackApp(MyAlbaCallback([service]), workers=4)
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import logging
+
+from .webhook import (
+    BLOCK, DROP_OLDEST, REJECT, _dropped, _metrics_response, _QueueMetrics,
+    _response, _verify)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCallbackQueue(object):
+    """
+    Вариант CallbackQueue для asyncio: нотификации обрабатываются
+    задачами, а синхронные обработчики AlbaCallback выполняются
+    в executor, чтобы не блокировать event loop
+    """
+
+    def __init__(self, callback, maxsize=1000, workers=4, overflow=REJECT,
+                 block_timeout=5, executor=None):
+        self.callback = callback
+        self.maxsize = maxsize
+        self.workers = workers
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.executor = executor
+        self.stats = _QueueMetrics(maxsize)
+        self.queue = None
+        self._tasks = []
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.maxsize)
+            self._tasks = [asyncio.ensure_future(self._work())
+                           for _ in range(self.workers)]
+
+    async def put(self, data):
+        self.start()
+        try:
+            if self.overflow == BLOCK:
+                await asyncio.wait_for(self.queue.put(data),
+                                       self.block_timeout)
+            else:
+                self.queue.put_nowait(data)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            if self.overflow != DROP_OLDEST:
+                self.stats.incr('rejected')
+                return False
+            _dropped(self.queue.get_nowait())
+            self.queue.task_done()
+            self.stats.incr('dropped')
+            return await self.put(data)
+        self.stats.incr('accepted')
+        return True
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await self.queue.get()
+            try:
+                await loop.run_in_executor(
+                    self.executor, self.callback._dispatch, data)
+                self.stats.incr('processed')
+            except Exception:
+                self.stats.incr('failed')
+                logger.exception('Callback processing failed')
+            finally:
+                self.queue.task_done()
+
+    async def join(self):
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.queue = None
+        self._tasks = []
+
+    def metrics(self):
+        depth = self.queue.qsize() if self.queue is not None else 0
+        return self.stats.as_dict(depth)
+
+
+class ASGICallbackApp(object):
+    """
+    ASGI приложение для приёма нотификаций, поведение как
+    у WSGICallbackApp
+    """
+
+    def __init__(self, callback, queue=None, metrics_path='/metrics',
+                 **queue_kwargs):
+        self.callback = callback
+        self.queue = queue or AsyncCallbackQueue(callback, **queue_kwargs)
+        self.metrics_path = metrics_path
+
+    async def process(self, method, path, body):
+        if method == 'GET' and path == self.metrics_path:
+            return _metrics_response(self.queue.metrics())
+        if method != 'POST':
+            return _response(405, 'Method not allowed')
+        post, error = _verify(self.callback, body)
+        if error is not None:
+            return error
+        if not await self.queue.put(post):
+            return _response(503, 'Queue is full')
+        return _response(200, 'OK')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    self.queue.start()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await self.queue.stop()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        status, headers, body = await self.process(
+            scope['method'], scope.get('path', ''), body)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers],
+        })
+        await send({'type': 'http.response.body', 'body': body})
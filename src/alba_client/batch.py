@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, wait)
+
+BatchResult = namedtuple('BatchResult', ['item', 'result', 'error'])
+BatchResult.__doc__ = """
+Результат одного элемента пакетной обработки
+item исходный элемент
+result результат вызова или None при ошибке
+error исключение (как правило, из CODE2EXCEPTION) или None
+"""
+
+
+def _call(func, item):
+    try:
+        return BatchResult(item, func(item), None)
+    except Exception as e:
+        return BatchResult(item, None, e)
+
+
+def run_concurrently(func, items, max_workers=10):
+    """
+    Вызывает func для каждого элемента items в пуле потоков и отдаёт
+    BatchResult по мере готовности. Одновременно выполняется не более
+    max_workers вызовов, items читается лениво, поэтому подходит для
+    больших потоков данных. Ошибка одного элемента не прерывает
+    обработку остальных.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(_call, func, item))
+            if len(pending) < max_workers:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
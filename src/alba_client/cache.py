@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ._compat import text_type
+
+logger = logging.getLogger(__name__)
+
+MISSING = 'missing'
+FRESH = 'fresh'
+STALE = 'stale'
+
+FINAL_STATUSES = frozenset(['payed', 'success', 'refunded'])
+
+
+class TTLCache(object):
+    """
+    Потокобезопасный LRU-кеш с временем жизни записей.
+
+    ttl время (в секундах), в течение которого запись считается свежей
+    maxsize максимальное число записей, лишние вытесняются по LRU
+    stale_ttl сколько ещё секунд после ttl можно отдавать устаревшее
+      значение, обновляя его в фоне (stale-while-revalidate)
+    """
+
+    def __init__(self, ttl, maxsize=128, stale_ttl=0):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def lookup(self, key):
+        """
+        Возвращает пару (значение, состояние), состояние - одно из
+        FRESH, STALE, MISSING
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None, MISSING
+            value, stored = entry
+            age = now - stored
+            if age > self.ttl + self.stale_ttl:
+                del self._data[key]
+                return None, MISSING
+            self._data.pop(key)
+            self._data[key] = entry
+            return value, FRESH if age <= self.ttl else STALE
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def begin_refresh(self, key):
+        """
+        Отмечает начало фонового обновления ключа, возвращает False,
+        если обновление уже идёт
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def _refresh(self, key, loader):
+        try:
+            self.set(key, loader())
+        except Exception:
+            logger.exception('Cache refresh failed for %r', key)
+        finally:
+            self.end_refresh(key)
+
+    def get_or_load(self, key, loader):
+        """
+        Возвращает значение из кеша, при отсутствии загружает его
+        через loader(); устаревшее значение отдаётся сразу, а loader
+        вызывается в фоновом потоке
+        """
+        value, state = self.lookup(key)
+        if state == FRESH:
+            return value
+        if state == STALE:
+            if self.begin_refresh(key):
+                thread = threading.Thread(
+                    target=self._refresh, args=(key, loader))
+                thread.daemon = True
+                thread.start()
+            return value
+        value = loader()
+        self.set(key, value)
+        return value
+
+
+class MetadataCache(object):
+    """
+    Кеш для редко меняющихся данных сервиса: pay_types и gate_details.
+    Может быть общим для нескольких сервисов.
+
+    pay_types_ttl, gate_details_ttl время жизни записей в секундах
+    max_gates максимальное число кешируемых шлюзов
+    stale_ttl сколько секунд можно отдавать устаревшие данные,
+      пока они обновляются в фоне
+    """
+
+    def __init__(self, pay_types_ttl=3600, gate_details_ttl=3600,
+                 max_gates=256, max_services=64, stale_ttl=600):
+        self.pay_types = TTLCache(pay_types_ttl, maxsize=max_services,
+                                  stale_ttl=stale_ttl)
+        self.gate_details = TTLCache(gate_details_ttl, maxsize=max_gates,
+                                     stale_ttl=stale_ttl)
+
+    def clear(self):
+        self.pay_types.invalidate()
+        self.gate_details.invalidate()
+
+
+class TransactionCache(object):
+    """
+    Постоянный кеш transaction_details для транзакций в окончательном
+    статусе, которые больше не меняются. Хранится в файле SQLite и может
+    быть общим для нескольких процессов и сервисов на одной машине.
+
+    path путь к файлу базы, ':memory:' - кеш в памяти процесса
+    maxsize максимальное число транзакций, при переполнении вытесняются
+      сохранённые раньше других
+    statuses значения transaction_status, которые кешируются
+    hits, misses число найденных и ненайденных в кеше транзакций
+    """
+
+    def __init__(self, path, maxsize=100000, statuses=FINAL_STATUSES):
+        self.path = path
+        self.maxsize = maxsize
+        self.statuses = frozenset(statuses)
+        self.hits = 0
+        self.misses = 0
+        self._connect(os.getpid())
+
+    def _connect(self, pid):
+        self._lock = threading.Lock()
+        self._pid = pid
+        self._connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False,
+            isolation_level=None)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS alba_transactions '
+            '(service_id TEXT NOT NULL, tid TEXT NOT NULL, order_id TEXT, '
+            'data TEXT NOT NULL, PRIMARY KEY (service_id, tid))')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS alba_transactions_order '
+            'ON alba_transactions (service_id, order_id)')
+
+    @contextmanager
+    def _db(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # соединение SQLite нельзя использовать после fork,
+            # унаследованное от родителя не трогаем
+            self._connect(pid)
+        with self._lock:
+            yield self._connection
+
+    def __len__(self):
+        with self._db() as db:
+            return db.execute(
+                'SELECT COUNT(*) FROM alba_transactions').fetchone()[0]
+
+    def get(self, service_id, tid=None, order_id=None):
+        """
+        Данные транзакции сервиса service_id по tid или по order_id,
+        None, если её нет в кеше
+        """
+        if tid:
+            query = ('SELECT data FROM alba_transactions '
+                     'WHERE service_id = ? AND tid = ?')
+            args = (text_type(service_id), text_type(tid))
+        else:
+            query = ('SELECT data FROM alba_transactions '
+                     'WHERE service_id = ? AND order_id = ?')
+            args = (text_type(service_id), text_type(order_id))
+        with self._db() as db:
+            row = db.execute(query, args).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, service_id, details, order_id=None):
+        """
+        Сохраняет ответ transaction_details, если статус транзакции
+        окончательный; возвращает True, если ответ сохранён
+        """
+        tid = details.get('tid')
+        if not tid or details.get('transaction_status') not in self.statuses:
+            return False
+        order_id = details.get('order_id') or order_id
+        with self._db() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO alba_transactions '
+                '(service_id, tid, order_id, data) VALUES (?, ?, ?, ?)',
+                (text_type(service_id), text_type(tid),
+                 text_type(order_id) if order_id else None,
+                 json.dumps(details)))
+            # rowid растёт с каждой вставкой, поэтому старые записи
+            # вытесняются без подсчёта строк
+            db.execute(
+                'DELETE FROM alba_transactions WHERE rowid <= '
+                '(SELECT MAX(rowid) FROM alba_transactions) - ?',
+                (self.maxsize,))
+        return True
+
+    def invalidate(self, service_id, tid=None, order_id=None):
+        """
+        Удаляет транзакцию сервиса service_id по tid и/или order_id,
+        без tid и order_id ничего не делает
+        """
+        with self._db() as db:
+            if tid:
+                db.execute(
+                    'DELETE FROM alba_transactions '
+                    'WHERE service_id = ? AND tid = ?',
+                    (text_type(service_id), text_type(tid)))
+            if order_id:
+                db.execute(
+                    'DELETE FROM alba_transactions '
+                    'WHERE service_id = ? AND order_id = ?',
+                    (text_type(service_id), text_type(order_id)))
+
+    def clear(self):
+        with self._db() as db:
+            db.execute('DELETE FROM alba_transactions')
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._connection.close()
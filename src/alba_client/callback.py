@@ -1,36 +1,115 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from six import text_type
+from ._compat import text_type
+
+from .exceptions import AlbaException
+from .metrics import CallbackEvent, as_hooks
 
 
 class AlbaCallback(object):
 
-    def __init__(self, services):
+    def __init__(self, services=(), deduplicator=None, registry=None,
+                 watcher=None, hooks=(), transaction_cache=None):
         """
         services список сервисов
+        deduplicator CallbackDeduplicator для подавления повторных
+          нотификаций, по умолчанию повторы обрабатываются заново
+        registry ServiceRegistry для загрузки сервисов, отсутствующих
+          в services, по мере поступления нотификаций
+        watcher StatusWatcher, которому передаются проверенные нотификации,
+          чтобы он прекратил опрос завершённых транзакций
+        hooks хуки обработки нотификаций из alba_client.metrics
+        transaction_cache TransactionCache, из которого удаляется
+          транзакция при нотификации refund
         """
         self.services = {
             text_type(service.service_id): service for service in services
         }
+        self.deduplicator = deduplicator
+        self.registry = registry
+        self.watcher = watcher
+        self.hooks = as_hooks(hooks)
+        self.transaction_cache = transaction_cache
 
-    def handle(self, post):
+    def get_service(self, service_id):
         """
-        Обработка нотификаций
+        Сервис по service_id или None, если он неизвестен
+        """
+        service = self.services.get(service_id)
+        if service is None and self.registry is not None:
+            service = self.registry.get(service_id)
+        return service
+
+    def verify(self, post):
         """
+        Проверка нотификации без её обработки
+        """
+        if self.hooks is None:
+            self._verify(post)
+            return
+        event = CallbackEvent(post)
+        try:
+            self._verify(post)
+        except Exception as e:
+            self.hooks.callback_rejected(event, e)
+            raise
+
+    def _verify(self, post):
         if 'service_id' not in post:
             raise AlbaException(
                 'Отсутствует обязательный параметр service_id')
 
-        if post['service_id'] in self.services:
-            service = self.services[post['service_id']]
-            if service.check_callback_sign(post):
-                self.callback(post)
-            else:
-                raise AlbaException("Ошибка в подписи")
-        else:
+        service = self.get_service(post['service_id'])
+        if service is None:
             raise AlbaException(
-                "Неизвестный сервис: %s" % type(post['service_id']))
+                "Неизвестный сервис: %s" % post['service_id'])
+        if not service.check_callback_sign(post):
+            raise AlbaException("Ошибка в подписи")
+
+    def handle(self, post):
+        """
+        Обработка нотификаций
+        """
+        self.verify(post)
+        self._dispatch(post)
+
+    def _dispatch(self, data):
+        """
+        Обработка проверенной нотификации, вызывается из handle
+        и из очередей alba_client.webhook
+        """
+        if self.hooks is None:
+            self._process(data)
+            return
+
+        event, tokens = self.hooks.callback(data)
+        try:
+            self._process(data)
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            self.hooks.callback_finished(event, tokens)
+
+    def _process(self, data):
+        if self.watcher is not None:
+            self.watcher.notify(data)
+        if (self.transaction_cache is not None
+                and data.get('command') == 'refund'):
+            self.transaction_cache.invalidate(
+                data.get('service_id'), data.get('tid'), data.get('order_id'))
+        if self.deduplicator is None:
+            self.callback(data)
+            return
+        key = self.deduplicator.key(data)
+        if not self.deduplicator.acquire(key):
+            return
+        try:
+            self.callback(data)
+        except Exception:
+            self.deduplicator.release(key)
+            raise
 
     def callback(self, data):
         """
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 from .exceptions import *
-from .sign import sign
+from .cache import MetadataCache
+from .connection import ConnectionPool
+from .sign import sign, Signer
 from .service import AlbaService
 from .callback import AlbaCallback
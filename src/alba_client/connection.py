@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ConnectionPool(object):
+    """
+    Пул HTTP-соединений к Alba поверх requests.Session.
+
+    Один пул можно передать нескольким AlbaService, тогда они будут
+    переиспользовать общие keep-alive соединения. После fork (например,
+    в воркерах gunicorn) сессия пересоздаётся, чтобы процессы не делили
+    между собой сокеты.
+
+    pool_size максимальное число соединений к одному хосту
+    pool_hosts число хостов, для которых держатся соединения
+    keep_alive переиспользовать ли соединения между запросами
+    """
+
+    def __init__(self, pool_size=10, pool_hosts=4, keep_alive=True):
+        self.pool_size = pool_size
+        self.pool_hosts = pool_hosts
+        self.keep_alive = keep_alive
+        self._reset(os.getpid())
+
+    def _reset(self, pid):
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = pid
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_hosts,
+                              pool_maxsize=self.pool_size,
+                              pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @property
+    def session(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # унаследованные от родителя соединения не трогаем
+            self._reset(pid)
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def request(self, method, url, data=None, timeout=None):
+        if method == 'get':
+            return self.session.get(url, params=data, timeout=timeout)
+        return self.session.post(url, data, timeout=timeout)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None and self._pid == os.getpid():
+                self._session.close()
+            self._session = None
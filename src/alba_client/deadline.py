@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from .exceptions import AlbaTimeoutError
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class Deadline(object):
+    """
+    Крайний срок выполнения вызова, отсчитывается от момента создания
+    seconds сколько секунд отведено на вызов
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = clock() + seconds
+
+    @classmethod
+    def start(cls, seconds):
+        return None if seconds is None else cls(seconds)
+
+    def remaining(self):
+        return self.expires - clock()
+
+    def check(self):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise AlbaTimeoutError(
+                'Превышено время выполнения запроса: {} с'
+                .format(self.seconds))
+        return remaining
+
+    def clamp(self, timeout):
+        """
+        Ограничивает таймаут (число или пара connect, read) оставшимся
+        временем
+        """
+        remaining = self.check()
+        if timeout is None:
+            return remaining
+        if isinstance(timeout, tuple):
+            return tuple(remaining if value is None else min(value, remaining)
+                         for value in timeout)
+        return min(timeout, remaining)
+
+
+def effective_timeout(timeout, deadline):
+    if deadline is None:
+        return timeout
+    return deadline.clamp(timeout)
@@ -2,9 +2,22 @@
 
 
 class AlbaException(Exception):
-    def __init__(self, message, errors=None):
+    def __init__(self, message, errors=None, code=None):
         super(AlbaException, self).__init__(message)
         self.errors = errors or {}
+        self.code = code
+
+
+class AlbaConnectionError(AlbaException):
+    pass
+
+
+class AlbaTimeoutError(AlbaConnectionError):
+    pass
+
+
+class AlbaRateLimitError(AlbaException):
+    pass
 
 
 class UniqueError(AlbaException):
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .exceptions import AlbaConnectionError
+
+
+class CircuitBreaker(object):
+    """
+    Размыкатель цепи для одного адреса.
+
+    После failure_threshold ошибок подряд адрес исключается из работы
+    на reset_timeout секунд, затем пропускается один пробный запрос:
+    при успехе адрес возвращается в работу, при ошибке снова
+    исключается
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    time.time() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def release(self):
+        """
+        Возврат пробного запроса, который был отменён без ответа:
+        адрес снова ждёт пробы, и её можно выполнить сразу
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.time() - self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+class Endpoint(object):
+    """
+    Адрес (base_url или card_token_url профиля) и его состояние
+    """
+
+    def __init__(self, base, breaker):
+        self.base = base
+        self.breaker = breaker
+        self.successes = 0
+        self.failures = 0
+        self.latency = None
+
+    def record_success(self, latency):
+        self.successes += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.failures += 1
+        self.breaker.record_failure()
+
+    def run(self, send):
+        started = time.time()
+        try:
+            result = send(self.base)
+        except AlbaConnectionError:
+            self.record_failure()
+            raise
+        except Exception:
+            # ответ получен, ошибка не связана с доступностью адреса
+            self.record_success(time.time() - started)
+            raise
+        self.record_success(time.time() - started)
+        return result
+
+
+class RetryPolicy(object):
+    """
+    Повтор идемпотентных запросов с экспоненциальной задержкой
+    и случайным разбросом (full jitter)
+
+    attempts общее число попыток
+    backoff базовая задержка в секундах
+    max_backoff максимальная задержка в секундах
+    """
+
+    def __init__(self, attempts=3, backoff=0.1, max_backoff=2.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class Failover(object):
+    """
+    Работа с несколькими профилями подключения.
+
+    Для каждого адреса ведётся статистика и размыкатель цепи,
+    запросы направляются на первый доступный адрес в порядке профилей.
+    Идемпотентные запросы при ошибке соединения повторяются по retry
+    на следующем доступном адресе. Если задан hedge_after, запрос,
+    допускающий хеджирование, через hedge_after секунд без ответа
+    дублируется на следующий адрес и используется первый успешный ответ.
+
+    profiles список профилей подключения
+    retry политика повторов RetryPolicy
+    """
+
+    def __init__(self, profiles, retry=None, failure_threshold=5,
+                 reset_timeout=30, hedge_after=None):
+        self.profiles = list(profiles)
+        self.retry = retry or RetryPolicy()
+        self.hedge_after = hedge_after
+        self.endpoints = {}
+        for profile in self.profiles:
+            for url_key, base in profile.items():
+                endpoints = self.endpoints.setdefault(url_key, [])
+                if base not in [endpoint.base for endpoint in endpoints]:
+                    endpoints.append(Endpoint(base, CircuitBreaker(
+                        failure_threshold, reset_timeout)))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def health(self):
+        """
+        Состояние адресов: {base: {state, successes, failures, latency}}
+        """
+        return {
+            endpoint.base: {
+                'state': endpoint.breaker.state,
+                'successes': endpoint.successes,
+                'failures': endpoint.failures,
+                'latency': endpoint.latency,
+            }
+            for endpoints in self.endpoints.values()
+            for endpoint in endpoints
+        }
+
+    def attempts(self, idempotent):
+        return self.retry.attempts if idempotent else 1
+
+    def choose(self, url_key, avoid=None):
+        """
+        Первый доступный адрес, по возможности отличный от avoid.
+        allow() вызывается только до первого подходящего адреса, чтобы
+        пробный запрос занимали лишь адреса, которые действительно выбраны
+        """
+        endpoints = self.endpoints[url_key]
+        for endpoint in ([e for e in endpoints if e is not avoid] +
+                         [e for e in endpoints if e is avoid]):
+            if endpoint.breaker.allow():
+                return endpoint
+        raise AlbaConnectionError('Нет доступных адресов: {}'
+                                  .format(url_key))
+
+    def delay(self, attempt, error, deadline=None):
+        """
+        Задержка перед повтором; если она не укладывается в deadline,
+        повтор не выполняется и поднимается последняя ошибка
+        """
+        delay = self.retry.delay(attempt)
+        if deadline is not None and delay >= deadline.remaining():
+            raise error
+        return delay
+
+    def call(self, send, url_key, idempotent=False, hedge=False,
+             deadline=None):
+        """
+        Выполняет send(base) с учётом повторов и переключения адресов,
+        повторы выполняются только пока не истёк deadline. Истёкший
+        deadline проверяется до выбора адреса и не считается ошибкой адреса
+        """
+        endpoint = None
+        for attempt in range(self.attempts(idempotent)):
+            if attempt:
+                time.sleep(self.delay(attempt, error, deadline))
+            if deadline is not None:
+                deadline.check()
+            endpoint = self.choose(url_key, avoid=endpoint)
+            try:
+                if hedge and self.hedge_after is not None:
+                    return self._hedged(send, url_key, endpoint, deadline)
+                return endpoint.run(send)
+            except AlbaConnectionError as e:
+                error = e
+        raise error
+
+    def _secondary(self, url_key, primary):
+        """
+        Адрес для хеджирования или None, если других доступных нет;
+        основной запрос в этом случае просто дожидается ответа
+        """
+        try:
+            secondary = self.choose(url_key, avoid=primary)
+        except AlbaConnectionError:
+            return None
+        return secondary if secondary is not primary else None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=8)
+            return self._executor
+
+    def _hedged(self, send, url_key, primary, deadline=None):
+        executor = self._get_executor()
+        pending = {executor.submit(primary.run, send)}
+        done, _ = wait(pending, timeout=self.hedge_after)
+        if not done and (deadline is None or deadline.remaining() > 0):
+            secondary = self._secondary(url_key, primary)
+            if secondary is not None:
+                pending.add(executor.submit(secondary.run, send))
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except AlbaConnectionError as e:
+                    error = e
+        raise error
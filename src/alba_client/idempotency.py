@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ._compat import text_type
+
+
+class MemoryIdempotencyStore(object):
+    """
+    Хранилище обработанных ключей в памяти процесса с вытеснением по LRU
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._keys:
+                return False
+            self._keys.pop(key)
+            self._keys[key] = None
+            return True
+
+    def add(self, key):
+        """
+        Добавляет ключ, возвращает False, если он уже был
+        """
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys[key] = None
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+
+class SQLiteIdempotencyStore(object):
+    """
+    Хранилище обработанных ключей в файле SQLite, может быть общим
+    для нескольких процессов на одной машине
+
+    path путь к файлу базы
+    max_age через сколько секунд ключи удаляются при вызове prune()
+    """
+
+    def __init__(self, path, max_age=7 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self._connect(os.getpid())
+
+    def _connect(self, pid):
+        self._lock = threading.Lock()
+        self._pid = pid
+        self._connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False,
+            isolation_level=None)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS alba_callbacks '
+            '(key TEXT PRIMARY KEY, created REAL NOT NULL)')
+
+    @contextmanager
+    def _db(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # соединение SQLite нельзя использовать после fork,
+            # унаследованное от родителя не трогаем
+            self._connect(pid)
+        with self._lock:
+            yield self._connection
+
+    @staticmethod
+    def _key(key):
+        return '\x1f'.join(key)
+
+    def __contains__(self, key):
+        with self._db() as db:
+            row = db.execute(
+                'SELECT 1 FROM alba_callbacks WHERE key = ?',
+                (self._key(key),)).fetchone()
+        return row is not None
+
+    def add(self, key):
+        with self._db() as db:
+            cursor = db.execute(
+                'INSERT OR IGNORE INTO alba_callbacks (key, created) '
+                'VALUES (?, ?)', (self._key(key), time.time()))
+        return cursor.rowcount == 1
+
+    def discard(self, key):
+        with self._db() as db:
+            db.execute(
+                'DELETE FROM alba_callbacks WHERE key = ?',
+                (self._key(key),))
+
+    def prune(self):
+        with self._db() as db:
+            db.execute(
+                'DELETE FROM alba_callbacks WHERE created < ?',
+                (time.time() - self.max_age,))
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._connection.close()
+
+
+class CallbackDeduplicator(object):
+    """
+    Подавление повторных нотификаций по ключу (service_id, tid, command).
+
+    Сначала проверяется локальный LRU-кеш, затем общее хранилище
+    backend (например, SQLiteIdempotencyStore), если оно задано.
+    hits число отброшенных повторов, misses число новых нотификаций
+    """
+
+    def __init__(self, backend=None, maxsize=10000):
+        self.local = MemoryIdempotencyStore(maxsize)
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(data):
+        return tuple(text_type(data.get(field, ''))
+                     for field in ('service_id', 'tid', 'command'))
+
+    def _count(self, duplicate):
+        with self._lock:
+            if duplicate:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return not duplicate
+
+    def acquire(self, key):
+        """
+        Возвращает True, если нотификация с таким ключом ещё
+        не обрабатывалась, и помечает её обработанной
+        """
+        if not self.local.add(key):
+            return self._count(True)
+        if self.backend is not None and not self.backend.add(key):
+            return self._count(True)
+        return self._count(False)
+
+    def release(self, key):
+        """
+        Снимает отметку, например, если обработка завершилась ошибкой
+        """
+        self.local.discard(key)
+        if self.backend is not None:
+            self.backend.discard(key)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Файлы заданий, результатов и журнал выполненных заданий
+для пакетных операций
+"""
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+import os
+import threading
+
+from six import text_type
+
+
+def _is_csv(path):
+    return path.lower().endswith('.csv')
+
+
+def read_records(path):
+    """
+    Построчно читает задания из CSV (с заголовком) или JSONL файла
+    """
+    with io.open(path, encoding='utf-8', newline='') as f:
+        if _is_csv(path):
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+class RecordWriter(object):
+    """
+    Запись результатов в CSV или JSONL в зависимости от расширения файла
+    fields колонки для CSV
+    """
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+        self._lock = threading.Lock()
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = io.open(path, 'a', encoding='utf-8', newline='')
+        self._csv = None
+        if _is_csv(path):
+            self._csv = csv.DictWriter(self._file, fields,
+                                       extrasaction='ignore')
+            if not exists:
+                self._csv.writeheader()
+
+    def write(self, record):
+        with self._lock:
+            if self._csv is not None:
+                self._csv.writerow(record)
+            else:
+                self._file.write(json.dumps(record, ensure_ascii=False))
+                self._file.write('\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Journal(object):
+    """
+    Журнал выполненных заданий: по одному ключу на строку.
+    При повторном запуске уже записанные ключи пропускаются;
+    недописанная при аварии последняя строка игнорируется.
+
+    path путь к файлу журнала
+    fsync сбрасывать ли каждую запись на диск
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._done = set()
+        self._lock = threading.Lock()
+        partial = False
+        if os.path.exists(path):
+            with io.open(path, encoding='utf-8') as f:
+                content = f.read()
+            lines = content.split('\n')
+            partial = lines[-1] != ''
+            self._done.update(line for line in lines[:-1] if line)
+        self._file = io.open(path, 'a', encoding='utf-8')
+        if partial:
+            self._file.write('\n')
+
+    def __contains__(self, key):
+        return text_type(key) in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, key):
+        key = text_type(key)
+        with self._lock:
+            if key in self._done:
+                return
+            self._file.write(key + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._done.add(key)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
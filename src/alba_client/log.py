@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Журналирование запросов AlbaService.
+
+Сообщения собираются только тогда, когда запись действительно
+выводится: если уровень DEBUG выключен, запрос не стоит ничего, кроме
+проверки уровня. Часть запросов можно журналировать выборочно, тела
+ответов обрезаются до max_body символов, а номера карт, CVC, подписи
+и секреты маскируются.
+
+    from alba_client.log import RequestLogger
+
+    service = AlbaService(<service-id>, '<service-secret>',
+                          request_logger=RequestLogger(
+                              sample_rates={'alba/details/': 0.01}))
+
+Для структурированных обработчиков в запись добавляется атрибут alba
+со словарём endpoint, method, params, status_code и body.
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import random
+
+from ._compat import text_type, urlparse
+
+REDACTED_FIELDS = frozenset(['card', 'cvc', 'check', 'secret'])
+DEFAULT_MAX_BODY = 2048
+
+
+def mask_card(card):
+    """
+    Номер карты с открытыми первыми 6 и последними 4 цифрами
+    """
+    card = text_type(card)
+    if len(card) > 10:
+        return card[:6] + '*' * (len(card) - 10) + card[-4:]
+    return '*' * len(card)
+
+
+def redact(data, fields=REDACTED_FIELDS):
+    """
+    Копия словаря с замаскированными чувствительными полями
+    """
+    if not isinstance(data, dict) or not fields.intersection(data):
+        return data
+    data = dict(data)
+    for field in fields.intersection(data):
+        if not data[field]:
+            continue
+        data[field] = mask_card(data[field]) if field == 'card' else '***'
+    return data
+
+
+class _Params(object):
+    """
+    Параметры запроса, маскируемые при выводе
+    """
+    __slots__ = ('data', 'fields')
+
+    def __init__(self, data, fields):
+        self.data = data
+        self.fields = fields
+
+    def __str__(self):
+        return text_type(redact(self.data, self.fields))
+
+    __unicode__ = __str__
+
+
+class _Body(object):
+    """
+    Тело ответа, декодируемое, маскируемое и обрезаемое при выводе
+    """
+    __slots__ = ('content', 'fields', 'max_body')
+
+    def __init__(self, content, fields, max_body):
+        self.content = content
+        self.fields = fields
+        self.max_body = max_body
+
+    def __str__(self):
+        body = self.content
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        if self.fields.intersection(body.split('"')):
+            try:
+                body = json.dumps(redact(json.loads(body), self.fields),
+                                  ensure_ascii=False)
+            except ValueError:
+                pass
+        if self.max_body is not None and len(body) > self.max_body:
+            body = '{}... ({} chars)'.format(body[:self.max_body], len(body))
+        return body
+
+    __unicode__ = __str__
+
+
+class RequestLogger(object):
+    """
+    Журнал запросов AlbaService на уровне DEBUG
+
+    logger logging.Logger, по умолчанию журнал сервиса
+    sample_rates доли журналируемых запросов по методам API,
+      например {'alba/details/': 0.1}
+    default_rate доля для остальных методов
+    max_body сколько символов тела ответа выводить, None - без ограничения
+    fields маскируемые поля
+    """
+
+    def __init__(self, logger=None, sample_rates=None, default_rate=1.0,
+                 max_body=DEFAULT_MAX_BODY, fields=REDACTED_FIELDS):
+        self.logger = logger or logging.getLogger('alba_client.service')
+        self.sample_rates = dict(sample_rates or {})
+        self.default_rate = default_rate
+        self.max_body = max_body
+        self.fields = frozenset(fields)
+        self._random = random.random
+        self._endpoints = {}
+
+    def _endpoint(self, url):
+        endpoint = self._endpoints.get(url)
+        if endpoint is None:
+            if len(self._endpoints) > 1024:
+                self._endpoints.clear()
+            endpoint = self._endpoints[url] = urlparse(url).path.lstrip('/')
+        return endpoint
+
+    def sent(self, method, url, data):
+        """
+        Запись об отправке запроса; возвращает контекст для received
+        или None, если запрос не журналируется
+        """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return None
+        endpoint = self._endpoint(url)
+        rate = self.sample_rates.get(endpoint, self.default_rate)
+        if rate < 1 and self._random() >= rate:
+            return None
+        params = _Params(data, self.fields)
+        context = {'endpoint': endpoint, 'method': method.upper(),
+                   'params': params}
+        self.logger.debug('Sent %s request to %s with params %s',
+                          context['method'], endpoint, params,
+                          extra={'alba': context})
+        return context
+
+    def received(self, context, status_code, content):
+        """
+        Запись об ответе на запрос, отмеченный sent
+        """
+        if context is None:
+            return
+        body = _Body(content, self.fields, self.max_body)
+        context = dict(context, status_code=status_code, body=body)
+        self.logger.debug('Server response %s from %s: %s', status_code,
+                          context['endpoint'], body, extra={'alba': context})
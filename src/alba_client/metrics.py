@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики и трассировка запросов AlbaService и нотификаций AlbaCallback.
+
+    metrics = Metrics()
+    service = AlbaService(<service-id>, '<service-secret>', hooks=[metrics])
+    callback = MyCallback([service], hooks=[metrics])
+    ...
+    metrics.prometheus()  # текст в формате Prometheus
+
+Хук - объект с методами request_started, request_finished,
+callback_started и callback_finished. Значение, которое вернул
+*_started, передаётся в *_finished того же хука. Без хуков сервис
+и AlbaCallback не создают событий и не замеряют время.
+"""
+from __future__ import unicode_literals
+
+import bisect
+import threading
+from collections import defaultdict
+
+from ._compat import text_type, urlparse
+from .deadline import clock
+from .exceptions import AlbaConnectionError, AlbaException, AlbaTimeoutError
+
+OK = 'ok'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CALLBACK_COMMANDS = frozenset(['process', 'success', 'recurrent_cancel',
+                               'refund'])
+
+
+def _form_size(data):
+    """
+    Размер параметров в байтах без учёта экранирования
+    """
+    if not data:
+        return 0
+    size = -1
+    for key, value in data.items():
+        if value is not None:
+            if not isinstance(value, bytes):
+                value = text_type(value)
+            size += len(key) + len(value) + 2
+    return max(size, 0)
+
+
+def error_code(error):
+    """
+    Код результата для метрик: ok, код из CODE2EXCEPTION,
+    timeout, connection или exception
+    """
+    if error is None:
+        return OK
+    if isinstance(error, AlbaTimeoutError):
+        return 'timeout'
+    if isinstance(error, AlbaConnectionError):
+        return 'connection'
+    if isinstance(error, AlbaException):
+        return error.code or 'unknown'
+    return 'exception'
+
+
+class RequestEvent(object):
+    """
+    Запрос к Alba
+    endpoint путь метода API, например alba/input/
+    sign_time время подписи, wire_time время ожидания ответа транспорта,
+      duration время от отправки до разбора ответа, в секундах
+    code результат, см. error_code
+    """
+    __slots__ = ('service_id', 'method', 'url', 'endpoint', 'started',
+                 'sign_time', 'wire_time', 'duration', 'bytes_sent',
+                 'bytes_received', 'status_code', 'error')
+
+    def __init__(self, service_id, method, url, endpoint, data,
+                 sign_time=None):
+        self.service_id = service_id
+        self.method = method
+        self.url = url
+        self.endpoint = endpoint
+        self.sign_time = sign_time or 0.0
+        self.wire_time = 0.0
+        self.duration = 0.0
+        self.bytes_sent = _form_size(data)
+        self.bytes_received = 0
+        self.status_code = None
+        self.error = None
+        self.started = clock()
+
+    def received(self, status_code, content):
+        self.wire_time = clock() - self.started
+        self.status_code = status_code
+        self.bytes_received = len(content)
+
+    @property
+    def code(self):
+        return error_code(self.error)
+
+
+class CallbackEvent(object):
+    """
+    Проверка и обработка нотификации AlbaCallback.
+    command - команда нотификации или other для неизвестных команд,
+    чтобы поддельные запросы не порождали новые серии метрик
+    """
+    __slots__ = ('service_id', 'command', 'tid', 'started', 'duration',
+                 'error')
+
+    def __init__(self, post):
+        command = post.get('command')
+        self.service_id = post.get('service_id')
+        self.command = command if command in CALLBACK_COMMANDS else 'other'
+        self.tid = post.get('tid')
+        self.started = clock()
+        self.duration = 0.0
+        self.error = None
+
+    @property
+    def code(self):
+        return error_code(self.error)
+
+
+class Hook(object):
+    """
+    Базовый класс хука, достаточно переопределить нужные методы
+    """
+
+    def request_started(self, event):
+        pass
+
+    def request_finished(self, event, token):
+        pass
+
+    def callback_started(self, event):
+        pass
+
+    def callback_finished(self, event, token):
+        pass
+
+
+class Hooks(object):
+    """
+    Набор хуков сервиса или AlbaCallback
+    """
+
+    def __init__(self, hooks):
+        self.hooks = tuple(hooks)
+        self._endpoints = {}
+
+    def _endpoint(self, url):
+        endpoint = self._endpoints.get(url)
+        if endpoint is None:
+            if len(self._endpoints) > 1024:
+                self._endpoints.clear()
+            endpoint = self._endpoints[url] = urlparse(url).path.lstrip('/')
+        return endpoint
+
+    def request(self, service_id, method, url, data, sign_time=None):
+        event = RequestEvent(service_id, method, url, self._endpoint(url),
+                             data, sign_time)
+        return event, [hook.request_started(event) for hook in self.hooks]
+
+    def request_finished(self, event, tokens):
+        event.duration = clock() - event.started
+        for hook, token in zip(self.hooks, tokens):
+            hook.request_finished(event, token)
+
+    def callback(self, post):
+        event = CallbackEvent(post)
+        return event, [hook.callback_started(event) for hook in self.hooks]
+
+    def callback_finished(self, event, tokens):
+        event.duration = clock() - event.started
+        for hook, token in zip(self.hooks, tokens):
+            hook.callback_finished(event, token)
+
+    def callback_rejected(self, event, error):
+        """
+        Нотификация, не прошедшая проверку
+        """
+        event.error = error
+        self.callback_finished(
+            event, [hook.callback_started(event) for hook in self.hooks])
+
+
+def as_hooks(hooks):
+    """
+    Hooks для непустого списка хуков, иначе None
+    """
+    return Hooks(hooks) if hooks else None
+
+
+class Histogram(object):
+    """
+    Гистограмма с накопительными корзинами, как в Prometheus
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items()))
+
+
+class Metrics(Hook):
+    """
+    Встроенные метрики:
+    гистограммы длительности запросов и обработки нотификаций,
+    счётчики запросов по endpoint и коду результата, байты отправленные
+    и полученные, суммарное время подписи и ожидания ответа
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='alba'):
+        self.buckets = buckets
+        self.prefix = prefix
+        self.latency = defaultdict(lambda: Histogram(self.buckets))
+        self.requests = defaultdict(int)
+        self.bytes_sent = defaultdict(int)
+        self.bytes_received = defaultdict(int)
+        self.sign_seconds = defaultdict(float)
+        self.wire_seconds = defaultdict(float)
+        self.callback_latency = defaultdict(lambda: Histogram(self.buckets))
+        self.callbacks = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def request_finished(self, event, token):
+        endpoint = event.endpoint
+        with self._lock:
+            self.latency[endpoint].observe(event.duration)
+            self.requests[endpoint, event.code] += 1
+            self.bytes_sent[endpoint] += event.bytes_sent
+            self.bytes_received[endpoint] += event.bytes_received
+            self.sign_seconds[endpoint] += event.sign_time
+            self.wire_seconds[endpoint] += event.wire_time
+
+    def callback_finished(self, event, token):
+        with self._lock:
+            self.callback_latency[event.command].observe(event.duration)
+            self.callbacks[event.command, event.code] += 1
+
+    def prometheus(self):
+        """
+        Метрики в текстовом формате Prometheus
+        """
+        with self._lock:
+            lines = []
+            self._histogram(lines, 'request_duration_seconds',
+                            'Длительность запросов к Alba', 'endpoint',
+                            self.latency)
+            self._counter(lines, 'requests_total', 'Запросы к Alba',
+                          ('endpoint', 'code'), self.requests)
+            self._counter(lines, 'request_bytes_sent_total',
+                          'Отправлено байт', ('endpoint',), self.bytes_sent)
+            self._counter(lines, 'request_bytes_received_total',
+                          'Получено байт', ('endpoint',),
+                          self.bytes_received)
+            self._counter(lines, 'request_sign_seconds_total',
+                          'Время подписи запросов', ('endpoint',),
+                          self.sign_seconds)
+            self._counter(lines, 'request_wire_seconds_total',
+                          'Время ожидания ответа', ('endpoint',),
+                          self.wire_seconds)
+            self._histogram(lines, 'callback_duration_seconds',
+                            'Длительность обработки нотификаций', 'command',
+                            self.callback_latency)
+            self._counter(lines, 'callbacks_total', 'Нотификации',
+                          ('command', 'code'), self.callbacks)
+        return '\n'.join(lines) + '\n'
+
+    def _counter(self, lines, name, description, label_names, values):
+        name = '{}_{}'.format(self.prefix, name)
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} counter'.format(name))
+        for key, value in sorted(values.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            lines.append('{}{{{}}} {}'.format(
+                name, _labels(**dict(zip(label_names, key))), value))
+
+    def _histogram(self, lines, name, description, label_name,
+                   histograms):
+        name = '{}_{}'.format(self.prefix, name)
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} histogram'.format(name))
+        for key, histogram in sorted(histograms.items()):
+            for bound, count in histogram.cumulative():
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    name, _labels(le=bound, **{label_name: key}), count))
+            lines.append('{}_bucket{{{}}} {}'.format(
+                name, _labels(le='+Inf', **{label_name: key}),
+                histogram.count))
+            labels = _labels(**{label_name: key})
+            lines.append('{}_sum{{{}}} {}'.format(name, labels,
+                                                  histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, labels,
+                                                    histogram.count))
+
+
+class TracingHook(Hook):
+    """
+    Спаны трассировки для запросов и нотификаций.
+
+    tracer объект с методом start_span(name, attributes=None),
+      например трассировщик OpenTelemetry; по умолчанию берётся
+      opentelemetry.trace.get_tracer, если пакет установлен
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer('alba_client')
+        self.tracer = tracer
+
+    def request_started(self, event):
+        return self.tracer.start_span('alba ' + event.endpoint, attributes={
+            'http.method': event.method.upper(),
+            'http.url': event.url.split('?', 1)[0],
+            'alba.service_id': str(event.service_id),
+        })
+
+    def request_finished(self, event, span):
+        span.set_attribute('alba.code', event.code)
+        span.set_attribute('alba.sign_time', event.sign_time)
+        span.set_attribute('alba.wire_time', event.wire_time)
+        if event.status_code is not None:
+            span.set_attribute('http.status_code', event.status_code)
+        if event.error is not None:
+            span.record_exception(event.error)
+        span.end()
+
+    def callback_started(self, event):
+        return self.tracer.start_span(
+            'alba callback {}'.format(event.command), attributes={
+                'alba.service_id': str(event.service_id),
+                'alba.tid': str(event.tid),
+            })
+
+    def callback_finished(self, event, span):
+        span.set_attribute('alba.code', event.code)
+        if event.error is not None:
+            span.record_exception(event.error)
+        span.end()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Компактные типизированные результаты методов AlbaService.
+
+Известные поля хранятся в __slots__, остальные - в небольшом словаре,
+суммы преобразуются в Decimal только при обращении. Исходный словарь
+ответа доступен через raw.
+"""
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from ._compat import text_type
+
+_MISSING = object()
+_ABSENT = object()
+
+
+def _decimal(value):
+    if value is None or value == '':
+        return None
+    return Decimal(text_type(value))
+
+
+class AlbaResult(object):
+    """
+    Базовый класс результатов; поддерживает чтение как словаря:
+    result['tid'], result.get('tid'), 'tid' in result
+    """
+    __slots__ = ('_extra',)
+    FIELDS = ()
+    DECIMAL_FIELDS = ()
+
+    def __init__(self, data):
+        extra = None
+        for key, value in data.items():
+            if key in self._field_set:
+                setattr(self, '_' + key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self._extra = extra
+
+    def _value(self, key, default=_MISSING):
+        if key in self._field_set:
+            value = getattr(self, '_' + key, _MISSING)
+        elif self._extra is not None:
+            value = self._extra.get(key, _MISSING)
+        else:
+            value = _MISSING
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return value
+
+    @property
+    def raw(self):
+        """
+        Исходный словарь ответа
+        """
+        data = {}
+        for field in self.FIELDS:
+            value = getattr(self, '_' + field, _MISSING)
+            if value is not _MISSING:
+                data[field] = value
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def __getitem__(self, key):
+        return self._value(key)
+
+    def __contains__(self, key):
+        return self._value(key, _ABSENT) is not _ABSENT
+
+    def get(self, key, default=None):
+        return self._value(key, default)
+
+    def __eq__(self, other):
+        if isinstance(other, AlbaResult):
+            other = other.raw
+        return self.raw == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.raw)
+
+
+def _field_property(name, decimal):
+    slot = '_' + name
+
+    def getter(self):
+        value = getattr(self, slot, None)
+        return _decimal(value) if decimal else value
+
+    return property(getter)
+
+
+def _result_class(name, fields, decimal_fields=(), doc=None):
+    namespace = {
+        '__slots__': tuple('_' + field for field in fields),
+        '__doc__': doc,
+        'FIELDS': tuple(fields),
+        'DECIMAL_FIELDS': tuple(decimal_fields),
+        '_field_set': frozenset(fields),
+    }
+    for field in fields:
+        namespace[field] = _field_property(field, field in decimal_fields)
+    return type(str(name), (AlbaResult,), namespace)
+
+
+Transaction = _result_class(
+    'Transaction',
+    ['status', 'tid', 'order_id', 'service_id', 'partner_id',
+     'transaction_status', 'type', 'name', 'comment', 'cost',
+     'income_total', 'income', 'partner_income', 'system_income',
+     'amount', 'phone_number', 'email', 'date_created'],
+    decimal_fields=['cost', 'income_total', 'income', 'partner_income',
+                    'system_income', 'amount'],
+    doc='Результат transaction_details')
+
+PayType = _result_class(
+    'PayType', ['type', 'name'],
+    doc='Способ оплаты из pay_types')
+
+GateDetails = _result_class(
+    'GateDetails', ['status', 'name', 'init_payment', 'percent'],
+    decimal_fields=['percent'],
+    doc='Результат gate_details')
+
+CardToken = _result_class(
+    'CardToken', ['status', 'token'],
+    doc='Результат create_card_token')
+
+
+def pay_types(types):
+    """
+    Оборачивает список способов оплаты; строки остаются как есть
+    """
+    return [PayType(item) if isinstance(item, dict) else item
+            for item in types]
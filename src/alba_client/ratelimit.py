@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from six import text_type
+
+from .exceptions import AlbaRateLimitError
+
+clock = getattr(time, 'monotonic', time.time)
+
+BLOCK = 'block'
+FAIL = 'fail'
+
+
+class TokenBucket(object):
+    """
+    Потокобезопасное ведро токенов
+
+    rate скорость пополнения, токенов в секунду
+    capacity ёмкость ведра (допустимый всплеск), по умолчанию равна rate
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1, max_wait=None):
+        """
+        Резервирует tokens токенов и возвращает, сколько секунд нужно
+        подождать до их появления, или None, если ждать пришлось бы
+        дольше max_wait (в этом случае ничего не резервируется)
+        """
+        with self._lock:
+            now = clock()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (tokens - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= tokens
+            return wait
+
+    def cancel(self, tokens=1):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+
+class RateLimiterStats(object):
+    """
+    Статистика ожидания: acquired - выданные разрешения, waited - сколько
+    из них пришлось ждать, rejected - отказы, wait_time и max_wait -
+    суммарное и максимальное ожидание в секундах
+    """
+    __slots__ = ('acquired', 'waited', 'rejected', 'wait_time', 'max_wait')
+
+    def __init__(self):
+        self.acquired = 0
+        self.waited = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class RateLimiter(object):
+    """
+    Ограничение частоты запросов к Alba, общее для потоков, корутин
+    и нескольких AlbaService.
+
+    global_rate общий лимит запросов в секунду, None - без ограничения
+    service_rates лимиты для отдельных service_id {service_id: rate}
+    default_service_rate лимит для остальных service_id
+    weights вес запроса к методу API, например {'alba/input/': 2},
+      по умолчанию 1
+    burst во сколько секунд лимита укладывается допустимый всплеск
+    policy BLOCK - ждать разрешения, FAIL - сразу поднимать
+      AlbaRateLimitError
+    max_wait сколько секунд можно ждать разрешения в режиме BLOCK
+    """
+
+    def __init__(self, global_rate=None, service_rates=None,
+                 default_service_rate=None, weights=None, burst=1,
+                 policy=BLOCK, max_wait=None):
+        self.burst = burst
+        self.global_bucket = self._bucket(global_rate)
+        self.service_buckets = {
+            text_type(service_id): self._bucket(rate)
+            for service_id, rate in (service_rates or {}).items()
+        }
+        self.default_service_rate = default_service_rate
+        self.weights = weights or {}
+        self.policy = policy
+        self.max_wait = max_wait
+        self.stats = RateLimiterStats()
+        self._lock = threading.Lock()
+
+    def _bucket(self, rate):
+        if rate is None:
+            return None
+        return TokenBucket(rate, rate * self.burst)
+
+    def _service_bucket(self, service_id):
+        service_id = text_type(service_id)
+        bucket = self.service_buckets.get(service_id)
+        if bucket is None and self.default_service_rate is not None:
+            with self._lock:
+                bucket = self.service_buckets.setdefault(
+                    service_id, self._bucket(self.default_service_rate))
+        return bucket
+
+    def _reserve(self, service_id, endpoint, max_wait):
+        weight = self.weights.get(endpoint, 1)
+        if self.policy == FAIL:
+            max_wait = 0
+        elif self.max_wait is not None:
+            max_wait = (self.max_wait if max_wait is None
+                        else min(max_wait, self.max_wait))
+        buckets = [bucket for bucket in (self.global_bucket,
+                                         self._service_bucket(service_id))
+                   if bucket is not None]
+        reserved = []
+        wait = 0.0
+        for bucket in buckets:
+            bucket_wait = bucket.reserve(weight, max_wait)
+            if bucket_wait is None:
+                for other in reserved:
+                    other.cancel(weight)
+                with self._lock:
+                    self.stats.rejected += 1
+                raise AlbaRateLimitError(
+                    'Превышен лимит запросов: {} {}'.format(
+                        service_id, endpoint))
+            reserved.append(bucket)
+            wait = max(wait, bucket_wait)
+        with self._lock:
+            self.stats.acquired += 1
+            if wait > 0:
+                self.stats.waited += 1
+                self.stats.wait_time += wait
+                self.stats.max_wait = max(self.stats.max_wait, wait)
+        return wait
+
+    def acquire(self, service_id, endpoint, max_wait=None):
+        """
+        Получение разрешения на запрос, при необходимости поток ждёт
+        max_wait сколько секунд можно ждать, например остаток deadline.
+        В asyncio используется alba_client.aio.acquire_async
+        """
+        wait = self._reserve(service_id, endpoint, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def as_rate_limiter(rate):
+    """
+    RateLimiter из числа запросов в секунду; готовый RateLimiter
+    и None возвращаются как есть
+    """
+    if rate and not isinstance(rate, RateLimiter):
+        return RateLimiter(global_rate=rate)
+    return rate or None
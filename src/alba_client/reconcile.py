@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Потоковая сверка собственного реестра платежей с Alba.
+
+    python -m alba_client.reconcile --service-id 10000 \
+        --ledger ledger.csv --mismatches mismatches.jsonl
+
+Реестр - CSV с заголовком или JSONL; по умолчанию строка содержит
+order_id, cost, income и status. Расхождения записываются по мере
+обнаружения, память не зависит от размера реестра.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from six import text_type
+
+from .batch import run_concurrently
+from .journal import RecordWriter, read_records
+
+DEFAULT_FIELDS = {
+    'cost': 'cost',
+    'income': 'income_total',
+    'status': 'transaction_status',
+}
+AMOUNT_FIELDS = ('cost', 'income')
+
+Mismatch = namedtuple('Mismatch', ['row', 'differences', 'error'])
+Mismatch.__doc__ = """
+Расхождение по одной строке реестра
+row строка реестра
+differences {поле: (значение в реестре, значение в Alba)}
+error исключение, если получить транзакцию из Alba не удалось
+"""
+
+
+def _amount(value):
+    try:
+        return Decimal(text_type(value))
+    except (InvalidOperation, ValueError):
+        return value
+
+
+class ReconcileStats(object):
+    """
+    Счётчики сверки и её скорость
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.matched = 0
+        self.mismatched = 0
+        self.errors = 0
+        self.started = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'matched': self.matched,
+            'mismatched': self.mismatched,
+            'errors': self.errors,
+            'elapsed': round(self.elapsed, 3),
+            'rows_per_second': round(self.rows_per_second, 1),
+        }
+
+
+class Reconciler(object):
+    """
+    Сверка строк реестра с transaction_details.
+
+    service AlbaService, через который запрашиваются транзакции
+    key поле строки, по которому ищется транзакция: order_id или tid
+    fields соответствие полей реестра полям ответа Alba; поля cost
+      и income сравниваются как Decimal
+    max_workers число одновременных запросов
+    deadline сколько секунд отведено на каждый запрос
+    """
+
+    def __init__(self, service, key='order_id', fields=None, max_workers=10,
+                 deadline=None):
+        self.service = service
+        self.key = key
+        self.fields = fields or DEFAULT_FIELDS
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.stats = ReconcileStats()
+
+    def _fetch(self, row):
+        return self.service.transaction_details(
+            deadline=self.deadline, **{self.key: row[self.key]})
+
+    def compare(self, row, details):
+        """
+        Различия между строкой реестра и ответом Alba
+        """
+        differences = {}
+        for field, remote_field in self.fields.items():
+            if field not in row:
+                continue
+            ours, theirs = row[field], details.get(remote_field)
+            if field in AMOUNT_FIELDS:
+                equal = _amount(ours) == _amount(theirs)
+            else:
+                equal = text_type(ours) == text_type(theirs)
+            if not equal:
+                differences[field] = (ours, theirs)
+        return differences
+
+    def run(self, rows):
+        """
+        Генератор Mismatch для строк, не совпавших с Alba
+        """
+        self.stats = stats = ReconcileStats()
+        for result in run_concurrently(self._fetch, rows, self.max_workers):
+            stats.rows += 1
+            if result.error is not None:
+                stats.errors += 1
+                yield Mismatch(result.item, {}, result.error)
+                continue
+            differences = self.compare(result.item, result.result)
+            if differences:
+                stats.mismatched += 1
+                yield Mismatch(result.item, differences, None)
+            else:
+                stats.matched += 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Сверка реестра с Alba')
+    parser.add_argument('--service-id', required=True)
+    parser.add_argument('--secret', default=os.environ.get('ALBA_SECRET'))
+    parser.add_argument('--ledger', required=True,
+                        help='CSV или JSONL файл реестра')
+    parser.add_argument('--mismatches', required=True,
+                        help='CSV или JSONL файл для расхождений')
+    parser.add_argument('--key', default='order_id',
+                        choices=['order_id', 'tid'])
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--deadline', type=float, default=None)
+    args = parser.parse_args(argv)
+    if not args.secret:
+        parser.error('нужен --secret или переменная окружения ALBA_SECRET')
+
+    from .connection import ConnectionPool
+    from .service import AlbaService
+
+    service = AlbaService(args.service_id, args.secret,
+                          pool=ConnectionPool(pool_size=args.workers))
+    reconciler = Reconciler(service, key=args.key,
+                            max_workers=args.workers,
+                            deadline=args.deadline)
+    with RecordWriter(args.mismatches,
+                      [args.key, 'differences', 'error']) as writer:
+        for mismatch in reconciler.run(read_records(args.ledger)):
+            writer.write({
+                args.key: mismatch.row.get(args.key),
+                'differences': {
+                    field: [text_type(ours), text_type(theirs)]
+                    for field, (ours, theirs)
+                    in mismatch.differences.items()},
+                'error': (text_type(mismatch.error)
+                          if mismatch.error is not None else None),
+            })
+    print(reconciler.stats.as_dict())
+    return 1 if reconciler.stats.mismatched or reconciler.stats.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
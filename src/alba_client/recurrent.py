@@ -1,7 +1,10 @@
 # coding=utf-8
 from __future__ import unicode_literals
 
-from .exceptions import AlbaException, MissArgumentError
+from collections import Counter, namedtuple
+
+from .batch import run_concurrently
+from .exceptions import AlbaException, MissArgumentError, UniqueError
 
 
 class RecurrentParams(object):
@@ -29,3 +32,114 @@ class RecurrentParams(object):
     @classmethod
     def next_pay(cls, order_id):
         return cls(cls.NEXT, None, None, order_id, None)
+
+
+ChargeResult = namedtuple(
+    'ChargeResult', ['subscription', 'action', 'result', 'error'])
+ChargeResult.__doc__ = """
+Результат обработки одной подписки
+action CHARGE или CANCEL
+result ответ Alba или None при ошибке
+"""
+
+CHARGE = 'charge'
+CANCEL = 'cancel'
+UNIQUE = 'unique'
+SKIPPED = 'skipped'
+
+
+class RecurrentScheduler(object):
+    """
+    Проведение очередных рекуррентных платежей для потока подписок.
+
+    Подписка - словарь с полями recurrent_order_id (order_id первого
+    платежа), pay_type, cost, name, email, phone; остальные поля
+    передаются в init_payment. Подписки с cancelled отменяются через
+    cancel_recurrent_payment. Ключ подписки в журнале - поле id, а при
+    его отсутствии recurrent_order_id.
+
+    У каждой подписки должен быть order_id, свой для каждого периода
+    списания (например, id подписки и месяц): если запрос прервался по
+    таймауту, повторный прогон получит от Alba UniqueError вместо
+    второго списания. Такие подписки считаются обработанными
+    и записываются в журнал.
+
+    service AlbaService
+    journal Journal обработанных подписок для продолжения прерванного
+      прогона, None - без журнала
+    max_workers число одновременных запросов
+    rate ограничение числа запросов в секунду или RateLimiter
+    deadline сколько секунд отведено на каждый запрос
+    """
+    REQUIRED = ('pay_type', 'cost', 'name', 'email', 'phone')
+
+    def __init__(self, service, journal=None, max_workers=10, rate=None,
+                 deadline=None):
+        self.service = service
+        self.journal = journal
+        self.max_workers = max_workers
+        if rate is not None:
+            from .ratelimit import as_rate_limiter
+            rate = as_rate_limiter(rate)
+        self.rate_limiter = rate
+        self.deadline = deadline
+        self.stats = Counter()
+
+    @staticmethod
+    def key(subscription):
+        return subscription.get('id', subscription['recurrent_order_id'])
+
+    @staticmethod
+    def action(subscription):
+        return CANCEL if subscription.get('cancelled') else CHARGE
+
+    def _acquire(self, endpoint):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.service.service_id, endpoint)
+
+    def _process(self, subscription):
+        order_id = subscription['recurrent_order_id']
+        if self.action(subscription) == CANCEL:
+            self._acquire('alba/recurrent_change/')
+            return self.service.cancel_recurrent_payment(
+                order_id, deadline=self.deadline)
+        kwargs = {key: value for key, value in subscription.items()
+                  if key not in self.REQUIRED and
+                  key not in ('id', 'recurrent_order_id', 'cancelled')}
+        self._acquire('alba/input/')
+        return self.service.init_payment(
+            *[subscription[field] for field in self.REQUIRED],
+            recurrent_params=RecurrentParams.next_pay(order_id),
+            deadline=self.deadline, **kwargs)
+
+    def run(self, subscriptions):
+        """
+        Генератор ChargeResult в порядке готовности; успешно обработанные
+        подписки и подписки с ошибкой unique записываются в журнал,
+        статистика - в stats
+        """
+        self.stats = stats = Counter()
+
+        def pending():
+            for subscription in subscriptions:
+                if (self.journal is not None and
+                        self.key(subscription) in self.journal):
+                    stats[SKIPPED] += 1
+                else:
+                    yield subscription
+
+        for result in run_concurrently(self._process, pending(),
+                                       self.max_workers):
+            action = self.action(result.item)
+            if result.error is None:
+                status = action
+            elif isinstance(result.error, UniqueError):
+                # платёж уже проведён предыдущим прогоном
+                status = UNIQUE
+            else:
+                status = 'error'
+            stats[status] += 1
+            if status != 'error' and self.journal is not None:
+                self.journal.add(self.key(result.item))
+            yield ChargeResult(result.item, action, result.result,
+                               result.error)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Пакетное проведение возвратов с возобновлением после сбоя.
+
+    python -m alba_client.refunds --service-id 10000 \
+        --jobs refunds.csv --journal refunds.journal --results results.jsonl
+
+Файл заданий - CSV с заголовком или JSONL с полями tid, amount, reason,
+test. Проведённые возвраты записываются в журнал, при повторном запуске
+они пропускаются. Повтор tid в файле заданий не проводится и попадает
+в результаты со статусом duplicate. Секретный ключ берётся из --secret
+или переменной окружения ALBA_SECRET.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+from six import text_type
+
+from .batch import run_concurrently
+from .exceptions import AuthError, UniqueError
+from .journal import Journal, RecordWriter, read_records
+from .ratelimit import as_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+OK = 'ok'
+UNIQUE = 'unique'
+AUTH = 'auth'
+ERROR = 'error'
+SKIPPED = 'skipped'
+DUPLICATE = 'duplicate'
+
+RESULT_FIELDS = ['tid', 'status', 'payback_id', 'error']
+
+
+def _flag(value):
+    return text_type(value).lower() in ('1', 'true', 'yes')
+
+
+def classify(error):
+    """
+    Статус результата по исключению
+    """
+    if error is None:
+        return OK
+    if isinstance(error, UniqueError):
+        return UNIQUE
+    if isinstance(error, AuthError):
+        return AUTH
+    return ERROR
+
+
+class BulkRefundRunner(object):
+    """
+    Параллельное проведение возвратов из потока заданий.
+
+    service AlbaService, через который проводятся возвраты
+    journal Journal с tid проведённых возвратов; возвраты с ошибкой
+      unique тоже считаются проведёнными, остальные ошибки
+      повторяются при следующем запуске
+    max_workers число одновременных запросов
+    rate ограничение числа запросов в секунду или готовый RateLimiter
+    deadline сколько секунд отведено на каждый возврат
+    """
+
+    def __init__(self, service, journal, max_workers=10, rate=None,
+                 deadline=None):
+        self.service = service
+        self.journal = journal
+        self.max_workers = max_workers
+        self.rate_limiter = as_rate_limiter(rate)
+        self.deadline = deadline
+
+    def _refund(self, job):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.service.service_id, 'alba/refund/')
+        return self.service.refund(
+            job['tid'], amount=job.get('amount') or None,
+            test=_flag(job.get('test')), reason=job.get('reason') or None,
+            deadline=self.deadline)
+
+    def run(self, jobs, writer=None):
+        """
+        Проводит возвраты, результаты по каждому tid передаются
+        в writer.write(); возвращает Counter со статусами.
+        Журнал ведётся по tid, поэтому повторные задания с тем же tid
+        не проводятся (статус DUPLICATE)
+        """
+        stats = Counter()
+        queued = set()
+
+        def pending():
+            for job in jobs:
+                tid = text_type(job['tid'])
+                if tid in queued:
+                    stats[DUPLICATE] += 1
+                    logger.warning('Duplicate refund job for tid %s', tid)
+                    if writer is not None:
+                        writer.write({
+                            'tid': job['tid'], 'status': DUPLICATE,
+                            'payback_id': None,
+                            'error': 'Duplicate tid in jobs'})
+                elif tid in self.journal:
+                    queued.add(tid)
+                    stats[SKIPPED] += 1
+                else:
+                    queued.add(tid)
+                    yield job
+
+        for result in run_concurrently(self._refund, pending(),
+                                       self.max_workers):
+            tid = result.item['tid']
+            status = classify(result.error)
+            if status in (OK, UNIQUE):
+                self.journal.add(tid)
+            stats[status] += 1
+            if writer is not None:
+                writer.write({
+                    'tid': tid,
+                    'status': status,
+                    'payback_id': (result.result or {}).get('payback_id'),
+                    'error': (text_type(result.error)
+                              if result.error is not None else None),
+                })
+        return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Пакетное проведение возвратов Alba')
+    parser.add_argument('--service-id', required=True)
+    parser.add_argument('--secret', default=os.environ.get('ALBA_SECRET'))
+    parser.add_argument('--jobs', required=True,
+                        help='CSV или JSONL файл с заданиями')
+    parser.add_argument('--journal', required=True,
+                        help='журнал проведённых возвратов')
+    parser.add_argument('--results', required=True,
+                        help='CSV или JSONL файл с результатами')
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=None,
+                        help='максимум запросов в секунду')
+    parser.add_argument('--deadline', type=float, default=None)
+    args = parser.parse_args(argv)
+    if not args.secret:
+        parser.error('нужен --secret или переменная окружения ALBA_SECRET')
+
+    from .service import AlbaService
+    from .connection import ConnectionPool
+
+    logging.basicConfig(level=logging.INFO)
+    service = AlbaService(args.service_id, args.secret,
+                          pool=ConnectionPool(pool_size=args.workers))
+    started = time.time()
+    with Journal(args.journal) as journal, \
+            RecordWriter(args.results, RESULT_FIELDS) as writer:
+        runner = BulkRefundRunner(service, journal, max_workers=args.workers,
+                                  rate=args.rate, deadline=args.deadline)
+        stats = runner.run(read_records(args.jobs), writer)
+    elapsed = time.time() - started
+    print(', '.join('{}: {}'.format(status, count)
+                    for status, count in sorted(stats.items())))
+    print('{:.1f} s'.format(elapsed))
+    return 1 if stats[AUTH] or stats[ERROR] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from ._compat import text_type
+
+from .cache import FRESH, TTLCache
+from .singleflight import SingleFlight
+
+
+class ServiceRegistry(object):
+    """
+    Ленивая загрузка сервисов для AlbaCallback.
+
+    Сервис загружается функцией loader(service_id) при первой нотификации
+    и хранится в LRU-кеше не дольше ttl секунд, после чего загружается
+    заново (например, чтобы подхватить новый секретный ключ).
+    Одновременные запросы одного и того же service_id объединяются
+    в одну загрузку.
+
+    loader функция, возвращающая AlbaService или None для
+      неизвестного service_id
+    maxsize максимальное число сервисов в кеше
+    ttl время жизни сервиса в кеше в секундах
+    negative_ttl сколько секунд помнить, что service_id неизвестен,
+      чтобы нотификации с чужими service_id не загружали loader;
+      None - не запоминать
+    """
+
+    def __init__(self, loader, maxsize=1024, ttl=300, negative_ttl=30):
+        self.loader = loader
+        self.cache = TTLCache(ttl, maxsize=maxsize)
+        self.unknown = (TTLCache(negative_ttl, maxsize=maxsize)
+                        if negative_ttl is not None else None)
+        self.flight = SingleFlight()
+
+    def _load(self, service_id):
+        service = self.loader(service_id)
+        if service is not None:
+            self.cache.set(service_id, service)
+        elif self.unknown is not None:
+            self.unknown.set(service_id, True)
+        return service
+
+    def get(self, service_id):
+        """
+        Сервис по service_id или None, если он неизвестен
+        """
+        service_id = text_type(service_id)
+        service, state = self.cache.lookup(service_id)
+        if state == FRESH:
+            return service
+        if (self.unknown is not None
+                and self.unknown.lookup(service_id)[1] == FRESH):
+            return None
+        return self.flight.do(service_id, lambda: self._load(service_id))
+
+    def invalidate(self, service_id=None):
+        if service_id is not None:
+            service_id = text_type(service_id)
+        self.cache.invalidate(service_id)
+        if self.unknown is not None:
+            self.unknown.invalidate(service_id)
@@ -2,14 +2,20 @@
 from __future__ import unicode_literals
 
 import logging
-import requests
 import hashlib
 import json
 
 from six import text_type
 
-from .exceptions import CODE2EXCEPTION, MissArgumentError, AlbaException
-from .sign import sign
+from .batch import run_concurrently
+from .deadline import Deadline, clock, effective_timeout
+from .exceptions import (
+    CODE2EXCEPTION, AlbaConnectionError, AlbaException, MissArgumentError)
+from .log import RequestLogger
+from .metrics import as_hooks
+from .models import CardToken, GateDetails, Transaction, pay_types
+from .sign import Signer, check_callback_sign
+from .transport import RequestsTransport
 
 
 class AlbaService(object):
@@ -24,15 +30,59 @@ class AlbaService(object):
         'card_token_test_url': 'https://test.rficb.ru/cardtoken/'
     }
 
+    DEFAULT_TIMEOUT = (5, 30)
+
     def __init__(self, service_id, secret, connection_profile=None,
-                 logger=None):
+                 logger=None, pool=None, cache=None, failover=None,
+                 timeout=DEFAULT_TIMEOUT, endpoint_timeouts=None,
+                 rate_limiter=None, typed=False, transport=None,
+                 singleflight=None, hooks=(), request_logger=None,
+                 transaction_cache=None):
         """
         service_id идентификатор сервиса
         secret секретный ключ сервиса
+        pool пул соединений ConnectionPool, может быть общим для
+          нескольких сервисов; по умолчанию создаётся собственный
+        cache кеш MetadataCache для pay_types и gate_details,
+          по умолчанию не используется
+        failover Failover для работы с несколькими профилями подключения,
+          в этом режиме connection_profile - первый профиль failover
+        timeout таймаут запросов в секундах: число или пара
+          (connect, read), None - без ограничения
+        endpoint_timeouts таймауты для отдельных методов API, например
+          {'alba/details/': (2, 10)}
+        rate_limiter RateLimiter, может быть общим для нескольких сервисов
+        transport транспорт из alba_client.transport, через который
+          отправляются запросы; по умолчанию RequestsTransport поверх pool
+        singleflight SingleFlight для объединения одновременных одинаковых
+          вызовов transaction_details, pay_types и gate_details в один
+          запрос; присоединившиеся вызовы получают результат и deadline
+          первого. Может быть общим для нескольких сервисов
+        hooks хуки запросов из alba_client.metrics, например Metrics()
+          или TracingHook()
+        request_logger RequestLogger из alba_client.log с выборочным
+          журналированием запросов; по умолчанию журналируются все
+          запросы в logger на уровне DEBUG
+        transaction_cache TransactionCache из alba_client.cache, в котором
+          transaction_details хранит транзакции в окончательном статусе;
+          по умолчанию не используется
+        typed возвращать ли результаты transaction_details, pay_types,
+          gate_details и create_card_token объектами из alba_client.models
+          вместо словарей
         """
         self.service_id = service_id
         self.secret = secret
-        if not connection_profile:
+        self._signers = {}
+        self.failover = failover
+        self.timeout = timeout
+        self.endpoint_timeouts = endpoint_timeouts or {}
+        self.rate_limiter = rate_limiter
+        self.typed = typed
+        self.singleflight = singleflight
+        self.hooks = as_hooks(hooks)
+        if failover is not None:
+            self.connection_profile = failover.profiles[0]
+        elif not connection_profile:
             self.connection_profile = self.FIRST_CONNECTION_PROFILE
         else:
             self.connection_profile = connection_profile
@@ -40,59 +90,175 @@ class AlbaService(object):
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
+        self.request_logger = request_logger or RequestLogger(self.logger)
+        if transport is None:
+            transport = RequestsTransport(pool)
+        self.transport = transport
+        self.pool = getattr(transport, 'pool', pool)
+        self.cache = cache
+        self.transaction_cache = transaction_cache
+
+    @property
+    def connection_profile(self):
+        return self._connection_profile
+
+    @connection_profile.setter
+    def connection_profile(self, value):
+        self._connection_profile = value
+        self._urls = {}
+
+    def _url(self, path, key='base_url'):
+        url = self._urls.get((key, path))
+        if url is None:
+            url = self._urls[(key, path)] = self.connection_profile[key] + path
+        return url
+
+    def _sign(self, method, url, params):
+        cache_key = (method, url, self.secret)
+        signer = self._signers.get(cache_key)
+        if signer is None:
+            signer = self._signers[cache_key] = Signer(
+                method, url, self.secret)
+        return signer(params)
+
+    def add_hook(self, hook):
+        """
+        Подключение хука запросов
+        """
+        self.hooks = as_hooks((self.hooks.hooks if self.hooks else ()) +
+                              (hook,))
+
+    def _request(self, url, method, data, timeout=None, sign_time=None):
+        log = self.request_logger.sent(method, url, data)
+        if self.hooks is None:
+            status_code, content = self.transport.request(
+                method, url, data, timeout=timeout)
+            self.request_logger.received(log, status_code, content)
+            return self._parse_response(status_code, content)
 
-    def _request(self, url, method, data):
+        event, tokens = self.hooks.request(
+            self.service_id, method, url, data, sign_time)
         try:
-            self.logger.debug('Sent {} request with params {}'
-                              .format(method.upper(), data))
-
-            if method == 'get':
-                response = requests.get(url, params=data)
-            else:
-                response = requests.post(url, data)
-
-            if response.status_code != 200:
-                self.logger.debug(u'Server unavailable: {}'
-                                  .format(response.status_code))
-                raise AlbaException('Сервер не доступен: {}'
-                                    .format(response.status_code))
-        except requests.ConnectionError as e:
-            raise AlbaException(e)
-
-        content = response.content.decode('utf-8')
-        self.logger.debug('Server response: {}'.format(content))
-
-        json_response = json.loads(content)
+            status_code, content = self.transport.request(
+                method, url, data, timeout=timeout)
+            self.request_logger.received(log, status_code, content)
+            event.received(status_code, content)
+            return self._parse_response(status_code, content)
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            self.hooks.request_finished(event, tokens)
+
+    def _parse_response(self, status_code, content):
+        if status_code != 200:
+            self.logger.debug('Server unavailable: %s', status_code)
+            raise AlbaConnectionError(
+                'Сервер не доступен: {}'.format(status_code))
+
+        json_response = json.loads(content.decode('utf-8'))
         if json_response['status'] == 'error':
             msg = json_response.get('msg', json_response.get('message'))
             code = json_response.get('code', 'unknown')
             errors = json_response.get('errors')
             raise CODE2EXCEPTION.get(code, AlbaException)(
-                msg, errors=errors)
+                msg, errors=errors, code=code)
 
         return json_response
 
+    def _result(self, wrap, data):
+        return wrap(data) if self.typed else data
+
+    def _coalesce(self, key, func, deadline=None):
+        if self.singleflight is None:
+            return func()
+        return self.singleflight.do((self.service_id,) + key, func,
+                                    timeout=deadline)
+
     def _get(self, url, data=None):
         return self._request(url, 'get', data)
 
     def _post(self, url, data=None):
         return self._request(url, 'post', data)
 
-    def pay_types(self):
+    def _send(self, method, url, fields, signed, timeout=None,
+              deadline=None):
+        timeout = effective_timeout(timeout, deadline)
+        sign_time = None
+        if signed:
+            fields = dict(fields)
+            started = clock() if self.hooks is not None else None
+            fields['check'] = self._sign(method.upper(), url, fields)
+            if started is not None:
+                sign_time = clock() - started
+        return self._request(url, method, fields, timeout=timeout,
+                             sign_time=sign_time)
+
+    @staticmethod
+    def _endpoint(path):
+        return path.split('?', 1)[0]
+
+    def _max_wait(self, deadline):
+        return None if deadline is None else deadline.remaining()
+
+    def _call(self, method, path, fields=None, url_key='base_url',
+              signed=True, idempotent=False, hedge=False, deadline=None):
         """
-        Получение списка доступных способов оплаты для сервиса
+        Выполнение запроса к path относительно адреса url_key профиля
+        signed подписывать ли fields параметром check
+        idempotent можно ли повторять запрос при ошибке соединения
+        hedge можно ли дублировать запрос на резервный адрес
+        deadline сколько секунд отведено на вызов вместе с повторами
         """
+        endpoint = self._endpoint(path)
+        timeout = self.endpoint_timeouts.get(endpoint, self.timeout)
+        deadline = Deadline.start(deadline)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.service_id, endpoint,
+                                      self._max_wait(deadline))
+        if self.failover is None:
+            return self._send(method, self._url(path, url_key), fields,
+                              signed, timeout, deadline)
+        return self.failover.call(
+            lambda base: self._send(method, base + path, fields, signed,
+                                    timeout, deadline),
+            url_key, idempotent=idempotent, hedge=hedge, deadline=deadline)
+
+    def _pay_types_path(self):
         check = hashlib.md5(
             (text_type(self.service_id) + self.secret).encode('utf-8'))
         check = check.hexdigest()
-        url = ("%salba/pay_types/?service_id=%s&check=%s" %
-               (self.connection_profile['base_url'], self.service_id, check))
-        return self._get(url)['types']
+        return ("alba/pay_types/?service_id=%s&check=%s" %
+                (self.service_id, check))
+
+    def _pay_types_url(self):
+        return self._url(self._pay_types_path())
+
+    def _load_pay_types(self, deadline=None):
+        return self._call('get', self._pay_types_path(), signed=False,
+                          idempotent=True, deadline=deadline)['types']
+
+    def pay_types(self, deadline=None):
+        """
+        Получение списка доступных способов оплаты для сервиса
+        deadline сколько секунд отведено на вызов
+        """
+        def load():
+            return self._coalesce(('alba/pay_types/',),
+                                  lambda: self._load_pay_types(deadline),
+                                  deadline)
+
+        if self.cache is None:
+            types = load()
+        else:
+            types = self.cache.pay_types.get_or_load(
+                self._pay_types_key(), load)
+        return self._result(pay_types, types)
 
     def init_payment(self, pay_type, cost, name, email, phone,
                      order_id=None, comment=None, bank_params=None,
                      commission=None, card_token=None, recurrent_params=None,
-                     **kwargs):
+                     deadline=None, **kwargs):
         """
         Инициация оплаты
         pay_type способ оплаты
@@ -104,6 +270,7 @@ class AlbaService(object):
         bank_params параметры для перевода на реквизиты
         commission на ком лежит комиссия на абоненте или партнере
           допустимые значение: 'partner', 'abonent'
+        deadline сколько секунд отведено на вызов
         """
         fields = {
             "cost": cost,
@@ -131,16 +298,41 @@ class AlbaService(object):
 
         fields.update(kwargs)
 
-        url = self.connection_profile['base_url'] + "alba/input/"
-        fields['check'] = sign("POST", url, fields, self.secret)
-
-        return self._post(url, fields)
+        return self._call('post', 'alba/input/', fields, deadline=deadline)
 
-    def transaction_details(self, tid=None, order_id=None):
+    def transaction_details(self, tid=None, order_id=None, deadline=None):
         """
         Получение информации о транзакции
         tid идентификатор транзакции
+        deadline сколько секунд отведено на вызов вместе с повторами
         """
+        params = self._details_params(tid, order_id)
+        details = self._cached_details(params)
+        if details is None:
+            details = self._coalesce(
+                self._details_key(params),
+                lambda: self._call('post', 'alba/details/', params,
+                                   idempotent=True, deadline=deadline),
+                deadline)
+            self._store_details(params, details)
+        return self._result(Transaction, details)
+
+    @staticmethod
+    def _details_key(params):
+        return ('alba/details/', params.get('tid'), params.get('order_id'))
+
+    def _cached_details(self, params):
+        if self.transaction_cache is None:
+            return None
+        return self.transaction_cache.get(
+            self.service_id, params.get('tid'), params.get('order_id'))
+
+    def _store_details(self, params, details):
+        if self.transaction_cache is not None:
+            self.transaction_cache.set(self.service_id, details,
+                                       params.get('order_id'))
+
+    def _details_params(self, tid, order_id):
         if tid:
             params = {'tid': tid}
         elif order_id:
@@ -148,17 +340,37 @@ class AlbaService(object):
         else:
             raise MissArgumentError('Ожидается аргумент tid или order_id')
 
-        url = self.connection_profile['base_url'] + "alba/details/"
         params['version'] = '2.0'
-        params['check'] = sign("POST", url, params, self.secret)
-        answer = self._post(url, params)
-        return answer
+        return params
+
+    @staticmethod
+    def _details_items(tids, order_ids):
+        for tid in tids or ():
+            yield {'tid': tid}
+        for order_id in order_ids or ():
+            yield {'order_id': order_id}
+
+    def transaction_details_batch(self, tids=None, order_ids=None,
+                                  max_workers=10, deadline=None):
+        """
+        Пакетное получение информации о транзакциях
+        tids, order_ids итерируемые идентификаторы транзакций и заказов
+        max_workers число одновременных запросов, для переиспользования
+          соединений стоит держать его не больше размера пула
+        deadline сколько секунд отведено на каждый запрос
+        Возвращает генератор BatchResult в порядке готовности, item -
+        словарь с tid или order_id, ошибки не прерывают обработку
+        """
+        return run_concurrently(
+            lambda item: self.transaction_details(deadline=deadline, **item),
+            self._details_items(tids, order_ids), max_workers=max_workers)
 
-    def refund(self, tid, amount=None, test=False, reason=None):
+    def refund(self, tid, amount=None, test=False, reason=None,
+               deadline=None):
         """
         проведение возврата
+        deadline сколько секунд отведено на вызов
         """
-        url = self.connection_profile['base_url'] + "alba/refund/"
         fields = {'version': '2.0',
                   'tid': tid}
         if amount:
@@ -170,41 +382,63 @@ class AlbaService(object):
         if reason:
             fields['reason'] = reason
 
-        fields['check'] = sign("POST", url, fields, self.secret)
-        answer = self._post(url, fields)
-        return answer
+        if self.transaction_cache is not None:
+            self.transaction_cache.invalidate(self.service_id, tid)
+        return self._call('post', 'alba/refund/', fields, deadline=deadline)
 
-    def gate_details(self, gate):
+    def _pay_types_key(self):
+        return text_type(self.service_id)
+
+    def _gate_details_key(self, gate):
+        return text_type(self.service_id), gate
+
+    def gate_details(self, gate, deadline=None):
         """
         получение информации о шлюзе
         gate короткое имя шлюза
+        deadline сколько секунд отведено на вызов
+        """
+        def load():
+            return self._coalesce(('alba/gate_details/', gate),
+                                  lambda: self._load_gate_details(
+                                      gate, deadline), deadline)
+
+        if self.cache is None:
+            details = load()
+        else:
+            details = self.cache.gate_details.get_or_load(
+                self._gate_details_key(gate), load)
+        return self._result(GateDetails, details)
+
+    def warm_up(self, gates=()):
+        """
+        Заполнение кеша pay_types и gate_details при старте процесса
+        gates короткие имена шлюзов, которые нужно загрузить заранее
         """
-        url = self.connection_profile['base_url'] + "alba/gate_details/"
+        if self.cache is None:
+            raise AlbaException('Кеш для сервиса не настроен')
+        self.cache.pay_types.set(self._pay_types_key(),
+                                 self._load_pay_types())
+        for gate in gates:
+            self.cache.gate_details.set(self._gate_details_key(gate),
+                                        self._load_gate_details(gate))
+
+    def _load_gate_details(self, gate, deadline=None):
         params = {'version': '2.0',
                   'gate': gate,
                   'service_id': self.service_id}
-        params['check'] = sign("GET", url, params, self.secret)
-        answer = self._get(url, params)
-        return answer
+        return self._call('get', 'alba/gate_details/', params,
+                          idempotent=True, deadline=deadline)
 
     def check_callback_sign(self, post):
         """
         Обработка нотификации
         array $post Массив $_POST параметров
         """
-        order = ['tid', 'name', 'comment', 'partner_id', 'service_id',
-                 'order_id', 'type', 'cost', 'income_total', 'income',
-                 'partner_income', 'system_income', 'command', 'phone_number',
-                 'email', 'resultStr', 'date_created', 'version']
-        params = [post.get(field, '') for field in order]
-        params.append(self.secret)
-        digest_hash = hashlib.md5(
-            (''.join(params)).encode('utf-8')).hexdigest()
-        return digest_hash == post['check']
+        return check_callback_sign(post, self.secret)
 
-    def create_card_token(
-            self, card, exp_month, exp_year, cvc, test,
-            card_holder=None):
+    def _card_token_params(self, card, exp_month, exp_year, cvc,
+                           card_holder=None):
         month = exp_month
         if len(month) == 1:
             month = '0' + month
@@ -219,18 +453,51 @@ class AlbaService(object):
         if card_holder:
             params.update({'card_holder': card_holder})
 
-        url = (self.connection_profile['card_token_test_url'] if test
-               else self.connection_profile['card_token_url'])
-        result = self._post(url + 'create', params)
-        return result['token']
+        return params
+
+    def _create_card_token(self, params, test, deadline=None):
+        url_key = 'card_token_test_url' if test else 'card_token_url'
+        return self._call('post', 'create', params, url_key=url_key,
+                          signed=False, hedge=True, deadline=deadline)
+
+    def create_card_token(
+            self, card, exp_month, exp_year, cvc, test,
+            card_holder=None, deadline=None):
+        params = self._card_token_params(
+            card, exp_month, exp_year, cvc, card_holder)
+        result = self._create_card_token(params, test, deadline)
+        return self._card_token(result)
+
+    def _card_token(self, result):
+        return CardToken(result) if self.typed else result['token']
+
+    def create_card_tokens(self, cards, test, max_workers=10,
+                           deadline=None):
+        """
+        Пакетная токенизация карт
+        cards итерируемые словари с аргументами create_card_token:
+          card, exp_month, exp_year, cvc и необязательный card_holder
+        max_workers число одновременных запросов
+        Возвращает генератор BatchResult в порядке готовности, result -
+        токен карты, ошибки не прерывают обработку
+        """
+        return run_concurrently(
+            lambda card: self.create_card_token(
+                test=test, deadline=deadline, **card),
+            cards, max_workers=max_workers)
+
+    def close(self):
+        """
+        Закрытие соединений транспорта
+        """
+        self.transport.close()
 
-    def cancel_recurrent_payment(self, order_id):
-        url = self.connection_profile['base_url'] + 'alba/recurrent_change/'
+    def cancel_recurrent_payment(self, order_id, deadline=None):
         fields = {
             'operation': 'cancel',
             'order_id': order_id,
             'service_id': self.service_id,
             'version': '2.0'
         }
-        fields['check'] = sign('POST', url, fields, self.secret)
-        return self._post(url, fields)
+        return self._call('post', 'alba/recurrent_change/', fields,
+                          deadline=deadline)
@@ -1,21 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from six import text_type
-from six.moves.urllib.parse import urlparse, quote
+from ._compat import quote, text_type, urlparse
 
 import base64
 import hashlib
 import hmac
 
 DEFAULT_SIGN_EXCLUDE = ['check', 'mac', 'check_gate_internal']
+CALLBACK_SIGN_FIELDS = [
+    'tid', 'name', 'comment', 'partner_id', 'service_id', 'order_id', 'type',
+    'cost', 'income_total', 'income', 'partner_income', 'system_income',
+    'command', 'phone_number', 'email', 'resultStr', 'date_created', 'version'
+]
 
 
-def sign(method, url, params, secret_key, exclude=DEFAULT_SIGN_EXCLUDE):
-    """
-    Типовой метод для подписи HTTP запросов
-    """
-    url_parsed = urlparse(url)
+def _canonical_query(params, exclude):
     keys = [param for param in params if param not in exclude]
     keys.sort()
 
@@ -26,12 +26,49 @@ def sign(method, url, params, secret_key, exclude=DEFAULT_SIGN_EXCLUDE):
             safe='~'
         )
         result.append('{}={}'.format(key, value))
+    return "&".join(result)
+
 
+class Signer(object):
+    """
+    Подпись запросов к одному адресу.
+    Разбор URL и подготовка HMAC-ключа выполняются один раз, поэтому
+    объект стоит создавать заранее и переиспользовать; результат
+    совпадает с sign()
+    """
+
+    def __init__(self, method, url, secret_key,
+                 exclude=DEFAULT_SIGN_EXCLUDE):
+        url_parsed = urlparse(url)
+        self.method = method
+        self.url = url
+        self.exclude = frozenset(exclude)
+        self._prefix = "\n".join([
+            method,
+            url_parsed.hostname,
+            url_parsed.path,
+            ""
+        ])
+        self._hmac = hmac.new(secret_key.encode('utf-8'),
+                              digestmod=hashlib.sha256)
+
+    def __call__(self, params):
+        data = self._prefix + _canonical_query(params, self.exclude)
+        digest = self._hmac.copy()
+        digest.update(data.encode('utf-8'))
+        return base64.b64encode(digest.digest())
+
+
+def sign(method, url, params, secret_key, exclude=DEFAULT_SIGN_EXCLUDE):
+    """
+    Типовой метод для подписи HTTP запросов
+    """
+    url_parsed = urlparse(url)
     data = "\n".join([
         method,
         url_parsed.hostname,
         url_parsed.path,
-        "&".join(result)
+        _canonical_query(params, exclude)
     ])
     digest = hmac.new(
         secret_key.encode('utf-8'),
@@ -40,3 +77,19 @@ def sign(method, url, params, secret_key, exclude=DEFAULT_SIGN_EXCLUDE):
     ).digest()
     signature = base64.b64encode(digest)
     return signature
+
+
+def callback_sign(post, secret_key):
+    """
+    Подпись нотификации Alba
+    """
+    params = [post.get(field, '') for field in CALLBACK_SIGN_FIELDS]
+    params.append(secret_key)
+    return hashlib.md5((''.join(params)).encode('utf-8')).hexdigest()
+
+
+def check_callback_sign(post, secret_key):
+    """
+    Проверка подписи нотификации, post - словарь POST параметров
+    """
+    return callback_sign(post, secret_key) == post['check']
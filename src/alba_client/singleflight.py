@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+from .exceptions import AlbaTimeoutError
+
+
+class _Call(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Объединение одновременных вызовов с одинаковым ключом:
+    функция выполняется один раз, остальные потоки получают
+    её результат или исключение. do_async делает то же для корутин.
+    timeout - сколько секунд присоединившийся вызов ждёт результата,
+    обычно остаток его deadline; по истечении поднимается AlbaTimeoutError.
+
+    executed число фактических вызовов, collapsed число вызовов,
+    присоединившихся к уже выполняющемуся
+    """
+
+    def __init__(self):
+        self.executed = 0
+        self.collapsed = 0
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def _count(self, leader):
+        with self._lock:
+            if leader:
+                self.executed += 1
+            else:
+                self.collapsed += 1
+
+    def do(self, key, func, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise AlbaTimeoutError(
+                    'Превышено время выполнения запроса: {} с'
+                    .format(timeout))
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def do_async(self, key, func, timeout=None):
+        """
+        Асинхронный вариант do: func - функция без аргументов,
+        возвращающая корутину. Возвращает awaitable с её результатом;
+        отмена одного из ожидающих не отменяет общий вызов, по истечении
+        timeout ожидающий получает asyncio.TimeoutError
+        """
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        task_key = (loop, key)
+        task = self._tasks.get(task_key)
+        leader = task is None
+        if leader:
+            task = self._tasks[task_key] = asyncio.ensure_future(func())
+            task.add_done_callback(
+                lambda done: self._finish_task(task_key, done))
+        self._count(leader)
+        if timeout is None:
+            return asyncio.shield(task)
+        return asyncio.wait_for(asyncio.shield(task), timeout)
+
+    def _finish_task(self, task_key, task):
+        if self._tasks.get(task_key) is task:
+            del self._tasks[task_key]
+        if not task.cancelled():
+            # исключение уже передано ожидающим
+            task.exception()
+
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный шлюз, имитирующий протокол Alba, для тестов и нагрузочного
+тестирования.
+
+    from alba_client.testing import FakeGateway
+
+    with FakeGateway({'10000': 'secret'}, pay_delay=0.1,
+                     callback=my_callback.handle) as gateway:
+        service = AlbaService('10000', 'secret',
+                              connection_profile=gateway.profile)
+        service.init_payment(...)
+
+Шлюз проверяет подпись sign() у запросов и md5 у pay_types, а через
+pay_delay секунд после init_payment отправляет подписанную нотификацию
+success. Без сети его можно подключить через gateway.transport().
+
+Отдельным процессом:
+
+    python -m alba_client.testing --port 8000 --service 10000:secret \
+        --latency 0.01 --unique-rate 0.01 --callback-url http://.../alba/
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen
+
+from ._compat import parse_qs, text_type, urlencode, urlparse
+from .deadline import clock
+from .ratelimit import TokenBucket
+from .sign import CALLBACK_SIGN_FIELDS, callback_sign, sign
+
+logger = logging.getLogger(__name__)
+
+NEW = 'new'
+PAYED = 'payed'
+REFUNDED = 'refunded'
+
+DEFAULT_PAY_TYPES = ['spg', 'mc', 'qiwi']
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return text_type(value)
+
+
+def _error(code, msg):
+    return {'status': 'error', 'code': code, 'msg': msg}
+
+
+class FakeGateway(object):
+    """
+    Имитация API Alba: alba/input/, alba/details/, alba/refund/,
+    alba/pay_types/, alba/gate_details/, alba/recurrent_change/
+    и cardtoken/create.
+
+    services словарь {service_id: secret}
+    host, port адрес HTTP-сервера, port=0 - любой свободный
+    latency задержка ответа в секундах, число или пара (min, max)
+    error_rates доли случайных ошибок по кодам, например
+      {'unique': 0.01, 'auth': 0.01}
+    max_rps ограничение пропускной способности, лишние запросы ждут
+    pay_delay через сколько секунд после init_payment транзакция
+      оплачивается, None - только явным вызовом pay()
+    callback адрес для нотификаций или функция, принимающая словарь
+      POST-параметров (например, AlbaCallback.handle)
+    seed зерно генератора случайных ошибок
+
+    stats счётчики запросов по методам и ошибок по кодам
+    """
+
+    def __init__(self, services, host='127.0.0.1', port=0, latency=0,
+                 error_rates=None, max_rps=None, pay_delay=None,
+                 callback=None, seed=None):
+        self.services = {text_type(service_id): secret
+                         for service_id, secret in services.items()}
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rates = dict(error_rates or {})
+        self.bucket = TokenBucket(max_rps) if max_rps else None
+        self.pay_delay = pay_delay
+        self.callback = callback
+        self.pay_types = list(DEFAULT_PAY_TYPES)
+        self.stats = Counter()
+        self.transactions = {}
+        self._orders = {}
+        self._tids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._timer_thread = None
+        self._stopped = False
+        self._server = None
+        self._routes = {
+            '/alba/input/': self._input,
+            '/alba/details/': self._details,
+            '/alba/refund/': self._refund,
+            '/alba/pay_types/': self._pay_types,
+            '/alba/gate_details/': self._gate_details,
+            '/alba/recurrent_change/': self._recurrent_change,
+            '/cardtoken/create': self._card_token,
+        }
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self._server.server_address[:2])
+
+    @property
+    def profile(self):
+        """
+        connection_profile для AlbaService, указывающий на шлюз
+        """
+        return {
+            'base_url': self.url,
+            'card_token_url': self.url + 'cardtoken/',
+            'card_token_test_url': self.url + 'cardtoken/',
+        }
+
+    def transport(self):
+        """
+        MemoryTransport, передающий запросы шлюзу без HTTP
+        """
+        from .transport import MemoryTransport
+        return MemoryTransport(handler=self.handle, history=1)
+
+    def _create_server(self):
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.gateway = self
+        return self._server
+
+    def start(self):
+        """
+        Запуск HTTP-сервера в фоновом потоке
+        """
+        thread = threading.Thread(target=self._create_server().serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve_forever(self):
+        self._create_server().serve_forever()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, method, url, data):
+        """
+        Обработка запроса, возвращает (status_code, body)
+        method 'get' или 'post', data словарь параметров
+        """
+        parsed = urlparse(url)
+        params = {key: _text(value) for key, value in (data or {}).items()}
+        for key, values in parse_qs(parsed.query).items():
+            params[key] = values[-1]
+        route = self._routes.get(parsed.path)
+        if route is None:
+            return 404, {'status': 'error', 'msg': 'Not found'}
+        self._throttle()
+        name = parsed.path.strip('/')
+        self._count(name)
+        body = self._injected_error()
+        if body is None:
+            body = route(method.upper(), url.split('?', 1)[0], params)
+        if body['status'] == 'error':
+            self._count('error.' + body['code'])
+        return 200, body
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _throttle(self):
+        if self.bucket is not None:
+            wait = self.bucket.reserve()
+            if wait:
+                time.sleep(wait)
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = self._random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def _injected_error(self):
+        value = self._random.random()
+        for code, rate in sorted(self.error_rates.items()):
+            if value < rate:
+                return _error(code, 'Injected {} error'.format(code))
+            value -= rate
+        return None
+
+    def _authenticate(self, method, url, params, service_id=None):
+        """
+        service_id, чьим ключом подписан запрос, или None
+        """
+        check = params.get('check')
+        if not check:
+            return None
+        if service_id is None:
+            candidates = self.services.items()
+        else:
+            candidates = [(service_id, self.services.get(service_id))]
+        for candidate, secret in candidates:
+            if secret is not None and _text(
+                    sign(method, url, params, secret)) == check:
+                return candidate
+        return None
+
+    def _signed(self, method, url, params):
+        service_id = params.get('service_id')
+        if not service_id and params.get('tid') in self.transactions:
+            service_id = self.transactions[params['tid']]['service_id']
+        return self._authenticate(method, url, params, service_id or None)
+
+    def _input(self, method, url, params):
+        service_id = self._signed(method, url, params)
+        if service_id is None:
+            return _error('auth', 'Ошибка в подписи')
+        with self._lock:
+            order_id = params.get('order_id')
+            if order_id and (service_id, order_id) in self._orders:
+                return _error('unique', 'Заказ уже существует')
+            tid = text_type(next(self._tids))
+            self.transactions[tid] = {
+                'tid': tid,
+                'service_id': service_id,
+                'order_id': order_id or '',
+                'type': params.get('type', ''),
+                'cost': params.get('cost', ''),
+                'name': params.get('name', ''),
+                'comment': params.get('comment', ''),
+                'email': params.get('email', ''),
+                'phone_number': params.get('phone_number', ''),
+                'transaction_status': NEW,
+            }
+            if order_id:
+                self._orders[(service_id, order_id)] = tid
+        if self.pay_delay is not None:
+            self._schedule(self.pay_delay, self.pay, tid)
+        return {'status': 'success', 'tid': tid}
+
+    def _details(self, method, url, params):
+        service_id = self._signed(method, url, params)
+        if service_id is None:
+            return _error('auth', 'Ошибка в подписи')
+        tid = params.get('tid') or self._orders.get(
+            (service_id, params.get('order_id')))
+        transaction = self.transactions.get(tid)
+        if transaction is None or transaction['service_id'] != service_id:
+            return _error('unknown', 'Транзакция не найдена')
+        return dict(transaction, status='success')
+
+    def _refund(self, method, url, params):
+        if self._signed(method, url, params) is None:
+            return _error('auth', 'Ошибка в подписи')
+        transaction = self.transactions.get(params.get('tid'))
+        if transaction is None or transaction['transaction_status'] != PAYED:
+            return _error('unknown', 'Транзакция не оплачена')
+        transaction['transaction_status'] = REFUNDED
+        self._send_callback(transaction, 'refund')
+        return {'status': 'success'}
+
+    def _pay_types(self, method, url, params):
+        service_id = params.get('service_id', '')
+        secret = self.services.get(service_id)
+        check = hashlib.md5(
+            (service_id + (secret or '')).encode('utf-8')).hexdigest()
+        if secret is None or params.get('check') != check:
+            return _error('auth', 'Ошибка в подписи')
+        return {'status': 'success', 'types': self.pay_types}
+
+    def _gate_details(self, method, url, params):
+        if self._signed(method, url, params) is None:
+            return _error('auth', 'Ошибка в подписи')
+        return {'status': 'success', 'name': params.get('gate', ''),
+                'init_payment': True, 'percent': '0'}
+
+    def _recurrent_change(self, method, url, params):
+        if self._signed(method, url, params) is None:
+            return _error('auth', 'Ошибка в подписи')
+        return {'status': 'success'}
+
+    def _card_token(self, method, url, params):
+        if params.get('service_id') not in self.services:
+            return _error('auth', 'Неизвестный сервис')
+        token = hashlib.sha1(
+            (params.get('card', '') + params.get('exp_year', '')).encode(
+                'utf-8')).hexdigest()
+        return {'status': 'success', 'token': token}
+
+    def pay(self, tid):
+        """
+        Оплата транзакции с отправкой нотификации success
+        """
+        transaction = self.transactions[text_type(tid)]
+        transaction['transaction_status'] = PAYED
+        self._send_callback(transaction, 'success')
+
+    def callback_post(self, transaction, command):
+        """
+        Подписанные POST-параметры нотификации по транзакции
+        """
+        post = {field: _text(transaction.get(field))
+                for field in CALLBACK_SIGN_FIELDS}
+        post.update(command=command, version='2.0')
+        post['check'] = callback_sign(
+            post, self.services[transaction['service_id']])
+        return post
+
+    def _send_callback(self, transaction, command):
+        if self.callback is None:
+            return
+        post = self.callback_post(transaction, command)
+        try:
+            if callable(self.callback):
+                self.callback(post)
+            else:
+                urlopen(self.callback, urlencode(post).encode('utf-8'),
+                        timeout=10).read()
+        except Exception:
+            self._count('callback.failed')
+            logger.exception('Callback delivery failed')
+        else:
+            self._count('callback.sent')
+
+    def _schedule(self, delay, func, *args):
+        with self._cond:
+            heapq.heappush(self._timers, (
+                clock() + delay, next(self._timer_ids), func, args))
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._run_timers)
+                self._timer_thread.daemon = True
+                self._timer_thread.start()
+            self._cond.notify()
+
+    def _run_timers(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (
+                        not self._timers or self._timers[0][0] > clock()):
+                    self._cond.wait(
+                        self._timers[0][0] - clock() if self._timers
+                        else None)
+                if self._stopped:
+                    return
+                _, _, func, args = heapq.heappop(self._timers)
+            func(*args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _respond(self, method, data):
+        host = self.headers.get('Host') or self.server.server_address[0]
+        status_code, body = self.server.gateway.handle(
+            method, 'http://{}{}'.format(host, self.path), data)
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._respond('get', None)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        data = {key: values[-1] for key, values in parse_qs(
+            body.decode('utf-8'), keep_blank_values=True).items()}
+        self._respond('post', data)
+
+    def log_message(self, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Локальный шлюз, имитирующий API Alba')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--service', action='append', required=True,
+                        metavar='ID:SECRET')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--unique-rate', type=float, default=0)
+    parser.add_argument('--auth-rate', type=float, default=0)
+    parser.add_argument('--max-rps', type=float, default=None)
+    parser.add_argument('--pay-delay', type=float, default=1.0)
+    parser.add_argument('--callback-url', default=None)
+    args = parser.parse_args(argv)
+
+    services = dict(item.split(':', 1) for item in args.service)
+    gateway = FakeGateway(
+        services, host=args.host, port=args.port, latency=args.latency,
+        error_rates={'unique': args.unique_rate, 'auth': args.auth_rate},
+        max_rps=args.max_rps, pay_delay=args.pay_delay,
+        callback=args.callback_url)
+    logging.basicConfig(level=logging.INFO)
+    print('Serving on http://{}:{}/'.format(args.host, args.port))
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
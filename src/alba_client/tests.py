@@ -1,11 +1,47 @@
 import hashlib
+import io
+import json
+import requests
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import requests_mock
-from unittest import TestCase
+from decimal import Decimal
+from unittest import TestCase, skipIf
 
 from six import text_type
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import quote, urlencode
 
-from alba_client import AlbaService, AlbaException
-from alba_client.recurrent import RecurrentParams
+from alba_client import (
+    AlbaService, AlbaException, AlbaCallback, ConnectionPool)
+from alba_client.batch import run_concurrently
+from alba_client.cache import MetadataCache, TTLCache, TransactionCache
+from alba_client.exceptions import (
+    AlbaConnectionError, AlbaRateLimitError, AlbaTimeoutError, AuthError,
+    UniqueError)
+from alba_client.failover import CircuitBreaker, Failover, RetryPolicy
+from alba_client import reconcile, refunds, webhook
+from alba_client.transport import (
+    HTTPXTransport, MemoryTransport, Urllib3Transport)
+from alba_client.models import GateDetails, PayType, Transaction
+from alba_client.journal import Journal, RecordWriter, read_records
+from alba_client.idempotency import (
+    CallbackDeduplicator, SQLiteIdempotencyStore)
+from alba_client.sign import check_callback_sign, sign, Signer
+from alba_client.ratelimit import FAIL, RateLimiter, TokenBucket
+from alba_client.recurrent import RecurrentParams, RecurrentScheduler
+from alba_client.registry import ServiceRegistry
+from alba_client.log import RequestLogger
+from alba_client.metrics import Hook, Metrics, TracingHook
+from alba_client.singleflight import SingleFlight
+from alba_client.testing import FakeGateway
+from alba_client.watcher import StatusWatcher
 
 
 class ServiceTestCase(TestCase):
@@ -231,3 +267,1628 @@ class ServiceTestCase(TestCase):
         post['check'] = post_check
         check = self.service.check_callback_sign(post)
         self.assertTrue(check)
+
+
+class ConnectionPoolTestCase(TestCase):
+    def test_service_owns_pool_by_default(self):
+        first = AlbaService('10000', 'secret')
+        second = AlbaService('10001', 'secret')
+        self.assertIsNot(first.pool, second.pool)
+
+    def test_shared_pool(self):
+        pool = ConnectionPool(pool_size=2)
+        first = AlbaService('10000', 'secret', pool=pool)
+        second = AlbaService('10001', 'secret', pool=pool)
+        self.assertIs(first.pool.session, second.pool.session)
+        adapter = pool.session.get_adapter('https://partner.rficb.ru/')
+        self.assertEqual(adapter._pool_maxsize, 2)
+
+    def test_session_is_reused(self):
+        pool = ConnectionPool()
+        service = AlbaService('10000', 'secret', pool=pool)
+        session = pool.session
+        with requests_mock.mock() as m:
+            m.post(service.connection_profile['base_url'] + 'alba/input/',
+                   json={'status': 'success', 'tid': 100})
+            service.init_payment(
+                'mc', 200, 'Test', 'test@test.ru', '79091234567')
+            service.init_payment(
+                'mc', 200, 'Test', 'test@test.ru', '79091234567')
+        self.assertIs(pool.session, session)
+
+    def test_session_recreated_after_fork(self):
+        pool = ConnectionPool()
+        session = pool.session
+        pool._pid = -1
+        self.assertIsNot(pool.session, session)
+
+    def test_keep_alive_disabled(self):
+        pool = ConnectionPool(keep_alive=False)
+        self.assertEqual(pool.session.headers['Connection'], 'close')
+
+
+class BatchTestCase(TestCase):
+    def setUp(self):
+        self.service = AlbaService('10000', 'secret')
+        self.url = self.service.connection_profile['base_url'] + 'alba/details/'
+
+    def details_callback(self, request, context):
+        params = dict(pair.split('=') for pair in request.text.split('&'))
+        if params.get('tid') == '2':
+            return {'status': 'error', 'code': 'auth', 'msg': 'Auth'}
+        return {'status': 'success', 'transaction_status': 'payed',
+                'tid': params.get('tid'), 'order_id': params.get('order_id')}
+
+    def test_transaction_details_batch(self):
+        with requests_mock.mock() as m:
+            m.post(self.url, json=self.details_callback)
+            results = list(self.service.transaction_details_batch(
+                tids=['1', '2', '3'], order_ids=['a'], max_workers=2))
+        self.assertEqual(len(results), 4)
+        by_item = {tuple(r.item.items())[0]: r for r in results}
+        self.assertEqual(by_item[('tid', '1')].result['tid'], '1')
+        self.assertEqual(by_item[('order_id', 'a')].result['order_id'], 'a')
+        failed = by_item[('tid', '2')]
+        self.assertIsNone(failed.result)
+        self.assertIsInstance(failed.error, AuthError)
+
+    def test_run_concurrently_is_bounded(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def func(item):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+            return item * 2
+
+        results = list(run_concurrently(func, range(20), max_workers=3))
+        self.assertEqual(sorted(r.result for r in results),
+                         [i * 2 for i in range(20)])
+        self.assertLessEqual(state['peak'], 3)
+
+
+class CacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = MetadataCache(pay_types_ttl=60, gate_details_ttl=60,
+                                   max_gates=2)
+        self.service = AlbaService('10000', 'secret', cache=self.cache)
+        self.gate_url = (self.service.connection_profile['base_url']
+                         + 'alba/gate_details/')
+
+    def test_pay_types_cached(self):
+        with requests_mock.mock() as m:
+            m.get(self.service._pay_types_url(),
+                  json={'status': 'success', 'types': ['mc']})
+            self.assertEqual(self.service.pay_types(), ['mc'])
+            self.assertEqual(self.service.pay_types(), ['mc'])
+            self.assertEqual(m.call_count, 1)
+
+    def test_gate_details_lru(self):
+        with requests_mock.mock() as m:
+            m.get(self.gate_url, json={'status': 'success'})
+            for gate in ('mc', 'qiwi', 'spg', 'mc'):
+                self.service.gate_details(gate)
+            self.assertEqual(m.call_count, 4)
+            self.service.gate_details('spg')
+            self.assertEqual(m.call_count, 4)
+        self.assertEqual(len(self.cache.gate_details), 2)
+
+    def test_stale_value_refreshed_in_background(self):
+        cache = TTLCache(ttl=0, stale_ttl=60)
+        cache.set('key', 'old')
+        refreshed = threading.Event()
+
+        def loader():
+            refreshed.set()
+            return 'new'
+
+        self.assertEqual(cache.get_or_load('key', loader), 'old')
+        self.assertTrue(refreshed.wait(1))
+        for _ in range(100):
+            if cache._data['key'][0] == 'new':
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache._data['key'][0], 'new')
+
+    def test_expired_value_reloaded(self):
+        cache = TTLCache(ttl=0, stale_ttl=0)
+        cache.set('key', 'old')
+        time.sleep(0.01)
+        self.assertEqual(cache.get_or_load('key', lambda: 'new'), 'new')
+
+    def test_warm_up(self):
+        with requests_mock.mock() as m:
+            m.get(self.service._pay_types_url(),
+                  json={'status': 'success', 'types': ['mc']})
+            m.get(self.gate_url, json={'status': 'success', 'name': 'MC'})
+            self.service.warm_up(gates=['mc'])
+            self.assertEqual(m.call_count, 2)
+            self.service.pay_types()
+            self.service.gate_details('mc')
+            self.assertEqual(m.call_count, 2)
+
+    def test_warm_up_without_cache(self):
+        with self.assertRaises(AlbaException):
+            AlbaService('10000', 'secret').warm_up()
+
+
+def run_in_child(func):
+    """
+    Результат func() (True или False) в дочернем процессе после fork
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.write(write, b'1' if func() else b'0')
+        finally:
+            os._exit(0)
+    os.close(write)
+    os.waitpid(pid, 0)
+    result = os.read(read, 1)
+    os.close(read)
+    return result == b'1'
+
+
+class TransactionCacheTestCase(TestCase):
+    def setUp(self):
+        self.statuses = {'1': 'payed', '2': 'new'}
+        self.transport = MemoryTransport(handler=self.handler)
+        self.cache = TransactionCache(':memory:', maxsize=2)
+        self.addCleanup(self.cache.close)
+        self.service = AlbaService('10000', 'secret',
+                                   transport=self.transport,
+                                   transaction_cache=self.cache)
+
+    def handler(self, method, url, data):
+        tid = data.get('tid') or '1'
+        return 200, {'status': 'success', 'tid': tid,
+                     'order_id': 'order-' + tid,
+                     'transaction_status': self.statuses.get(tid, 'payed')}
+
+    def test_final_status_cached(self):
+        first = self.service.transaction_details(tid='1')
+        self.assertEqual(self.service.transaction_details(tid='1'), first)
+        self.assertEqual(
+            self.service.transaction_details(order_id='order-1'), first)
+        self.assertEqual(len(self.transport.requests), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_pending_status_not_cached(self):
+        self.service.transaction_details(tid='2')
+        self.service.transaction_details(tid='2')
+        self.assertEqual(len(self.transport.requests), 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_keys_include_service(self):
+        self.service.transaction_details(tid='1')
+        self.assertIsNotNone(self.cache.get('10000', order_id='order-1'))
+        self.assertIsNone(self.cache.get('20000', order_id='order-1'))
+        self.assertIsNone(self.cache.get('20000', tid='1'))
+
+    def test_invalidate_without_keys_keeps_entries(self):
+        self.service.transaction_details(tid='1')
+        self.cache.invalidate('10000')
+        self.assertEqual(len(self.cache), 1)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_oldest_evicted(self):
+        for tid in ('3', '4', '5'):
+            self.service.transaction_details(tid=tid)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('10000', tid='3'))
+        self.assertIsNotNone(self.cache.get('10000', tid='5'))
+
+    def test_refund_callback_invalidates(self):
+        self.service.transaction_details(tid='1')
+        callback = RecordingCallback([self.service],
+                                     transaction_cache=self.cache)
+        callback.handle(signed_post(self.service, tid='1', command='refund'))
+        self.statuses['1'] = 'refunded'
+        details = self.service.transaction_details(tid='1')
+        self.assertEqual(details['transaction_status'], 'refunded')
+        self.assertEqual(len(self.transport.requests), 2)
+
+    def test_shared_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'transactions.sqlite')
+        first = TransactionCache(path)
+        first.set('10000', {'tid': '1', 'transaction_status': 'success'})
+        first.close()
+        second = TransactionCache(path)
+        self.addCleanup(second.close)
+        self.assertEqual(second.get('10000', tid='1')['transaction_status'],
+                         'success')
+
+    @skipIf(not hasattr(os, 'fork'), 'fork is not available')
+    def test_reconnects_after_fork(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = TransactionCache(os.path.join(directory, 'cache.sqlite'))
+        self.addCleanup(cache.close)
+        cache.set('10000', {'tid': '1', 'transaction_status': 'success'})
+        connection = cache._connection
+        self.assertTrue(run_in_child(
+            lambda: cache.get('10000', tid='1') is not None
+            and cache._connection is not connection))
+        self.assertIs(cache._connection, connection)
+
+
+class SignerTestCase(TestCase):
+    url = 'https://partner.rficb.ru/alba/input/'
+
+    def test_signer_matches_sign(self):
+        for params in ({}, {'tid': 100, 'check': 'x'},
+                       {'name': 'Тест', 'comment': 'a b&c~', 'cost': None},
+                       {'version': '2.0', 'service_id': '10000'}):
+            signer = Signer('POST', self.url, 'secret')
+            self.assertEqual(signer(params),
+                             sign('POST', self.url, params, 'secret'))
+            self.assertEqual(signer(params), signer(params))
+
+    def test_service_reuses_signer(self):
+        service = AlbaService('10000', 'secret')
+        url = service._url('alba/details/')
+        service._sign('POST', url, {'tid': 1})
+        service._sign('POST', url, {'tid': 2})
+        self.assertEqual(len(service._signers), 1)
+        service.secret = 'rotated'
+        self.assertEqual(service._sign('POST', url, {'tid': 1}),
+                         sign('POST', url, {'tid': 1}, 'rotated'))
+
+    def test_url_cache_follows_connection_profile(self):
+        service = AlbaService('10000', 'secret')
+        self.assertEqual(service._url('create', 'card_token_url'),
+                         'https://secure.rficb.ru/cardtoken/create')
+        service.connection_profile = AlbaService.SECOND_CONNECTION_PROFILE
+        self.assertEqual(service._url('create', 'card_token_url'),
+                         'https://secure.rfibank.ru/cardtoken/create')
+
+
+class RecordingCallback(AlbaCallback):
+    def __init__(self, *args, **kwargs):
+        super(RecordingCallback, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def callback_success(self, data):
+        self.calls.append(data['tid'])
+        if data.get('fail'):
+            raise ValueError('handler failed')
+
+
+def signed_post(service, **fields):
+    order = ['tid', 'name', 'comment', 'partner_id', 'service_id',
+             'order_id', 'type', 'cost', 'income_total', 'income',
+             'partner_income', 'system_income', 'command', 'phone_number',
+             'email', 'resultStr', 'date_created', 'version']
+    post = dict(fields, service_id=text_type(service.service_id))
+    params = [post.get(field, '') for field in order]
+    params.append(service.secret)
+    post['check'] = hashlib.md5(
+        (''.join(params)).encode('utf-8')).hexdigest()
+    return post
+
+
+class CallbackDeduplicationTestCase(TestCase):
+    def setUp(self):
+        self.service = AlbaService('10000', 'secret')
+
+    def test_duplicates_suppressed(self):
+        deduplicator = CallbackDeduplicator(maxsize=10)
+        callback = RecordingCallback([self.service], deduplicator)
+        post = signed_post(self.service, tid='1', command='success')
+        callback.handle(post)
+        callback.handle(post)
+        callback.handle(signed_post(self.service, tid='2', command='success'))
+        self.assertEqual(callback.calls, ['1', '2'])
+        self.assertEqual((deduplicator.hits, deduplicator.misses), (1, 2))
+
+    def test_failed_dispatch_is_retried(self):
+        deduplicator = CallbackDeduplicator()
+        callback = RecordingCallback([self.service], deduplicator)
+        post = signed_post(self.service, tid='1', command='success')
+        post['fail'] = '1'
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                callback.handle(post)
+        self.assertEqual(callback.calls, ['1', '1'])
+
+    def test_bad_sign_not_recorded(self):
+        deduplicator = CallbackDeduplicator()
+        callback = RecordingCallback([self.service], deduplicator)
+        post = signed_post(self.service, tid='1', command='success')
+        with self.assertRaises(AlbaException):
+            callback.handle(dict(post, check='forged'))
+        callback.handle(post)
+        self.assertEqual(callback.calls, ['1'])
+
+    def test_shared_sqlite_backend(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'callbacks.sqlite')
+        post = signed_post(self.service, tid='1', command='success')
+        first = RecordingCallback(
+            [self.service],
+            CallbackDeduplicator(SQLiteIdempotencyStore(path)))
+        second = RecordingCallback(
+            [self.service],
+            CallbackDeduplicator(SQLiteIdempotencyStore(path)))
+        first.handle(post)
+        second.handle(post)
+        self.assertEqual(first.calls, ['1'])
+        self.assertEqual(second.calls, [])
+        self.assertEqual(second.deduplicator.hits, 1)
+
+    @skipIf(not hasattr(os, 'fork'), 'fork is not available')
+    def test_sqlite_reconnects_after_fork(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = SQLiteIdempotencyStore(
+            os.path.join(directory, 'callbacks.sqlite'))
+        self.addCleanup(store.close)
+        store.add('10000:1:success')
+        connection = store._connection
+        self.assertTrue(run_in_child(
+            lambda: '10000:1:success' in store
+            and store._connection is not connection))
+        self.assertIs(store._connection, connection)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    """
+    Локальный HTTP-сервер, отвечающий body на любой запрос
+    """
+
+    def __init__(self, body, delay=0):
+        payload = json.dumps(body).encode('utf-8')
+        received = self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = self.rfile.read(
+                    int(self.headers.get('Content-Length', 0)))
+                received.append((self.command, self.path, data))
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FailoverTestCase(TestCase):
+    primary = {'base_url': 'https://a.example/',
+               'card_token_url': 'https://token-a.example/',
+               'card_token_test_url': 'https://token-a.example/'}
+    secondary = {'base_url': 'https://b.example/',
+                 'card_token_url': 'https://token-b.example/',
+                 'card_token_test_url': 'https://token-b.example/'}
+
+    def make_service(self, **kwargs):
+        kwargs.setdefault('retry', RetryPolicy(attempts=3, backoff=0))
+        self.failover = Failover([self.primary, self.secondary], **kwargs)
+        return AlbaService('10000', 'secret', failover=self.failover)
+
+    def test_idempotent_call_fails_over(self):
+        service = self.make_service()
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/details/', status_code=502)
+            m.post('https://b.example/alba/details/',
+                   json={'status': 'success', 'tid': '1'})
+            self.assertEqual(service.transaction_details(tid=1)['tid'], '1')
+        health = self.failover.health()
+        self.assertEqual(health['https://a.example/']['failures'], 1)
+        self.assertEqual(health['https://b.example/']['successes'], 1)
+
+    def test_signature_matches_endpoint(self):
+        service = self.make_service()
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/details/',
+                   exc=requests.ConnectionError('refused'))
+            m.post('https://b.example/alba/details/',
+                   json={'status': 'success'})
+            service.transaction_details(tid=1)
+            request = m.request_history[-1]
+        self.assertIn(
+            quote(sign('POST', 'https://b.example/alba/details/',
+                       {'tid': 1, 'version': '2.0'}, 'secret'), safe=''),
+            request.text)
+
+    def test_business_error_not_retried(self):
+        service = self.make_service()
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/details/',
+                   json={'status': 'error', 'code': 'auth', 'msg': 'Auth'})
+            with self.assertRaises(AuthError):
+                service.transaction_details(tid=1)
+            self.assertEqual(m.call_count, 1)
+
+    def test_non_idempotent_call_not_retried(self):
+        service = self.make_service()
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/input/', status_code=502)
+            m.post('https://b.example/alba/input/',
+                   json={'status': 'success'})
+            with self.assertRaises(AlbaConnectionError):
+                service.init_payment(
+                    'mc', 200, 'Test', 'test@test.ru', '79091234567')
+            self.assertEqual(m.call_count, 1)
+
+    def test_circuit_breaker_skips_failed_endpoint(self):
+        service = self.make_service(failure_threshold=1, reset_timeout=60)
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/input/', status_code=502)
+            m.post('https://b.example/alba/input/',
+                   json={'status': 'success', 'tid': 2})
+            with self.assertRaises(AlbaConnectionError):
+                service.init_payment(
+                    'mc', 200, 'Test', 'test@test.ru', '79091234567')
+            response = service.init_payment(
+                'mc', 200, 'Test', 'test@test.ru', '79091234567')
+        self.assertEqual(response['tid'], 2)
+        self.assertEqual(self.failover.health()['https://a.example/']['state'],
+                         CircuitBreaker.OPEN)
+
+    def test_half_open_after_reset_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_unchosen_endpoint_not_probed(self):
+        service = self.make_service(failure_threshold=1, reset_timeout=0)
+        secondary = self.failover.endpoints['base_url'][1]
+        secondary.record_failure()
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/details/',
+                   json={'status': 'success'})
+            m.post('https://b.example/alba/details/',
+                   json={'status': 'success', 'tid': '2'})
+            for _ in range(3):
+                service.transaction_details(tid=1)
+            self.assertEqual(secondary.breaker.state, CircuitBreaker.OPEN)
+            m.post('https://a.example/alba/details/', status_code=502)
+            self.assertEqual(service.transaction_details(tid=1)['tid'], '2')
+
+    def test_probe_with_business_error_closes_circuit(self):
+        service = self.make_service(failure_threshold=1, reset_timeout=0)
+        for endpoint in self.failover.endpoints['base_url']:
+            endpoint.record_failure()
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/details/',
+                   json={'status': 'error', 'code': 'unknown',
+                         'msg': 'Транзакция не найдена'})
+            with self.assertRaises(AlbaException):
+                service.transaction_details(tid=1)
+        self.assertEqual(self.failover.health()['https://a.example/']['state'],
+                         CircuitBreaker.CLOSED)
+
+    def test_hedged_card_token(self):
+        slow = StubServer({'status': 'success', 'token': 'slow'}, delay=0.5)
+        fast = StubServer({'status': 'success', 'token': 'fast'})
+        self.addCleanup(slow.stop)
+        self.addCleanup(fast.stop)
+        self.primary = dict(self.primary, card_token_url=slow.url)
+        self.secondary = dict(self.secondary, card_token_url=fast.url)
+        service = self.make_service(hedge_after=0.05)
+        started = time.time()
+        token = service.create_card_token(
+            '4300000000000777', '1', '22', '123', test=False)
+        self.assertEqual(token, 'fast')
+        self.assertLess(time.time() - started, 0.4)
+
+    def test_hedge_waits_for_probe_without_secondary(self):
+        server = StubServer({'status': 'success', 'token': 'probe'},
+                            delay=0.1)
+        self.addCleanup(server.stop)
+        self.primary = dict(self.primary, card_token_url=server.url)
+        service = self.make_service(hedge_after=0.02, failure_threshold=1,
+                                    reset_timeout=60)
+        primary, secondary = self.failover.endpoints['card_token_url']
+        primary.record_failure()
+        primary.breaker.opened_at -= 60
+        secondary.record_failure()
+        token = service.create_card_token(
+            '4300000000000777', '1', '22', '123', test=False)
+        self.assertEqual(token, 'probe')
+        self.assertEqual(primary.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_release_returns_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.release()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow())
+
+
+class TimeoutTestCase(TestCase):
+    def setUp(self):
+        self.service = AlbaService(
+            '10000', 'secret', timeout=(3, 20),
+            endpoint_timeouts={'alba/details/': (1, 5)})
+        self.base_url = self.service.connection_profile['base_url']
+
+    def test_service_and_endpoint_timeouts(self):
+        with requests_mock.mock() as m:
+            m.post(self.base_url + 'alba/input/', json={'status': 'success'})
+            m.post(self.base_url + 'alba/details/',
+                   json={'status': 'success'})
+            self.service.init_payment(
+                'mc', 200, 'Test', 'test@test.ru', '79091234567')
+            self.service.transaction_details(tid=1)
+            timeouts = [r.timeout for r in m.request_history]
+        self.assertEqual(timeouts, [(3, 20), (1, 5)])
+
+    def test_deadline_limits_timeout(self):
+        with requests_mock.mock() as m:
+            m.post(self.base_url + 'alba/refund/', json={'status': 'success'})
+            self.service.refund(1, deadline=0.5)
+            connect, read = m.request_history[0].timeout
+        self.assertLessEqual(connect, 0.5)
+        self.assertLessEqual(read, 0.5)
+
+    def test_timeout_error(self):
+        with requests_mock.mock() as m:
+            m.post(self.base_url + 'alba/details/', exc=requests.ReadTimeout)
+            with self.assertRaises(AlbaTimeoutError):
+                self.service.transaction_details(tid=1)
+
+    def test_expired_deadline(self):
+        with self.assertRaises(AlbaTimeoutError):
+            self.service.transaction_details(tid=1, deadline=0)
+
+    def test_slow_server(self):
+        server = StubServer({'status': 'success'}, delay=0.5)
+        self.addCleanup(server.stop)
+        service = AlbaService(
+            '10000', 'secret',
+            connection_profile=dict(self.service.connection_profile,
+                                    base_url=server.url))
+        started = time.time()
+        with self.assertRaises(AlbaTimeoutError):
+            service.gate_details('mc', deadline=0.1)
+        self.assertLess(time.time() - started, 0.4)
+
+    def test_retries_respect_deadline(self):
+        failover = Failover(
+            [{'base_url': 'https://a.example/'},
+             {'base_url': 'https://b.example/'}],
+            retry=RetryPolicy(attempts=5, backoff=10, max_backoff=10))
+        service = AlbaService('10000', 'secret', failover=failover)
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/details/', status_code=502)
+            m.post('https://b.example/alba/details/', status_code=502)
+            started = time.time()
+            with self.assertRaises(AlbaConnectionError):
+                service.transaction_details(tid=1, deadline=0.2)
+        self.assertLess(time.time() - started, 0.3)
+
+
+    def test_expired_deadline_not_counted_against_endpoint(self):
+        failover = Failover(
+            [{'base_url': 'https://a.example/'},
+             {'base_url': 'https://b.example/'}], failure_threshold=1)
+        service = AlbaService('10000', 'secret', failover=failover)
+        with requests_mock.mock() as m:
+            m.post('https://a.example/alba/details/',
+                   json={'status': 'success', 'tid': '1'})
+            for _ in range(6):
+                with self.assertRaises(AlbaTimeoutError):
+                    service.transaction_details(tid=1, deadline=0)
+            self.assertEqual(m.call_count, 0)
+            self.assertEqual(service.transaction_details(tid=1)['tid'], '1')
+        self.assertEqual(failover.health()['https://a.example/']['failures'],
+                         0)
+
+
+class BulkRefundTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.service = AlbaService('10000', 'secret')
+        self.url = self.service.connection_profile['base_url'] + 'alba/refund/'
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def refund_callback(self, request, context):
+        params = dict(pair.split('=') for pair in request.text.split('&'))
+        tid = params['tid']
+        if tid == '2':
+            return {'status': 'error', 'code': 'unique', 'msg': 'Done'}
+        if tid == '3':
+            return {'status': 'error', 'code': 'auth', 'msg': 'Auth'}
+        if tid == '4' and not self.recovered:
+            return {'status': 'error', 'msg': 'Temporary'}
+        return {'status': 'success', 'payback_id': int(tid) * 10}
+
+    def test_resumes_from_journal(self):
+        jobs = self.path('jobs.csv')
+        with open(jobs, 'w') as f:
+            f.write('tid,amount,reason,test\n')
+            for tid in range(1, 6):
+                f.write('{},100,Campaign,1\n'.format(tid))
+
+        self.recovered = False
+        with requests_mock.mock() as m:
+            m.post(self.url, json=self.refund_callback)
+            with Journal(self.path('journal')) as journal, \
+                    RecordWriter(self.path('results.jsonl'),
+                                 refunds.RESULT_FIELDS) as writer:
+                stats = refunds.BulkRefundRunner(
+                    self.service, journal, max_workers=2, rate=1000,
+                ).run(read_records(jobs), writer)
+        self.assertEqual(stats, {'ok': 2, 'unique': 1, 'auth': 1, 'error': 1})
+        results = {r['tid']: r for r in read_records(
+            self.path('results.jsonl'))}
+        self.assertEqual(results['5']['payback_id'], 50)
+        self.assertEqual(results['3']['status'], 'auth')
+
+        self.recovered = True
+        with requests_mock.mock() as m:
+            m.post(self.url, json=self.refund_callback)
+            with Journal(self.path('journal')) as journal:
+                stats = refunds.BulkRefundRunner(
+                    self.service, journal).run(read_records(jobs))
+            refunded = sorted(
+                dict(pair.split('=') for pair in r.text.split('&'))['tid']
+                for r in m.request_history)
+        self.assertEqual(refunded, ['3', '4'])
+        self.assertEqual(stats['skipped'], 3)
+
+    def test_duplicate_tid_refunded_once(self):
+        jobs = self.path('jobs.jsonl')
+        with open(jobs, 'w') as f:
+            f.write('{"tid": 1, "amount": 100}\n{"tid": 5}\n'
+                    '{"tid": "1", "amount": 100}\n')
+        self.recovered = True
+        with requests_mock.mock() as m:
+            m.post(self.url, json=self.refund_callback)
+            with Journal(self.path('journal')) as journal, \
+                    RecordWriter(self.path('results.jsonl'),
+                                 refunds.RESULT_FIELDS) as writer:
+                stats = refunds.BulkRefundRunner(
+                    self.service, journal).run(read_records(jobs), writer)
+            self.assertEqual(m.call_count, 2)
+        self.assertEqual(stats, {'ok': 2, 'duplicate': 1})
+        statuses = sorted(
+            r['status'] for r in read_records(self.path('results.jsonl')))
+        self.assertEqual(statuses, ['duplicate', 'ok', 'ok'])
+
+    def test_journal_ignores_partial_line(self):
+        with open(self.path('journal'), 'w') as f:
+            f.write('1\n2\n3')
+        with Journal(self.path('journal')) as journal:
+            self.assertIn('2', journal)
+            self.assertNotIn('3', journal)
+            journal.add(3)
+        with Journal(self.path('journal')) as journal:
+            self.assertEqual(len(journal), 3)
+
+    def test_cli(self):
+        jobs = self.path('jobs.jsonl')
+        with open(jobs, 'w') as f:
+            f.write('{"tid": 1, "amount": 100}\n{"tid": 5}\n')
+        self.recovered = True
+        with requests_mock.mock() as m:
+            m.post(self.url, json=self.refund_callback)
+            code = refunds.main([
+                '--service-id', '10000', '--secret', 'secret',
+                '--jobs', jobs, '--journal', self.path('journal'),
+                '--results', self.path('results.csv')])
+        self.assertEqual(code, 0)
+        with open(self.path('results.csv')) as f:
+            self.assertEqual(f.readline().strip(),
+                             'tid,status,payback_id,error')
+
+
+class RateLimiterTestCase(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertIsNone(bucket.reserve(max_wait=0.01))
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+
+    def test_blocking_policy(self):
+        limiter = RateLimiter(global_rate=50)
+        limiter.global_bucket.tokens = 0
+        started = time.time()
+        for _ in range(5):
+            limiter.acquire('10000', 'alba/details/')
+        self.assertGreaterEqual(time.time() - started, 0.08)
+        self.assertEqual(limiter.stats.acquired, 5)
+        self.assertEqual(limiter.stats.waited, 5)
+        self.assertGreater(limiter.stats.max_wait, 0)
+
+    def test_fail_fast_policy_with_weights(self):
+        limiter = RateLimiter(default_service_rate=2, policy=FAIL,
+                              weights={'alba/input/': 2})
+        limiter.acquire('10000', 'alba/input/')
+        with self.assertRaises(AlbaRateLimitError):
+            limiter.acquire('10000', 'alba/details/')
+        limiter.acquire('10001', 'alba/details/')
+        self.assertEqual(limiter.stats.rejected, 1)
+
+    def test_global_limit_shared_by_services(self):
+        limiter = RateLimiter(global_rate=1, service_rates={'10000': 100},
+                              policy=FAIL)
+        first = AlbaService('10000', 'secret', rate_limiter=limiter)
+        second = AlbaService('10001', 'secret', rate_limiter=limiter)
+        with requests_mock.mock() as m:
+            m.post(first.connection_profile['base_url'] + 'alba/details/',
+                   json={'status': 'success'})
+            first.transaction_details(tid=1)
+            with self.assertRaises(AlbaRateLimitError):
+                second.transaction_details(tid=2)
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(limiter.service_buckets['10000'].tokens, 99)
+
+    def test_max_wait_respects_deadline(self):
+        limiter = RateLimiter(global_rate=1)
+        limiter.global_bucket.tokens = 0
+        service = AlbaService('10000', 'secret', rate_limiter=limiter)
+        with self.assertRaises(AlbaRateLimitError):
+            service.transaction_details(tid=1, deadline=0.1)
+
+
+class ServiceRegistryTestCase(TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.secrets = {'10000': 'secret', '10001': 'other'}
+
+    def loader(self, service_id):
+        self.loaded.append(service_id)
+        time.sleep(0.05)
+        if service_id in self.secrets:
+            return AlbaService(service_id, self.secrets[service_id])
+
+    def test_callback_loads_only_needed_service(self):
+        callback = RecordingCallback(registry=ServiceRegistry(self.loader))
+        service = AlbaService('10001', 'other')
+        callback.handle(signed_post(service, tid='1', command='success'))
+        callback.handle(signed_post(service, tid='2', command='success'))
+        self.assertEqual(self.loaded, ['10001'])
+        self.assertEqual(callback.calls, ['1', '2'])
+
+    def test_unknown_service(self):
+        callback = RecordingCallback(registry=ServiceRegistry(self.loader))
+        with self.assertRaises(AlbaException):
+            callback.handle(signed_post(AlbaService('1', 'x'), tid='1',
+                                        command='success'))
+
+    def test_unknown_service_cached(self):
+        registry = ServiceRegistry(self.loader, negative_ttl=60)
+        for _ in range(3):
+            self.assertIsNone(registry.get('1'))
+        self.assertEqual(self.loaded, ['1'])
+        self.secrets['1'] = 'new'
+        registry.invalidate('1')
+        self.assertEqual(registry.get('1').secret, 'new')
+
+    def test_concurrent_lookups_coalesced(self):
+        registry = ServiceRegistry(self.loader)
+        results = list(run_concurrently(
+            lambda _: registry.get(10000), range(8), max_workers=8))
+        self.assertEqual(self.loaded, ['10000'])
+        self.assertEqual(len({id(r.result) for r in results}), 1)
+        self.assertEqual(registry.flight.executed, 1)
+        self.assertEqual(registry.flight.collapsed, 7)
+
+    def test_ttl_reloads_rotated_secret(self):
+        registry = ServiceRegistry(self.loader, ttl=0)
+        self.assertEqual(registry.get('10000').secret, 'secret')
+        self.secrets['10000'] = 'rotated'
+        time.sleep(0.01)
+        self.assertEqual(registry.get('10000').secret, 'rotated')
+
+    def test_lru_eviction(self):
+        registry = ServiceRegistry(self.loader, maxsize=1)
+        registry.get('10000')
+        registry.get('10001')
+        registry.get('10000')
+        self.assertEqual(self.loaded, ['10000', '10001', '10000'])
+
+    def test_singleflight_shares_exception(self):
+        flight = SingleFlight()
+
+        def fail():
+            time.sleep(0.05)
+            raise AuthError('Auth')
+
+        results = list(run_concurrently(
+            lambda _: flight.do('key', fail), range(3), max_workers=3))
+        self.assertTrue(all(isinstance(r.error, AuthError) for r in results))
+        self.assertEqual(flight.executed + flight.collapsed, 3)
+
+
+class ReconcileTestCase(TestCase):
+    alba = {
+        '1': {'cost': '100.00', 'income_total': 95,
+              'transaction_status': 'payed'},
+        '2': {'cost': '200.00', 'income_total': 190,
+              'transaction_status': 'refunded'},
+        '3': {'cost': '300', 'income_total': 285,
+              'transaction_status': 'payed'},
+    }
+
+    def details_callback(self, request, context):
+        params = dict(pair.split('=') for pair in request.text.split('&'))
+        details = self.alba.get(params['order_id'])
+        if details is None:
+            return {'status': 'error', 'msg': 'Not found'}
+        return dict(details, status='success')
+
+    def test_streams_mismatches(self):
+        service = AlbaService('10000', 'secret')
+        ledger = [
+            {'order_id': '1', 'cost': '100', 'income': '95',
+             'status': 'payed'},
+            {'order_id': '2', 'cost': '200', 'income': '190',
+             'status': 'payed'},
+            {'order_id': '3', 'cost': '300.5', 'status': 'payed'},
+            {'order_id': '4', 'cost': '10', 'status': 'payed'},
+        ]
+        reconciler = reconcile.Reconciler(service, max_workers=2)
+        with requests_mock.mock() as m:
+            m.post(service.connection_profile['base_url'] + 'alba/details/',
+                   json=self.details_callback)
+            mismatches = {mismatch.row['order_id']: mismatch
+                          for mismatch in reconciler.run(iter(ledger))}
+        self.assertEqual(sorted(mismatches), ['2', '3', '4'])
+        self.assertEqual(mismatches['2'].differences,
+                         {'status': ('payed', 'refunded')})
+        self.assertEqual(mismatches['3'].differences,
+                         {'cost': ('300.5', '300')})
+        self.assertIsInstance(mismatches['4'].error, AlbaException)
+        stats = reconciler.stats.as_dict()
+        self.assertEqual((stats['rows'], stats['matched'],
+                          stats['mismatched'], stats['errors']),
+                         (4, 1, 2, 1))
+        self.assertGreater(stats['rows_per_second'], 0)
+
+
+class CardTokenBatchTestCase(TestCase):
+    def setUp(self):
+        self.service = AlbaService('10000', 'secret')
+        self.url = self.service._url('create', 'card_token_test_url')
+
+    def token_callback(self, request, context):
+        params = dict(pair.split('=') for pair in request.text.split('&'))
+        if params['cvc'] == '000':
+            return {'status': 'error', 'msg': 'Invalid cvc'}
+        return {'status': 'success', 'token': 'token-' + params['card'][-4:]}
+
+    def test_create_card_tokens(self):
+        cards = [
+            {'card': '4300000000000777', 'exp_month': '1',
+             'exp_year': '22', 'cvc': '123'},
+            {'card': '4300000000000888', 'exp_month': '12',
+             'exp_year': '22', 'cvc': '000', 'card_holder': 'Name'},
+        ]
+        with requests_mock.mock() as m:
+            m.post(self.url, json=self.token_callback)
+            results = {r.item['card']: r for r in
+                       self.service.create_card_tokens(cards, test=True)}
+        self.assertEqual(results['4300000000000777'].result, 'token-0777')
+        self.assertIsInstance(results['4300000000000888'].error,
+                              AlbaException)
+
+    def test_card_data_not_logged(self):
+        with requests_mock.mock() as m:
+            m.post(self.url, json={'status': 'success', 'token': 'test'})
+            with self.assertLogs('alba_client.service', 'DEBUG') as logs:
+                self.service.create_card_token(
+                    '4300000000000777', '1', '22', '987', test=True)
+        output = '\n'.join(logs.output)
+        self.assertNotIn('4300000000000777', output)
+        self.assertNotIn('987', output)
+        self.assertIn('430000******0777', output)
+
+
+class RecurrentSchedulerTestCase(TestCase):
+    def setUp(self):
+        self.service = AlbaService('10000', 'secret')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        base_url = self.service.connection_profile['base_url']
+        self.input_url = base_url + 'alba/input/'
+        self.cancel_url = base_url + 'alba/recurrent_change/'
+
+    def subscriptions(self):
+        for number in range(1, 5):
+            yield {'id': 'sub-{}'.format(number),
+                   'recurrent_order_id': number, 'pay_type': 'spg',
+                   'cost': 100, 'name': 'Subscription',
+                   'email': 'test@test.ru', 'phone': '79091234567',
+                   'card_token': 'token', 'cancelled': number == 4}
+
+    def input_callback(self, request, context):
+        if 'card_token=token' not in request.text:
+            return {'status': 'error', 'msg': 'No token'}
+        return {'status': 'success', 'tid': 1}
+
+    def test_run_with_journal(self):
+        journal_path = os.path.join(self.directory, 'journal')
+        with requests_mock.mock() as m:
+            m.post(self.input_url, json=self.input_callback)
+            m.post(self.cancel_url, json={'status': 'success'})
+            with Journal(journal_path) as journal:
+                scheduler = RecurrentScheduler(
+                    self.service, journal, max_workers=3, rate=1000)
+                results = list(scheduler.run(self.subscriptions()))
+            self.assertEqual(len(results), 4)
+            self.assertEqual(scheduler.stats, {'charge': 3, 'cancel': 1})
+            cancelled = [r for r in results if r.action == 'cancel']
+            self.assertEqual(cancelled[0].subscription['id'], 'sub-4')
+
+            with Journal(journal_path) as journal:
+                scheduler = RecurrentScheduler(self.service, journal)
+                self.assertEqual(list(scheduler.run(self.subscriptions())),
+                                 [])
+            self.assertEqual(scheduler.stats['skipped'], 4)
+            self.assertEqual(m.call_count, 4)
+
+    def test_errors_are_reported(self):
+        subscription = dict(next(self.subscriptions()), card_token=None)
+        with requests_mock.mock() as m:
+            m.post(self.input_url, json=self.input_callback)
+            scheduler = RecurrentScheduler(self.service)
+            result, = scheduler.run([subscription])
+        self.assertIsInstance(result.error, AlbaException)
+        self.assertEqual(scheduler.stats['error'], 1)
+
+    def test_unique_error_is_journaled(self):
+        journal_path = os.path.join(self.directory, 'journal')
+        subscription = dict(next(self.subscriptions()), order_id='sub-1-10')
+        with requests_mock.mock() as m:
+            m.post(self.input_url, json={'status': 'error', 'code': 'unique',
+                                         'msg': 'Заказ уже существует'})
+            for _ in range(2):
+                with Journal(journal_path) as journal:
+                    scheduler = RecurrentScheduler(self.service, journal)
+                    list(scheduler.run([subscription]))
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(scheduler.stats, {'skipped': 1})
+
+
+class SlowCallback(RecordingCallback):
+    def __init__(self, *args, **kwargs):
+        super(SlowCallback, self).__init__(*args, **kwargs)
+        self.release = threading.Event()
+
+    def callback_success(self, data):
+        self.release.wait(1)
+        super(SlowCallback, self).callback_success(data)
+
+
+class WebhookTestCase(TestCase):
+    def setUp(self):
+        self.service = AlbaService('10000', 'secret')
+
+    def wsgi_request(self, app, body, method='POST', path='/'):
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        }
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+
+        response['body'] = b''.join(app(environ, start_response))
+        return response
+
+    def body(self, **fields):
+        return urlencode(signed_post(self.service, **fields)).encode('utf-8')
+
+    def test_wsgi_acknowledges_and_dispatches(self):
+        callback = RecordingCallback([self.service])
+        app = webhook.WSGICallbackApp(callback, workers=2)
+        self.addCleanup(app.queue.stop)
+        response = self.wsgi_request(
+            app, self.body(tid='1', command='success'))
+        self.assertEqual(response['status'], '200 OK')
+        app.queue.join()
+        self.assertEqual(callback.calls, ['1'])
+        self.assertEqual(app.queue.metrics()['processed'], 1)
+
+    def test_wsgi_rejects_bad_sign(self):
+        app = webhook.WSGICallbackApp(RecordingCallback([self.service]))
+        self.addCleanup(app.queue.stop)
+        response = self.wsgi_request(app, b'service_id=10000&check=bad')
+        self.assertEqual(response['status'], '400 Bad Request')
+
+    def test_wsgi_rejects_malformed_body(self):
+        app = webhook.WSGICallbackApp(RecordingCallback([self.service]))
+        self.addCleanup(app.queue.stop)
+        for body in (b'service_id=10000&command=success', b'service_id=\xff'):
+            response = self.wsgi_request(app, body)
+            self.assertEqual(response['status'], '400 Bad Request')
+
+    def test_overflow_reject(self):
+        callback = SlowCallback([self.service])
+        app = webhook.WSGICallbackApp(callback, maxsize=1, workers=1)
+        self.addCleanup(app.queue.stop)
+        statuses = [self.wsgi_request(
+            app, self.body(tid=text_type(tid), command='success'))['status']
+            for tid in range(4)]
+        callback.release.set()
+        app.queue.join()
+        self.assertIn('503 Service Unavailable', statuses)
+        metrics = json.loads(self.wsgi_request(
+            app, b'', method='GET', path='/metrics')['body'].decode('utf-8'))
+        self.assertEqual(metrics['rejected'],
+                         statuses.count('503 Service Unavailable'))
+        self.assertEqual(metrics['depth'], 0)
+
+    def test_overflow_drop_oldest(self):
+        callback = SlowCallback([self.service])
+        queue = webhook.CallbackQueue(callback, maxsize=1, workers=1,
+                                      overflow=webhook.DROP_OLDEST)
+        self.addCleanup(queue.stop)
+        with self.assertLogs('alba_client.webhook', 'ERROR') as logs:
+            for tid in range(4):
+                self.assertTrue(queue.put(
+                    signed_post(self.service, tid=text_type(tid),
+                                command='success')))
+        callback.release.set()
+        queue.join()
+        self.assertEqual(callback.calls[-1], '3')
+        self.assertGreater(queue.metrics()['dropped'], 0)
+        self.assertEqual(len(logs.records), queue.metrics()['dropped'])
+
+    def test_workers_started_lazily(self):
+        callback = RecordingCallback([self.service])
+        queue = webhook.CallbackQueue(callback, workers=2)
+        self.addCleanup(queue.stop)
+        self.assertEqual(queue._threads, [])
+        queue.put(signed_post(self.service, tid='1', command='success'))
+        self.assertEqual(len(queue._threads), 2)
+        queue.join()
+        # после fork процесс запускает свои потоки и свою очередь
+        inherited = queue.queue
+        queue._pid = -1
+        queue.put(signed_post(self.service, tid='2', command='success'))
+        queue.join()
+        self.assertIsNot(queue.queue, inherited)
+        self.assertEqual(callback.calls, ['1', '2'])
+        self.assertEqual(queue.metrics()['accepted'], 1)
+        for _ in range(2):
+            inherited.put(None)
+
+
+class TransportTestCase(TestCase):
+    def make_service(self, transport, base_url):
+        profile = dict(AlbaService.FIRST_CONNECTION_PROFILE,
+                       base_url=base_url)
+        return AlbaService('10000', 'secret', connection_profile=profile,
+                           transport=transport)
+
+    def check_transport(self, transport):
+        server = StubServer({'status': 'success', 'tid': 100})
+        try:
+            service = self.make_service(transport, server.url)
+            service.init_payment('mc', 200, 'Test', 'test@test.ru', '7909')
+            service.gate_details('mc')
+        finally:
+            service.close()
+            server.stop()
+        method, path, body = server.requests[0]
+        self.assertEqual((method, path), ('POST', '/alba/input/'))
+        post = dict(pair.split('=') for pair in body.decode().split('&'))
+        self.assertEqual(post['email'], quote('test@test.ru'))
+        self.assertIn('check', post)
+        method, path, body = server.requests[1]
+        self.assertEqual(method, 'GET')
+        self.assertTrue(path.startswith('/alba/gate_details/?'))
+        self.assertIn('gate=mc', path)
+
+    def check_timeout(self, transport):
+        server = StubServer({'status': 'success'}, delay=0.5)
+        try:
+            service = self.make_service(transport, server.url)
+            service.timeout = (1, 0.05)
+            with self.assertRaises(AlbaTimeoutError):
+                service.transaction_details(tid=1)
+        finally:
+            service.close()
+            server.stop()
+
+    def test_urllib3_transport(self):
+        self.check_transport(Urllib3Transport())
+        self.check_timeout(Urllib3Transport())
+
+    def test_urllib3_connection_error(self):
+        service = self.make_service(Urllib3Transport(),
+                                    'http://127.0.0.1:1/')
+        with self.assertRaises(AlbaConnectionError) as e:
+            service.transaction_details(tid=1)
+        self.assertNotIsInstance(e.exception, AlbaTimeoutError)
+
+    def test_httpx_transport(self):
+        try:
+            transport = HTTPXTransport(http2=False)
+        except ImportError:
+            self.skipTest('httpx is not installed')
+        self.check_transport(transport)
+        self.check_timeout(HTTPXTransport(http2=False))
+
+    def test_memory_transport(self):
+        transport = MemoryTransport(
+            handler=lambda method, url, data: (
+                200, {'status': 'success', 'tid': data['tid']}))
+        service = AlbaService('10000', 'secret', transport=transport)
+        self.assertEqual(service.transaction_details(tid=5)['tid'], 5)
+        method, url, data = transport.requests[0]
+        self.assertEqual(url, service._url('alba/details/'))
+        self.assertIn('check', data)
+
+    def test_memory_transport_missing_url(self):
+        service = AlbaService('10000', 'secret',
+                              transport=MemoryTransport())
+        with self.assertRaises(AlbaConnectionError):
+            service.refund(1)
+
+
+class CoalescingTestCase(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.transport = MemoryTransport(handler=self.handler)
+        self.service = AlbaService('10000', 'secret',
+                                   transport=self.transport,
+                                   singleflight=SingleFlight())
+
+    def handler(self, method, url, data):
+        self.calls.append(url)
+        time.sleep(0.05)
+        if data and data.get('tid') == 'slow':
+            self.release.wait(1)
+        if data and data.get('tid') == 'bad':
+            return 200, {'status': 'error', 'code': 'auth', 'msg': 'Auth'}
+        return 200, {'status': 'success', 'tid': 1, 'types': ['mc']}
+
+    def test_transaction_details_coalesced(self):
+        results = list(run_concurrently(
+            lambda _: self.service.transaction_details(tid=1), range(8),
+            max_workers=8))
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(all(r.result['tid'] == 1 for r in results))
+        flight = self.service.singleflight
+        self.assertEqual((flight.executed, flight.collapsed), (1, 7))
+
+    def test_different_keys_not_coalesced(self):
+        list(run_concurrently(
+            lambda tid: self.service.transaction_details(tid=tid),
+            [1, 2], max_workers=2))
+        list(run_concurrently(
+            lambda gate: self.service.gate_details(gate),
+            ['mc', 'mc', 'spg'], max_workers=3))
+        self.assertEqual(len(self.calls), 4)
+
+    def test_shared_exception(self):
+        results = list(run_concurrently(
+            lambda _: self.service.transaction_details(tid='bad'), range(4),
+            max_workers=4))
+        self.assertTrue(all(isinstance(r.error, AuthError)
+                            for r in results))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_joined_call_respects_deadline(self):
+        leader = threading.Thread(
+            target=self.service.transaction_details, kwargs={'tid': 'slow'})
+        leader.start()
+        self.addCleanup(leader.join)
+        self.addCleanup(self.release.set)
+        while not self.calls:
+            time.sleep(0.01)
+        started = time.time()
+        with self.assertRaises(AlbaTimeoutError):
+            self.service.transaction_details(tid='slow', deadline=0.05)
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_pay_types_coalesced_with_cache(self):
+        self.service.cache = MetadataCache()
+        results = list(run_concurrently(
+            lambda _: self.service.pay_types(), range(4), max_workers=4))
+        self.assertEqual([r.result for r in results], [['mc']] * 4)
+        self.assertEqual(len(self.calls), 1)
+
+
+class StatusWatcherTestCase(TestCase):
+    def setUp(self):
+        self.statuses = {}
+        self.polls = []
+        self.service = AlbaService(
+            '10000', 'secret', transport=MemoryTransport(handler=self.handler))
+        self.watcher = StatusWatcher(self.service, min_interval=0.01,
+                                     max_interval=0.02, timeout=5)
+        self.addCleanup(self.watcher.stop)
+
+    def handler(self, method, url, data):
+        tid = data['tid']
+        self.polls.append(tid)
+        statuses = self.statuses[tid]
+        if statuses == 'auth':
+            return 200, {'status': 'error', 'code': 'auth', 'msg': 'Auth'}
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        return 200, {'status': 'success', 'tid': tid,
+                     'transaction_status': status}
+
+    def test_polls_until_terminal_status(self):
+        self.statuses = {'1': ['open', 'open', 'payed'], '2': ['refunded']}
+        done = []
+        first = self.watcher.watch(1, callback=done.append)
+        second = self.watcher.watch('2')
+        self.assertIs(self.watcher.watch('1'), first)
+        self.assertEqual(first.result(2)['transaction_status'], 'payed')
+        self.assertEqual(second.result(2)['transaction_status'], 'refunded')
+        self.assertEqual(done, [first])
+        self.assertEqual(self.polls.count('1'), 3)
+        self.assertEqual(self.watcher.stats['resolved'], 2)
+        self.assertEqual(len(self.watcher), 0)
+
+    def test_callback_stops_polling(self):
+        self.statuses = {'1': ['open']}
+        callback = RecordingCallback([self.service], watcher=self.watcher)
+        future = self.watcher.watch('1')
+        time.sleep(0.05)
+        post = signed_post(self.service, tid='1', command='success')
+        callback.handle(post)
+        self.assertEqual(future.result(1), post)
+        polls = len(self.polls)
+        time.sleep(0.1)
+        self.assertEqual(len(self.polls), polls)
+        self.assertEqual(self.watcher.stats['notified'], 1)
+
+    def test_process_notification_keeps_polling(self):
+        self.statuses = {'1': ['open', 'open', 'payed']}
+        future = self.watcher.watch('1')
+        self.watcher.notify({'tid': '1', 'command': 'process'})
+        self.assertEqual(future.result(2)['transaction_status'], 'payed')
+
+    def test_timeout(self):
+        self.statuses = {'1': ['open']}
+        self.watcher.timeout = 0.05
+        future = self.watcher.watch('1')
+        with self.assertRaises(AlbaTimeoutError):
+            future.result(2)
+
+    def test_business_error(self):
+        self.statuses = {'1': 'auth'}
+        with self.assertRaises(AuthError):
+            self.watcher.watch('1').result(2)
+
+    def test_stop_cancels_pending(self):
+        self.statuses = {'1': ['open']}
+        future = self.watcher.watch('1')
+        self.watcher.stop()
+        self.assertTrue(future.cancelled())
+
+
+class FakeGatewayTestCase(TestCase):
+    def setUp(self):
+        self.callback = RecordingCallback([AlbaService('10000', 'secret')])
+        self.gateway = FakeGateway({'10000': 'secret'}, pay_delay=0.01,
+                                   callback=self.callback.handle).start()
+        self.addCleanup(self.gateway.stop)
+        self.service = AlbaService('10000', 'secret',
+                                   connection_profile=self.gateway.profile)
+
+    def test_payment_flow(self):
+        response = self.service.init_payment(
+            'mc', 200, 'Test', 'test@test.ru', '79091234567', order_id='1')
+        future = StatusWatcher(self.service, min_interval=0.01).watch(
+            response['tid'])
+        self.assertEqual(future.result(2)['transaction_status'], 'payed')
+        self.assertEqual(self.callback.calls, [response['tid']])
+        self.service.refund(response['tid'])
+        details = self.service.transaction_details(order_id='1')
+        self.assertEqual(details['transaction_status'], 'refunded')
+        with self.assertRaises(UniqueError):
+            self.service.init_payment(
+                'mc', 200, 'Test', 'test@test.ru', '7909', order_id='1')
+
+    def test_metadata_and_card_token(self):
+        self.assertIn('mc', self.service.pay_types())
+        self.assertEqual(self.service.gate_details('mc')['name'], 'mc')
+        self.assertTrue(self.service.create_card_token(
+            '4300000000000777', '1', '22', '123', test=True))
+        self.service.cancel_recurrent_payment('1')
+
+    def test_wrong_secret(self):
+        service = AlbaService('10000', 'other',
+                              connection_profile=self.gateway.profile)
+        with self.assertRaises(AuthError):
+            service.transaction_details(tid=1)
+        with self.assertRaises(AuthError):
+            service.pay_types()
+        self.assertEqual(self.gateway.stats['error.auth'], 2)
+
+    def test_injected_errors_in_memory(self):
+        gateway = FakeGateway({'10000': 'secret'},
+                              error_rates={'unique': 1.0})
+        service = AlbaService('10000', 'secret',
+                              transport=gateway.transport())
+        with self.assertRaises(UniqueError):
+            service.init_payment('mc', 200, 'Test', 'test@test.ru', '7909')
+        gateway.error_rates = {}
+        self.assertEqual(service.init_payment(
+            'mc', 200, 'Test', 'test@test.ru', '7909')['status'], 'success')
+
+
+class FakeSpan(object):
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.exceptions = []
+        self.ended = False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, error):
+        self.exceptions.append(error)
+
+    def end(self):
+        self.ended = True
+
+
+class FakeTracer(object):
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, attributes=None):
+        self.spans.append(FakeSpan(name, attributes or {}))
+        return self.spans[-1]
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.service = AlbaService('10000', 'secret', hooks=[self.metrics],
+                                   transport=MemoryTransport())
+        self.responses = self.service.transport.responses
+        self.details_url = self.service._url('alba/details/')
+
+    def test_request_metrics(self):
+        self.responses[self.details_url] = (
+            200, {'status': 'success', 'tid': 1})
+        self.service.transaction_details(tid=1)
+        self.responses[self.details_url] = (
+            200, {'status': 'error', 'code': 'auth', 'msg': 'Auth'})
+        with self.assertRaises(AuthError) as e:
+            self.service.transaction_details(tid=1)
+        self.assertEqual(e.exception.code, 'auth')
+        with self.assertRaises(AlbaConnectionError):
+            self.service.refund(1)
+
+        metrics = self.metrics
+        self.assertEqual(metrics.requests['alba/details/', 'ok'], 1)
+        self.assertEqual(metrics.requests['alba/details/', 'auth'], 1)
+        self.assertEqual(metrics.requests['alba/refund/', 'connection'], 1)
+        self.assertEqual(metrics.latency['alba/details/'].count, 2)
+        self.assertGreater(metrics.bytes_sent['alba/details/'], 0)
+        self.assertGreater(metrics.bytes_received['alba/details/'], 0)
+        self.assertGreater(metrics.sign_seconds['alba/details/'], 0)
+
+        text = metrics.prometheus()
+        self.assertIn('# TYPE alba_request_duration_seconds histogram', text)
+        self.assertIn('alba_requests_total{code="auth",'
+                      'endpoint="alba/details/"} 1', text)
+        self.assertIn('alba_request_duration_seconds_bucket{'
+                      'endpoint="alba/details/",le="+Inf"} 2', text)
+
+    def test_callback_metrics(self):
+        callback = RecordingCallback([self.service], hooks=[self.metrics])
+        callback.handle(signed_post(self.service, tid='1',
+                                    command='success'))
+        with self.assertRaises(AlbaException):
+            callback.handle({'service_id': '10000', 'command': 'success',
+                             'check': 'bad'})
+        self.assertEqual(self.metrics.callbacks['success', 'ok'], 1)
+        self.assertEqual(self.metrics.callbacks['success', 'unknown'], 1)
+        self.assertIn('alba_callbacks_total', self.metrics.prometheus())
+
+    def test_forged_commands_share_series(self):
+        callback = RecordingCallback([self.service], hooks=[self.metrics])
+        for number in range(20):
+            with self.assertRaises(AlbaException):
+                callback.handle({'service_id': '10000', 'check': 'bad',
+                                 'command': 'forged-{}'.format(number)})
+        self.assertEqual(list(self.metrics.callback_latency), ['other'])
+        self.assertEqual(self.metrics.callbacks['other', 'unknown'], 20)
+
+    def test_webhook_callback_metrics(self):
+        callback = RecordingCallback([self.service], hooks=[self.metrics])
+        app = webhook.WSGICallbackApp(callback, workers=1)
+        self.addCleanup(app.queue.stop)
+        body = urlencode(signed_post(self.service, tid='1',
+                                     command='success')).encode('utf-8')
+        app.process('POST', '/', body)
+        app.process('POST', '/', b'service_id=10000&check=bad')
+        app.queue.join()
+        self.assertEqual(self.metrics.callbacks['success', 'ok'], 1)
+        self.assertEqual(self.metrics.callbacks['other', 'unknown'], 1)
+
+    def test_tracing_spans(self):
+        tracer = FakeTracer()
+        self.service.add_hook(TracingHook(tracer))
+        self.responses[self.details_url] = (
+            200, {'status': 'error', 'code': 'unique', 'msg': 'Dup'})
+        with self.assertRaises(UniqueError):
+            self.service.transaction_details(tid=1)
+        span, = tracer.spans
+        self.assertEqual(span.name, 'alba alba/details/')
+        self.assertEqual(span.attributes['alba.code'], 'unique')
+        self.assertTrue(span.ended)
+        self.assertEqual(len(span.exceptions), 1)
+        self.assertEqual(self.metrics.requests['alba/details/', 'unique'], 1)
+
+    def test_no_events_without_hooks(self):
+        class FailingHook(Hook):
+            def request_started(self, event):
+                raise AssertionError('hook called')
+
+        service = AlbaService(
+            '10000', 'secret', transport=MemoryTransport(
+                {self.details_url: (200, {'status': 'success'})}))
+        self.assertIsNone(service.hooks)
+        service.transaction_details(tid=1)
+        service.add_hook(FailingHook())
+        with self.assertRaises(AssertionError):
+            service.transaction_details(tid=1)
+
+
+class RequestLoggingTestCase(TestCase):
+    def make_service(self, **kwargs):
+        transport = MemoryTransport(handler=lambda method, url, data: (
+            200, {'status': 'success', 'token': 'test', 'card': data.get(
+                'card'), 'payload': 'x' * 100}))
+        return AlbaService('10000', 'secret', transport=transport,
+                           request_logger=RequestLogger(**kwargs))
+
+    def test_redaction_and_body_cap(self):
+        service = self.make_service(max_body=40)
+        with self.assertLogs('alba_client.service', 'DEBUG') as logs:
+            service.create_card_token('4300000000000777', '1', '22', '987',
+                                      test=True)
+            service.refund(1)
+        output = '\n'.join(logs.output)
+        self.assertNotIn('4300000000000777', output)
+        self.assertNotIn('987', output)
+        self.assertIn('430000******0777', output)
+        self.assertNotIn('x' * 50, output)
+        self.assertIn('chars)', output)
+        self.assertEqual(logs.records[-2].alba['endpoint'], 'alba/refund/')
+        self.assertIn("'check': '***'", logs.records[-2].getMessage())
+
+    def test_sampling(self):
+        service = self.make_service(sample_rates={'alba/details/': 0})
+        with self.assertLogs('alba_client.service', 'DEBUG') as logs:
+            service.transaction_details(tid=1)
+            service.refund(1)
+        endpoints = {record.alba['endpoint'] for record in logs.records}
+        self.assertEqual(endpoints, {'alba/refund/'})
+
+    def test_nothing_built_when_debug_disabled(self):
+        logger = RequestLogger()
+        level = logger.logger.level
+        logger.logger.setLevel('INFO')
+        self.addCleanup(logger.logger.setLevel, level)
+        self.assertIsNone(logger.sent('post', 'https://x/alba/input/', {}))
+        self.assertEqual(logger._endpoints, {})
+
+
+class TypedResultTestCase(TestCase):
+    def setUp(self):
+        self.service = AlbaService('10000', 'secret', typed=True)
+
+    def test_transaction_details(self):
+        with requests_mock.mock() as m:
+            m.post(self.service._url('alba/details/'), json={
+                'status': 'success', 'tid': 100, 'cost': '10.10',
+                'transaction_status': 'payed', 'extra_field': 'x'})
+            details = self.service.transaction_details(tid=100)
+        self.assertIsInstance(details, Transaction)
+        self.assertEqual(details.cost, Decimal('10.10'))
+        self.assertEqual(details.transaction_status, 'payed')
+        self.assertIsNone(details.income_total)
+        self.assertEqual(details['extra_field'], 'x')
+        self.assertEqual(details['cost'], '10.10')
+        self.assertEqual(details.raw['tid'], 100)
+        self.assertFalse(hasattr(details, '__dict__'))
+
+    def test_dict_compatibility(self):
+        data = {'status': 'success', 'name': 'Gate', 'percent': '2.5'}
+        details = GateDetails(data)
+        self.assertEqual(details, data)
+        self.assertEqual(details.raw, data)
+        self.assertIn('name', details)
+        self.assertNotIn('tid', details)
+        self.assertEqual(details.get('tid', 1), 1)
+        self.assertEqual(details.percent, Decimal('2.5'))
+        with self.assertRaises(KeyError):
+            details['tid']
+
+    def test_pay_types_and_card_token(self):
+        with requests_mock.mock() as m:
+            m.get(self.service._pay_types_url(), json={
+                'status': 'success',
+                'types': [{'type': 'mc', 'name': 'Card'}, 'qiwi']})
+            m.post(self.service._url('create', 'card_token_url'),
+                   json={'status': 'success', 'token': 'test'})
+            types = self.service.pay_types()
+            token = self.service.create_card_token(
+                '4300000000000777', '1', '22', '123', test=False)
+        self.assertIsInstance(types[0], PayType)
+        self.assertEqual(types[0].type, 'mc')
+        self.assertEqual(types[1], 'qiwi')
+        self.assertEqual(token.token, 'test')
+
+    def test_cache_keeps_raw_dicts(self):
+        self.service.cache = MetadataCache()
+        with requests_mock.mock() as m:
+            m.get(self.service._url('alba/gate_details/'), json={
+                'status': 'success', 'name': 'Gate', 'percent': '1'})
+            first = self.service.gate_details('mc')
+            second = self.service.gate_details('mc')
+        self.assertEqual(m.call_count, 1)
+        self.assertIsInstance(second, GateDetails)
+        self.assertEqual(first, second)
+        self.assertIsInstance(self.service.cache.gate_details.lookup(
+            self.service._gate_details_key('mc'))[0], dict)
+
+
+class LightweightImportTestCase(TestCase):
+    def test_callback_path_without_third_party_modules(self):
+        code = (
+            'import sys\n'
+            'from alba_client import AlbaCallback, check_callback_sign, sign\n'
+            'from alba_client.webhook import WSGICallbackApp\n'
+            'heavy = {"requests", "six", "urllib3"} & set(sys.modules)\n'
+            'assert not heavy, heavy\n'
+            'from alba_client import AlbaService\n'
+            'assert "requests" in sys.modules\n')
+        subprocess.check_call([sys.executable, '-c', code], env=dict(
+            os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__)))))
+
+    def test_check_callback_sign_function(self):
+        post = signed_post(AlbaService('10000', 'secret'), tid='1',
+                           command='success')
+        self.assertTrue(check_callback_sign(post, 'secret'))
+        self.assertFalse(check_callback_sign(post, 'other'))
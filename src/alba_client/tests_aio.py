@@ -0,0 +1,308 @@
+# Тесты с корутинами (Python 3.7+) отдельно от tests.py, который должен
+# разбираться и в Python 2:
+#     python -m pytest alba_client/tests.py alba_client/tests_aio.py
+import asyncio
+import json
+import time
+from decimal import Decimal
+from unittest import TestCase, skipIf
+
+from six.moves.urllib.parse import urlencode
+
+from alba_client import AlbaService, AlbaException
+from alba_client.cache import MetadataCache
+from alba_client.exceptions import AlbaTimeoutError, AuthError
+from alba_client.failover import CircuitBreaker, Failover
+from alba_client.models import Transaction
+from alba_client.ratelimit import RateLimiter
+from alba_client.metrics import Metrics
+from alba_client.singleflight import SingleFlight
+from alba_client.tests import RecordingCallback, StubServer, signed_post
+
+try:
+    import aiohttp
+    from alba_client.aio import (
+        AsyncAlbaService, AsyncConnectionPool, _encode_params, acquire_async)
+    from alba_client.asgi import ASGICallbackApp
+except ImportError:
+    aiohttp = None
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncRateLimiterTestCase(TestCase):
+    def test_acquire_async(self):
+        limiter = RateLimiter(global_rate=100)
+        limiter.global_bucket.tokens = 0
+
+        async def acquire_many():
+            await asyncio.gather(*[
+                acquire_async(limiter, '10000', 'alba/details/')
+                for _ in range(3)])
+
+        started = time.time()
+        asyncio.run(acquire_many())
+        self.assertGreaterEqual(time.time() - started, 0.025)
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class ASGICallbackAppTestCase(TestCase):
+    def setUp(self):
+        self.service = AlbaService('10000', 'secret')
+
+    def body(self, **fields):
+        return urlencode(signed_post(self.service, **fields)).encode('utf-8')
+
+    def test_asgi(self):
+        callback = RecordingCallback([self.service])
+        app = ASGICallbackApp(callback, workers=2)
+        sent = []
+
+        async def request(body):
+            messages = [{'type': 'http.request', 'body': body}]
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            await app({'type': 'http', 'method': 'POST', 'path': '/'},
+                       receive, send)
+
+        async def scenario():
+            await request(self.body(tid='1', command='success'))
+            await request(b'service_id=10000&check=bad')
+            await app.queue.join()
+            await app.queue.stop()
+
+        asyncio.run(scenario())
+        statuses = [m['status'] for m in sent
+                    if m['type'] == 'http.response.start']
+        self.assertEqual(statuses, [200, 400])
+        self.assertEqual(callback.calls, ['1'])
+
+
+class StubAsyncPool(object):
+    def __init__(self, responses, exc=None):
+        self.responses = responses
+        self.exc = exc
+        self.requests = []
+
+    async def request(self, method, url, data=None, timeout=None):
+        self.requests.append((method, url, data))
+        if self.exc:
+            raise self.exc
+        status_code, body = self.responses[url]
+        return status_code, json.dumps(body).encode('utf-8')
+
+    async def close(self):
+        pass
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncServiceTestCase(TestCase):
+    base_url = AlbaService.FIRST_CONNECTION_PROFILE['base_url']
+
+    def make_service(self, responses, exc=None):
+        return AsyncAlbaService('10000', 'secret',
+                                pool=StubAsyncPool(responses, exc))
+
+    def test_init_payment(self):
+        service = self.make_service({
+            self.base_url + 'alba/input/':
+                (200, {'status': 'success', 'tid': 100})})
+        response = asyncio.run(service.init_payment(
+            'mc', 200, 'Test', 'test@test.ru', '79091234567'))
+        self.assertEqual(response['tid'], 100)
+        method, url, data = service.pool.requests[0]
+        self.assertEqual(method, 'post')
+        self.assertIn('check', data)
+
+    def test_pay_types(self):
+        service = self.make_service({})
+        service.pool.responses[service._pay_types_url()] = (
+            200, {'status': 'success', 'types': ['mc']})
+        self.assertEqual(asyncio.run(service.pay_types()), ['mc'])
+
+    def test_cached_pay_types(self):
+        service = self.make_service({})
+        service.cache = MetadataCache()
+        service.pool.responses[service._pay_types_url()] = (
+            200, {'status': 'success', 'types': ['mc']})
+        asyncio.run(service.pay_types())
+        self.assertEqual(asyncio.run(service.pay_types()), ['mc'])
+        self.assertEqual(len(service.pool.requests), 1)
+
+    def test_create_card_token(self):
+        service = self.make_service({
+            AlbaService.FIRST_CONNECTION_PROFILE['card_token_test_url']
+            + 'create':
+                (200, {'status': 'success', 'token': 'test'})})
+        token = asyncio.run(service.create_card_token(
+            '4300000000000777', '1', '22', '123', test=True))
+        self.assertEqual(token, 'test')
+        self.assertEqual(service.pool.requests[0][2]['exp_month'], '01')
+
+    def test_coalesced_transaction_details(self):
+        service = self.make_service({
+            self.base_url + 'alba/details/':
+                (200, {'status': 'success', 'tid': 100})})
+        service.singleflight = SingleFlight()
+
+        async def scenario():
+            return await asyncio.gather(
+                *[service.transaction_details(tid=100) for _ in range(5)])
+
+        results = asyncio.run(scenario())
+        self.assertEqual([r['tid'] for r in results], [100] * 5)
+        self.assertEqual(len(service.pool.requests), 1)
+        self.assertEqual(service.singleflight.collapsed, 4)
+
+    def test_coalesced_call_respects_deadline(self):
+        service = self.make_service({})
+        service.singleflight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(1)
+
+        async def scenario():
+            leader = asyncio.ensure_future(service._coalesce(('key',), slow))
+            await asyncio.sleep(0)
+            try:
+                with self.assertRaises(AlbaTimeoutError):
+                    await service._coalesce(('key',), slow, deadline=0.05)
+            finally:
+                leader.cancel()
+
+        started = time.time()
+        asyncio.run(scenario())
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(service.singleflight.collapsed, 1)
+
+    def test_cancelled_hedge_probe_released(self):
+        primary = {'card_token_url': 'https://token-a.example/'}
+        secondary = {'card_token_url': 'https://token-b.example/'}
+        delays = {primary['card_token_url']: 0.05,
+                  secondary['card_token_url']: 1}
+
+        class DelayedPool(StubAsyncPool):
+            async def request(self, method, url, data=None, timeout=None):
+                await asyncio.sleep(delays[url.rsplit('create', 1)[0]])
+                return 200, b'{"status": "success", "token": "test"}'
+
+        failover = Failover([primary, secondary], failure_threshold=1,
+                            reset_timeout=60, hedge_after=0.01)
+        probe = failover.endpoints['card_token_url'][1]
+        probe.record_failure()
+        probe.breaker.opened_at -= 60
+        service = AsyncAlbaService('10000', 'secret', failover=failover,
+                                   pool=DelayedPool({}))
+        token = asyncio.run(service.create_card_token(
+            '4300000000000777', '1', '22', '123', test=False))
+        self.assertEqual(token, 'test')
+        self.assertEqual(probe.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(probe.breaker.allow())
+
+    def test_coalesced_error(self):
+        service = self.make_service({
+            self.base_url + 'alba/details/':
+                (200, {'status': 'error', 'code': 'auth', 'msg': 'Auth'})})
+        service.singleflight = SingleFlight()
+
+        async def scenario():
+            return await asyncio.gather(
+                *[service.transaction_details(tid=1) for _ in range(3)],
+                return_exceptions=True)
+
+        results = asyncio.run(scenario())
+        self.assertTrue(all(isinstance(r, AuthError) for r in results))
+        self.assertEqual(len(service.pool.requests), 1)
+
+    def test_request_metrics(self):
+        metrics = Metrics()
+        service = self.make_service({
+            self.base_url + 'alba/details/':
+                (200, {'status': 'success', 'tid': 100})})
+        service.add_hook(metrics)
+        asyncio.run(service.transaction_details(tid=100))
+        self.assertEqual(metrics.requests['alba/details/', 'ok'], 1)
+
+    def test_typed_transaction_details(self):
+        service = self.make_service({
+            self.base_url + 'alba/details/':
+                (200, {'status': 'success', 'tid': 100, 'cost': '5.00'})})
+        service.typed = True
+        details = asyncio.run(service.transaction_details(tid=100))
+        self.assertIsInstance(details, Transaction)
+        self.assertEqual(details.cost, Decimal('5.00'))
+
+    def test_error_code_mapping(self):
+        service = self.make_service({
+            self.base_url + 'alba/details/':
+                (200, {'status': 'error', 'code': 'auth', 'msg': 'Auth'})})
+        with self.assertRaises(AuthError):
+            asyncio.run(service.transaction_details(tid=100))
+
+    def test_server_unavailable(self):
+        service = self.make_service({
+            self.base_url + 'alba/refund/': (502, {})})
+        with self.assertRaises(AlbaException):
+            asyncio.run(service.refund(10))
+
+    def test_connection_error(self):
+        service = self.make_service(
+            {}, exc=aiohttp.ClientConnectionError('refused'))
+        with self.assertRaises(AlbaException):
+            asyncio.run(service.gate_details('mc'))
+
+    def test_transaction_details_batch(self):
+        service = self.make_service({
+            self.base_url + 'alba/details/':
+                (200, {'status': 'error', 'code': 'unique', 'msg': 'Dup'})})
+
+        async def collect():
+            return [r async for r in service.transaction_details_batch(
+                tids=range(1, 6), max_workers=2)]
+
+        results = asyncio.run(collect())
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(r.error is not None for r in results))
+
+    def test_create_card_tokens(self):
+        service = self.make_service({
+            AlbaService.FIRST_CONNECTION_PROFILE['card_token_url']
+            + 'create': (200, {'status': 'success', 'token': 'test'})})
+
+        async def collect():
+            return [r async for r in service.create_card_tokens(
+                [{'card': '4300000000000777', 'exp_month': '01',
+                  'exp_year': '22', 'cvc': '123'}] * 3,
+                test=False, max_workers=2)]
+
+        results = asyncio.run(collect())
+        self.assertEqual([r.result for r in results], ['test'] * 3)
+
+    def test_timeout_error(self):
+        service = self.make_service({}, exc=asyncio.TimeoutError())
+        with self.assertRaises(AlbaTimeoutError):
+            asyncio.run(service.transaction_details(tid=1, deadline=1))
+
+    def test_encode_params(self):
+        self.assertEqual(
+            sorted(_encode_params({'a': 1, 'b': None, 'check': b'c2ln'})),
+            [('a', '1'), ('check', 'c2ln')])
+
+    def test_session_closed_with_loop(self):
+        server = StubServer({'status': 'success'})
+        self.addCleanup(server.stop)
+        pool = AsyncConnectionPool()
+        sessions = []
+
+        async def request():
+            await pool.request('get', server.url)
+            sessions.append(pool.session)
+
+        for _ in range(3):
+            asyncio.run(request())
+        self.assertEqual(len(set(sessions)), 3)
+        self.assertTrue(all(session.closed for session in sessions))
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Транспорты, через которые AlbaService отправляет HTTP-запросы.
+
+Транспорт - объект с методами request(method, url, data=None,
+timeout=None), возвращающим пару (status_code, content), и close().
+Ошибки сети транспорт приводит к AlbaTimeoutError и AlbaConnectionError.
+
+    from alba_client.transport import Urllib3Transport
+
+    service = AlbaService(<service-id>, '<service-secret>',
+                          transport=Urllib3Transport(pool_size=20))
+"""
+from __future__ import unicode_literals
+
+import collections
+import json
+import os
+import threading
+
+import requests
+import urllib3
+
+from ._compat import text_type, urlencode
+from .connection import ConnectionPool
+from .exceptions import AlbaConnectionError, AlbaTimeoutError
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+
+def _encode_params(data):
+    """
+    Приводит параметры к тому же виду, что и requests
+    """
+    if not data:
+        return None
+    result = []
+    for key, value in data.items():
+        if value is None:
+            continue
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        result.append((key, text_type(value)))
+    return result
+
+
+class Transport(object):
+    """
+    Базовый класс транспорта
+    """
+
+    def request(self, method, url, data=None, timeout=None):
+        """
+        method 'get' или 'post', data передаётся в строке запроса
+          или в теле формы соответственно
+        timeout число секунд или пара (connect, read), None - без ограничения
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RequestsTransport(Transport):
+    """
+    Транспорт по умолчанию поверх ConnectionPool (requests.Session)
+    pool пул соединений, может быть общим для нескольких транспортов
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or ConnectionPool()
+
+    def request(self, method, url, data=None, timeout=None):
+        try:
+            response = self.pool.request(method, url, data, timeout=timeout)
+        except requests.Timeout as e:
+            raise AlbaTimeoutError(e)
+        except requests.ConnectionError as e:
+            raise AlbaConnectionError(e)
+        return response.status_code, response.content
+
+    def close(self):
+        self.pool.close()
+
+
+class Urllib3Transport(Transport):
+    """
+    Транспорт напрямую поверх urllib3.PoolManager, без накладных
+    расходов requests на сессии, хуки и разбор ответа.
+    Как и ConnectionPool, после fork пересоздаёт пул соединений.
+
+    pool_size максимальное число соединений к одному хосту
+    pool_hosts число хостов, для которых держатся соединения
+    keep_alive переиспользовать ли соединения между запросами
+    """
+
+    def __init__(self, pool_size=10, pool_hosts=4, keep_alive=True):
+        self.pool_size = pool_size
+        self.pool_hosts = pool_hosts
+        self.keep_alive = keep_alive
+        self.headers = {} if keep_alive else {'Connection': 'close'}
+        self._reset(os.getpid())
+
+    def _reset(self, pid):
+        self._lock = threading.Lock()
+        self._manager = None
+        self._pid = pid
+
+    @property
+    def manager(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._reset(pid)
+        if self._manager is None:
+            with self._lock:
+                if self._manager is None:
+                    self._manager = urllib3.PoolManager(
+                        num_pools=self.pool_hosts, maxsize=self.pool_size,
+                        block=False, retries=False)
+        return self._manager
+
+    @staticmethod
+    def _timeout(timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return urllib3.Timeout(connect=connect, read=read)
+        return urllib3.Timeout(total=timeout)
+
+    def request(self, method, url, data=None, timeout=None):
+        fields = _encode_params(data)
+        timeout = self._timeout(timeout)
+        try:
+            if method == 'get':
+                response = self.manager.request(
+                    'GET', url, fields=fields, headers=self.headers,
+                    timeout=timeout)
+            else:
+                headers = dict(self.headers)
+                headers['Content-Type'] = FORM_CONTENT_TYPE
+                response = self.manager.request(
+                    'POST', url, body=urlencode(fields or []),
+                    headers=headers, timeout=timeout)
+        except urllib3.exceptions.NewConnectionError as e:
+            raise AlbaConnectionError(e)
+        except urllib3.exceptions.TimeoutError as e:
+            raise AlbaTimeoutError(e)
+        except urllib3.exceptions.HTTPError as e:
+            raise AlbaConnectionError(e)
+        return response.status, response.data
+
+    def close(self):
+        with self._lock:
+            if self._manager is not None and self._pid == os.getpid():
+                self._manager.clear()
+            self._manager = None
+
+
+class HTTPXTransport(Transport):
+    """
+    Транспорт поверх httpx.Client с поддержкой HTTP/2: запросы к одному
+    хосту мультиплексируются в одном соединении.
+    Требуется `pip install alba-client-python[http2]`.
+
+    http2 договариваться ли о HTTP/2, иначе используется HTTP/1.1
+    pool_size максимальное число соединений
+    keep_alive переиспользовать ли соединения между запросами
+    """
+
+    def __init__(self, http2=True, pool_size=10, keep_alive=True):
+        import httpx
+        self._httpx = httpx
+        self.http2 = http2
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # клиент создаётся сразу, чтобы отсутствие h2 было видно заранее
+        self._client = self._create_client()
+
+    def _create_client(self):
+        limits = self._httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size if self.keep_alive else 0)
+        return self._httpx.Client(http2=self.http2, limits=limits)
+
+    @property
+    def client(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._client = self._create_client()
+                    self._pid = pid
+        return self._client
+
+    def _timeout(self, timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self._httpx.Timeout(None, connect=connect, read=read)
+        return self._httpx.Timeout(timeout)
+
+    def request(self, method, url, data=None, timeout=None):
+        fields = _encode_params(data)
+        timeout = self._timeout(timeout)
+        httpx = self._httpx
+        try:
+            if method == 'get':
+                response = self.client.get(url, params=fields,
+                                           timeout=timeout)
+            else:
+                response = self.client.post(url, data=dict(fields or ()),
+                                            timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise AlbaTimeoutError(e)
+        except httpx.TransportError as e:
+            raise AlbaConnectionError(e)
+        return response.status_code, response.content
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._client.close()
+
+
+class MemoryTransport(Transport):
+    """
+    Транспорт без сети для тестов и бенчмарков.
+
+    responses ответы по адресу запроса {url: (status_code, body)}
+    handler функция handler(method, url, data) -> (status_code, body),
+      если задана, responses не используется
+    history сколько последних запросов хранить в requests
+
+    body может быть bytes или объектом, который сериализуется в JSON.
+    """
+
+    def __init__(self, responses=None, handler=None, history=1000):
+        self.responses = dict(responses or {})
+        self.handler = handler
+        self.requests = collections.deque(maxlen=history)
+
+    def request(self, method, url, data=None, timeout=None):
+        self.requests.append((method, url, data))
+        if self.handler is not None:
+            status_code, body = self.handler(method, url, data)
+        else:
+            try:
+                status_code, body = self.responses[url]
+            except KeyError:
+                raise AlbaConnectionError('Нет ответа для {}'.format(url))
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        return status_code, body
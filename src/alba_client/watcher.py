@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Ожидание окончательного статуса транзакций.
+
+    watcher = StatusWatcher(service)
+    callback = MyCallback([service], watcher=watcher)
+
+    response = service.init_payment(...)
+    future = watcher.watch(response['tid'])
+    details = future.result()
+
+Один фоновый поток следит за всеми транзакциями и по мере наступления
+сроков отправляет запросы transaction_details в общий пул потоков.
+Интервал опроса каждой транзакции растёт от min_interval до max_interval,
+а нотификация от Alba через AlbaCallback сразу завершает ожидание.
+В asyncio future можно дождаться через asyncio.wrap_future.
+"""
+from __future__ import unicode_literals
+
+import heapq
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from ._compat import text_type
+from .batch import _call
+from .deadline import clock
+from .exceptions import AlbaConnectionError, AlbaTimeoutError
+
+TERMINAL_STATUSES = frozenset(
+    ['payed', 'success', 'refunded', 'canceled', 'error'])
+TERMINAL_COMMANDS = frozenset(['success'])
+
+
+class _Watch(object):
+    __slots__ = ('tid', 'future', 'interval', 'due', 'expires')
+
+    def __init__(self, tid, future, interval, due, expires):
+        self.tid = tid
+        self.future = future
+        self.interval = interval
+        self.due = due
+        self.expires = expires
+
+
+class StatusWatcher(object):
+    """
+    Отслеживание статусов множества транзакций.
+
+    service AlbaService, через который выполняются запросы
+    min_interval через сколько секунд опросить транзакцию впервые
+    max_interval максимальный интервал между опросами
+    factor во сколько раз увеличивается интервал после каждого опроса
+    timeout сколько секунд ждать окончательного статуса, после чего
+      future завершается AlbaTimeoutError
+    max_workers число одновременных запросов
+    terminal_statuses значения transaction_status, на которых ожидание
+      заканчивается
+    terminal_commands команды нотификаций, завершающие ожидание
+
+    Future получает ответ transaction_details либо данные нотификации,
+    ошибки, кроме ошибок соединения, завершают future исключением.
+    stats счётчики polls, resolved, notified, failed, expired
+    """
+
+    def __init__(self, service, min_interval=1, max_interval=30, factor=2,
+                 timeout=900, max_workers=10,
+                 terminal_statuses=TERMINAL_STATUSES,
+                 terminal_commands=TERMINAL_COMMANDS):
+        self.service = service
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.terminal_statuses = frozenset(terminal_statuses)
+        self.terminal_commands = frozenset(terminal_commands)
+        self.stats = Counter()
+        self._watches = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._watches)
+
+    def watch(self, tid, callback=None):
+        """
+        Начать отслеживание транзакции tid, возвращает Future.
+        callback вызывается с future, когда статус станет окончательным.
+        Повторный вызов для того же tid возвращает тот же future
+        """
+        tid = text_type(tid)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('StatusWatcher остановлен')
+            watch = self._watches.get(tid)
+            if watch is None:
+                now = clock()
+                watch = self._watches[tid] = _Watch(
+                    tid, Future(), self.min_interval,
+                    now + self.min_interval, now + self.timeout)
+                self._schedule(watch)
+                self._start()
+        if callback is not None:
+            watch.future.add_done_callback(callback)
+        return watch.future
+
+    def unwatch(self, tid):
+        """
+        Прекратить отслеживание, future отменяется
+        """
+        watch = self._pop(text_type(tid))
+        if watch is not None:
+            watch.future.cancel()
+
+    def notify(self, data):
+        """
+        Завершает ожидание по нотификации AlbaCallback
+        """
+        if data.get('command') not in self.terminal_commands:
+            return
+        self._resolve(text_type(data.get('tid')), 'notified', result=data)
+
+    def stop(self):
+        """
+        Остановка фонового потока, ожидающие future отменяются
+        """
+        with self._cond:
+            self._stopped = True
+            watches = list(self._watches.values())
+            self._watches.clear()
+            self._heap = []
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        for watch in watches:
+            watch.future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _start(self):
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _schedule(self, watch):
+        heapq.heappush(self._heap, (watch.due, watch.tid))
+        self._cond.notify()
+
+    def _pop(self, tid):
+        with self._cond:
+            return self._watches.pop(tid, None)
+
+    def _resolve(self, tid, outcome, result=None, error=None):
+        with self._cond:
+            watch = self._watches.pop(tid, None)
+            if watch is None:
+                return
+            self.stats[outcome] += 1
+        if watch.future.done():
+            return
+        if error is not None:
+            watch.future.set_exception(error)
+        else:
+            watch.future.set_result(result)
+
+    def _take_due(self):
+        """
+        Снимает с очереди транзакции, которые пора опросить или
+        срок ожидания которых истёк
+        """
+        now = clock()
+        due, expired = [], []
+        while self._heap and self._heap[0][0] <= now:
+            when, tid = heapq.heappop(self._heap)
+            watch = self._watches.get(tid)
+            if watch is None or watch.due != when:
+                continue
+            if now >= watch.expires:
+                del self._watches[tid]
+                expired.append(watch)
+            else:
+                due.append(watch)
+        return due, expired
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due, expired = self._take_due()
+                while not (due or expired or self._stopped):
+                    wait = self._heap[0][0] - clock() if self._heap else None
+                    self._cond.wait(wait)
+                    due, expired = self._take_due()
+                if self._stopped:
+                    return
+            for watch in expired:
+                with self._cond:
+                    self.stats['expired'] += 1
+                if not watch.future.done():
+                    watch.future.set_exception(AlbaTimeoutError(
+                        'Статус транзакции {} не получен'.format(watch.tid)))
+            for watch in due:
+                future = self._executor.submit(_call, self._poll, watch)
+                future.add_done_callback(self._polled)
+
+    def _poll(self, watch):
+        return self.service.transaction_details(tid=watch.tid)
+
+    def _polled(self, future):
+        watch, details, error = future.result()
+        with self._cond:
+            self.stats['polls'] += 1
+        if error is None:
+            if details.get('transaction_status') in self.terminal_statuses:
+                self._resolve(watch.tid, 'resolved', result=details)
+                return
+        elif not isinstance(error, AlbaConnectionError):
+            # ошибки соединения и таймауты повторяются по расписанию
+            self._resolve(watch.tid, 'failed', error=error)
+            return
+        with self._cond:
+            if self._watches.get(watch.tid) is not watch:
+                return
+            watch.interval = min(watch.interval * self.factor,
+                                 self.max_interval)
+            watch.due = min(clock() + watch.interval, watch.expires)
+            self._schedule(watch)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI приложение для приёма нотификаций Alba.
+
+Приложение проверяет подпись, сразу отвечает Alba и передаёт
+нотификацию в ограниченную очередь, из которой её обрабатывают
+рабочие потоки вызовом AlbaCallback. ASGI вариант - в alba_client.asgi.
+
+    from alba_client.webhook import WSGICallbackApp
+
+    application = WSGICallbackApp(MyAlbaCallback([service]), workers=4)
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import threading
+
+from ._compat import parse_qs, queue, text_type
+
+from .exceptions import AlbaException
+
+logger = logging.getLogger(__name__)
+
+REJECT = 'reject'
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+
+
+def parse_post(body):
+    """
+    Разбор тела запроса application/x-www-form-urlencoded
+    """
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return {key: values[-1] for key, values
+            in parse_qs(body, keep_blank_values=True).items()}
+
+
+def _dropped(data):
+    if data is None:
+        return
+    logger.error('Callback queue is full, dropped %s notification '
+                 'for tid %s of service %s', data.get('command'),
+                 data.get('tid'), data.get('service_id'))
+
+
+class _QueueMetrics(object):
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.accepted = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def as_dict(self, depth):
+        return {
+            'depth': depth,
+            'maxsize': self.maxsize,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+
+class CallbackQueue(object):
+    """
+    Ограниченная очередь проверенных нотификаций с рабочими потоками.
+
+    callback AlbaCallback
+    maxsize размер очереди
+    workers число рабочих потоков
+    overflow поведение при переполнении: REJECT - отказ (Alba повторит
+      доставку позже), DROP_OLDEST - вытеснить самую старую нотификацию,
+      BLOCK - ждать места не дольше block_timeout секунд.
+      Вытесненной нотификации Alba уже ответили 200 и повторно её не
+      пришлёт, поэтому DROP_OLDEST теряет события success и refund;
+      каждое вытеснение журналируется на уровне ERROR
+
+    Рабочие потоки запускаются при первой нотификации, поэтому очередь
+    можно создать до fork (gunicorn --preload): каждый процесс запускает
+    свои потоки
+    """
+
+    def __init__(self, callback, maxsize=1000, workers=4, overflow=REJECT,
+                 block_timeout=5):
+        self.callback = callback
+        self.maxsize = maxsize
+        self.workers = workers
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._reset(os.getpid())
+
+    def _reset(self, pid):
+        self._lock = threading.Lock()
+        self.queue = queue.Queue(self.maxsize)
+        self.stats = _QueueMetrics(self.maxsize)
+        self._threads = []
+        self._pid = pid
+
+    def start(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # потоков родителя в дочернем процессе нет, а нотификации
+            # из его очереди он обработает сам
+            self._reset(pid)
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            threads = []
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(self.queue,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            self._threads = threads
+
+    def put(self, data):
+        """
+        Добавляет нотификацию, возвращает False, если она не принята
+        """
+        self.start()
+        try:
+            if self.overflow == BLOCK:
+                self.queue.put(data, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(data)
+        except queue.Full:
+            if self.overflow != DROP_OLDEST:
+                self.stats.incr('rejected')
+                return False
+            try:
+                _dropped(self.queue.get_nowait())
+                self.queue.task_done()
+                self.stats.incr('dropped')
+            except queue.Empty:
+                pass
+            return self.put(data)
+        self.stats.incr('accepted')
+        return True
+
+    def _work(self, tasks):
+        while True:
+            data = tasks.get()
+            try:
+                if data is None:
+                    return
+                self.callback._dispatch(data)
+                self.stats.incr('processed')
+            except Exception:
+                self.stats.incr('failed')
+                logger.exception('Callback processing failed')
+            finally:
+                tasks.task_done()
+
+    def join(self):
+        """
+        Ожидание обработки всех принятых нотификаций
+        """
+        self.queue.join()
+
+    def stop(self):
+        if self._pid != os.getpid():
+            return
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def metrics(self):
+        return self.stats.as_dict(self.queue.qsize())
+
+
+def _response(status, body):
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    return status, [('Content-Type', 'text/plain; charset=utf-8'),
+                    ('Content-Length', str(len(body)))], body
+
+
+def _verify(callback, body):
+    """
+    Разбор и проверка нотификации; возвращает (post, None) или
+    (None, ответ 400), в том числе для некорректного тела запроса
+    """
+    try:
+        post = parse_post(body)
+        callback.verify(post)
+    except AlbaException as e:
+        return None, _response(400, text_type(e))
+    except (KeyError, ValueError):
+        return None, _response(400, 'Malformed notification')
+    return post, None
+
+
+def _metrics_response(metrics):
+    status, headers, body = _response(200, json.dumps(metrics))
+    headers[0] = ('Content-Type', 'application/json')
+    return status, headers, body
+
+
+class WSGICallbackApp(object):
+    """
+    WSGI приложение для приёма нотификаций.
+    Ответ 200 - нотификация принята, 400 - не прошла проверку,
+    503 - очередь переполнена. GET на metrics_path отдаёт метрики
+    очереди в JSON.
+    """
+    STATUS = {200: '200 OK', 400: '400 Bad Request',
+              404: '404 Not Found', 405: '405 Method Not Allowed',
+              503: '503 Service Unavailable'}
+
+    def __init__(self, callback, queue=None, metrics_path='/metrics',
+                 **queue_kwargs):
+        self.callback = callback
+        self.queue = queue or CallbackQueue(callback, **queue_kwargs)
+        self.metrics_path = metrics_path
+
+    def process(self, method, path, body):
+        if method == 'GET' and path == self.metrics_path:
+            return _metrics_response(self.queue.metrics())
+        if method != 'POST':
+            return _response(405, 'Method not allowed')
+        post, error = _verify(self.callback, body)
+        if error is not None:
+            return error
+        if not self.queue.put(post):
+            return _response(503, 'Queue is full')
+        return _response(200, 'OK')
+
+    def __call__(self, environ, start_response):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        body = environ['wsgi.input'].read(length) if length else b''
+        status, headers, body = self.process(
+            environ['REQUEST_METHOD'], environ.get('PATH_INFO', ''), body)
+        start_response(self.STATUS[status], headers)
+        return [body]